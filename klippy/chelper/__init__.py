@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging
+import sys, os, logging, hashlib, subprocess, time
 import cffi
 
 
@@ -16,18 +16,28 @@ COMPILE_ARGS = ("-Wall -g -O2 -shared -fPIC"
                 " -flto -fwhole-program -fno-use-linker-plugin"
                 " -o %s %s")
 SSE_FLAGS = "-mfpmath=sse -msse2"
+# Additional compile options for each optional build variant (the first
+# option in each list that is supported by the compiler is used)
+VARIANT_FLAGS = {
+    'generic': [],
+    'native': [["-march=native", "-mcpu=native"]],
+}
 SOURCE_FILES = [
     'pyhelper.c', 'serialqueue.c', 'stepcompress.c', 'steppersync.c',
-    'itersolve.c', 'trapq.c', 'pollreactor.c', 'msgblock.c', 'trdispatch.c',
+    'itersolve.c', 'trapq.c', 'lookahead.c', 'pollreactor.c', 'msgblock.c',
+    'trdispatch.c', 'bulkqueue.c',
     'kin_cartesian.c', 'kin_corexy.c', 'kin_corexz.c', 'kin_delta.c',
     'kin_deltesian.c', 'kin_polar.c', 'kin_rotary_delta.c', 'kin_winch.c',
     'kin_extruder.c', 'kin_shaper.c', 'kin_idex.c', 'kin_generic.c'
 ]
-DEST_LIB = "c_helper.so"
+DEST_LIB = "c_helper-%s-%s.so"
 OTHER_FILES = [
     'list.h', 'serialqueue.h', 'stepcompress.h', 'steppersync.h',
-    'itersolve.h', 'pyhelper.h', 'trapq.h', 'pollreactor.h', 'msgblock.h'
+    'itersolve.h', 'pyhelper.h', 'trapq.h', 'lookahead.h', 'pollreactor.h',
+    'msgblock.h', 'compiler.h'
 ]
+CACHE_DIR = "~/.cache/klipper"
+FAILED_BUILD_RETRY_TIME = 24. * 60. * 60.
 
 defs_stepcompress = """
     struct pull_history_steps {
@@ -49,9 +59,17 @@ defs_stepcompress = """
     int stepcompress_extract_old(struct stepcompress *sc
         , struct pull_history_steps *p, int max
         , uint64_t start_clock, uint64_t end_clock);
+    int stepcompress_export(struct stepcompress *sc
+        , struct pull_history_steps *p, int max
+        , uint64_t start_clock, uint64_t end_clock);
 """
 
 defs_steppersync = """
+    struct syncemitter_stats {
+        double gen_time, flush_time;
+        uint64_t gen_count, step_count, msg_count;
+    };
+
     struct stepcompress *syncemitter_get_stepcompress(struct syncemitter *se);
     void syncemitter_set_stepper_kinematics(struct syncemitter *se
         , struct stepper_kinematics *sk);
@@ -59,6 +77,8 @@ defs_steppersync = """
         struct syncemitter *se);
     void syncemitter_queue_msg(struct syncemitter *se, uint64_t req_clock
         , uint32_t *data, int len);
+    void syncemitter_get_stats(struct syncemitter *se
+        , struct syncemitter_stats *stats);
     struct syncemitter *steppersync_alloc_syncemitter(struct steppersync *ss
         , char name[16], int alloc_stepcompress);
     void steppersync_setup_movequeue(struct steppersync *ss
@@ -69,6 +89,9 @@ defs_steppersync = """
     void steppersyncmgr_free(struct steppersyncmgr *ssm);
     struct steppersync *steppersyncmgr_alloc_steppersync(
         struct steppersyncmgr *ssm);
+    void steppersyncmgr_start_gen_steps(struct steppersyncmgr *ssm
+        , double flush_time, double gen_steps_time, double clear_history_time);
+    int32_t steppersyncmgr_finalize_gen_steps(struct steppersyncmgr *ssm);
     int32_t steppersyncmgr_gen_steps(struct steppersyncmgr *ssm
         , double flush_time, double gen_steps_time, double clear_history_time);
 """
@@ -110,6 +133,23 @@ defs_trapq = """
         , double pos_x, double pos_y, double pos_z);
     int trapq_extract_old(struct trapq *tq, struct pull_move *p, int max
         , double start_time, double end_time);
+    int trapq_export(struct trapq *tq, struct pull_move *p, int max
+        , double start_time, double end_time);
+"""
+
+defs_lookahead = """
+    struct lookahead_junction {
+        double start_v2, cruise_v2, end_v2;
+    };
+
+    struct lookahead *lookahead_alloc(void);
+    void lookahead_free(struct lookahead *la);
+    void lookahead_reset(struct lookahead *la);
+    void lookahead_add_move(struct lookahead *la, double max_start_v2
+        , double max_cruise_v2, double delta_v2
+        , double max_mcr_start_v2, double mcr_delta_v2);
+    int lookahead_flush(struct lookahead *la, int lazy
+        , struct lookahead_junction *res);
 """
 
 defs_kin_cartesian = """
@@ -197,8 +237,13 @@ defs_serialqueue = """
     void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
         , uint8_t *msg, int len, uint64_t min_clock, uint64_t req_clock
         , uint64_t notify_id);
+    void serialqueue_send_multi(struct serialqueue *sq
+        , struct command_queue *cq, uint8_t *msgs, int *lens, int count
+        , uint64_t min_clock, uint64_t req_clock);
     void serialqueue_pull(struct serialqueue *sq
         , struct pull_queue_message *pqm);
+    int serialqueue_pull_batch(struct serialqueue *sq
+        , struct pull_queue_message *q, int max);
     void serialqueue_set_wire_frequency(struct serialqueue *sq
         , double frequency);
     void serialqueue_set_receive_window(struct serialqueue *sq
@@ -223,6 +268,29 @@ defs_trdispatch = """
         , uint64_t expire_ticks, uint64_t min_extend_ticks);
 """
 
+defs_bulkqueue = """
+    #define MESSAGE_PAYLOAD_MAX 59
+    struct pull_bulk_message {
+        uint32_t sequence;
+        int len;
+        uint8_t data[MESSAGE_PAYLOAD_MAX];
+    };
+
+    struct bulkqueue *bulkqueue_alloc(uint32_t size);
+    void bulkqueue_free(struct bulkqueue *bq);
+    void bulkqueue_setup(struct bulkqueue *bq, struct serialqueue *sq
+        , uint32_t msgtag, uint32_t oid);
+    int bulkqueue_pull(struct bulkqueue *bq, struct pull_bulk_message *p
+        , int max);
+    int bulkqueue_pull_samples(struct bulkqueue *bq, int bytes_per_sample
+        , int samples_per_block, int64_t last_sequence
+        , double time_base, double chip_base, double inv_freq
+        , double *times, uint8_t *data, int max
+        , int64_t *last_chip_clock);
+    void bulkqueue_clear(struct bulkqueue *bq);
+    uint32_t bulkqueue_get_dropped(struct bulkqueue *bq);
+"""
+
 defs_pyhelper = """
     void set_python_logging_callback(void (*func)(const char *));
     double get_monotonic(void);
@@ -235,8 +303,9 @@ defs_std = """
 
 defs_all = [
     defs_pyhelper, defs_serialqueue, defs_std, defs_stepcompress,
-    defs_steppersync, defs_itersolve, defs_trapq, defs_trdispatch,
-    defs_kin_cartesian, defs_kin_corexy, defs_kin_corexz, defs_kin_delta,
+    defs_steppersync, defs_itersolve, defs_trapq, defs_lookahead,
+    defs_trdispatch, defs_bulkqueue, defs_kin_cartesian, defs_kin_corexy,
+    defs_kin_corexz, defs_kin_delta,
     defs_kin_deltesian, defs_kin_polar, defs_kin_rotary_delta, defs_kin_winch,
     defs_kin_extruder, defs_kin_shaper, defs_kin_idex,
     defs_kin_generic_cartesian,
@@ -278,28 +347,242 @@ def do_build_code(cmd):
         logging.error(msg)
         raise Exception(msg)
 
-# Build the main c_helper.so c code library
-def check_build_c_library():
+# Return a hash of the contents of the given files and build options
+def get_build_hash(filelist, options):
+    h = hashlib.sha1(options.encode())
+    for filename in filelist:
+        f = open(filename, 'rb')
+        h.update(f.read())
+        f.close()
+    return h.hexdigest()[:16]
+
+# Return cpu identification (for builds that are tuned to the host cpu)
+def get_cpu_signature():
+    try:
+        f = open('/proc/cpuinfo', 'r')
+        data = f.read()
+        f.close()
+    except:
+        return ""
+    keys = ['model name', 'flags', 'cpu implementer', 'cpu architecture',
+            'cpu part', 'features']
+    lines = set([l.strip() for l in data.split('\n')
+                 if l.split(':')[0].strip().lower() in keys])
+    return '\n'.join(sorted(lines))
+
+# Directories that may contain c_helper.so (the first writable
+# directory is used when building).  The shared cache is separated
+# by source directory so that different checkouts do not remove each
+# other's builds.
+def get_cache_dirs(srcdir):
+    srchash = hashlib.sha1(srcdir.encode()).hexdigest()[:16]
+    cachedir = os.path.join(os.path.expanduser(CACHE_DIR), "chelper-" + srchash)
+    return [srcdir, cachedir]
+
+# Check if a recent build attempt failed
+def check_failed_build(failname):
+    try:
+        fail_time = os.path.getmtime(failname)
+    except os.error:
+        return False
+    return abs(time.time() - fail_time) < FAILED_BUILD_RETRY_TIME
+
+# Note a failed build (it is retried after FAILED_BUILD_RETRY_TIME)
+def note_failed_build(destdir, variant, failname, msg):
+    remove_stale_builds(destdir, variant, failname)
+    try:
+        f = open(os.path.join(destdir, failname), 'w')
+        f.write("%s\n" % (msg,))
+        f.close()
+    except IOError:
+        pass
+
+# Select the command line to build a given variant (or None if the
+# compiler does not support the variant)
+def get_build_command(variant):
+    flags = []
+    if check_gcc_option(SSE_FLAGS):
+        flags.append(SSE_FLAGS)
+    for options in VARIANT_FLAGS[variant]:
+        options = [o for o in options if check_gcc_option(o)]
+        if not options:
+            return None
+        flags.append(options[0])
+    return " ".join([GCC_CMD] + flags + [COMPILE_ARGS])
+
+# Remove libraries from previous builds of a variant
+def remove_stale_builds(destdir, variant, keep):
+    prefix = DEST_LIB.split('%s')[0] + variant + '-'
+    for fname in os.listdir(destdir):
+        if fname.startswith(prefix) and fname != keep:
+            try:
+                os.remove(os.path.join(destdir, fname))
+            except os.error:
+                pass
+
+# Build (or locate a previous build of) a c_helper.so variant
+def build_c_library(variant):
     srcdir = os.path.dirname(os.path.realpath(__file__))
     srcfiles = get_abs_files(srcdir, SOURCE_FILES)
     ofiles = get_abs_files(srcdir, OTHER_FILES)
-    destlib = get_abs_files(srcdir, [DEST_LIB])[0]
-    if not check_build_code(srcfiles+ofiles+[__file__], destlib):
-        # Code already built
-        return destlib
-    # Select command line options
-    if check_gcc_option(SSE_FLAGS):
-        cmd = "%s %s %s" % (GCC_CMD, SSE_FLAGS, COMPILE_ARGS)
+    build_options = " ".join([variant, COMPILE_ARGS, SSE_FLAGS,
+                              repr(VARIANT_FLAGS[variant])])
+    if variant != 'generic':
+        build_options += "\n" + get_cpu_signature()
+    build_hash = get_build_hash(sorted(srcfiles + ofiles) + [__file__],
+                                build_options)
+    libname = DEST_LIB % (variant, build_hash)
+    failname = DEST_LIB % (variant, build_hash + "-failed")
+    cache_dirs = get_cache_dirs(srcdir)
+    for destdir in cache_dirs:
+        if os.path.exists(os.path.join(destdir, libname)):
+            # Code already built
+            return os.path.join(destdir, libname)
+        if check_failed_build(os.path.join(destdir, failname)):
+            raise Exception("Build of C code variant %s recently failed"
+                            % (variant,))
+    # Find directory to store library in
+    for destdir in cache_dirs:
+        try:
+            if not os.path.exists(destdir):
+                os.makedirs(destdir)
+        except os.error:
+            continue
+        if os.access(destdir, os.W_OK):
+            break
     else:
-        cmd = "%s %s" % (GCC_CMD, COMPILE_ARGS)
+        raise Exception("Unable to find a writable directory for %s"
+                        % (libname,))
+    destlib = os.path.join(destdir, libname)
+    # Select command line options
+    cmd = get_build_command(variant)
+    if cmd is None:
+        msg = "Compiler does not support C code variant %s" % (variant,)
+        note_failed_build(destdir, variant, failname, msg)
+        raise Exception(msg)
     # Invoke compiler
-    logging.info("Building C code module %s", DEST_LIB)
-    tempdestlib = get_abs_files(srcdir, ["_temp_" + DEST_LIB])[0]
-    do_build_code(cmd % (tempdestlib, ' '.join(srcfiles)))
+    logging.info("Building C code module %s", destlib)
+    tempdestlib = os.path.join(destdir, "_temp_" + libname)
+    try:
+        do_build_code(cmd % (tempdestlib, ' '.join(srcfiles)))
+    except Exception as e:
+        if variant != 'generic':
+            note_failed_build(destdir, variant, failname, str(e))
+        raise
     # Rename from temporary file to final file name
     os.rename(tempdestlib, destlib)
+    remove_stale_builds(destdir, variant, libname)
     return destlib
 
+# Time a step generation workload (itersolve and stepcompress) using
+# the given c_helper.so library.  Returns seconds per iteration.
+def benchmark_library(destlib, duration=1.):
+    ffi_main = cffi.FFI()
+    for d in defs_all:
+        ffi_main.cdef(d)
+    ffi_lib = ffi_main.dlopen(destlib)
+    devnull = open(os.devnull, 'wb')
+    sq = ffi_lib.serialqueue_alloc(devnull.fileno(), b'f', 0, b'bench')
+    ssm = ffi_lib.steppersyncmgr_alloc()
+    ss = ffi_lib.steppersyncmgr_alloc_steppersync(ssm)
+    ffi_lib.steppersync_setup_movequeue(ss, sq, 1024)
+    ffi_lib.steppersync_set_time(ss, 0., 16000000.)
+    trapq = ffi_lib.trapq_alloc()
+    for oid, axis in enumerate('xyz'):
+        se = ffi_lib.steppersync_alloc_syncemitter(ss, b'stepper', True)
+        sc = ffi_lib.syncemitter_get_stepcompress(se)
+        ffi_lib.stepcompress_fill(sc, oid, 25, 1, 2)
+        sk = ffi_lib.cartesian_stepper_alloc(axis.encode())
+        ffi_lib.itersolve_set_trapq(sk, trapq, 0.0125)
+        ffi_lib.itersolve_set_position(sk, 100., 100., 10.)
+        ffi_lib.syncemitter_set_stepper_kinematics(se, sk)
+    # Generate steps for a series of moves in alternating directions
+    count = 0
+    move_time = 0.
+    start_time = time.time()
+    while 1:
+        d = 1. - 2. * (count & 1)
+        ffi_lib.trapq_append(trapq, move_time, 0.05, 0.1, 0.05,
+                             100. - 9. * d, 100. - 12. * d, 10.,
+                             .6 * d, .8 * d, 0., 0., 200., 4000.)
+        move_time += 0.2
+        ret = ffi_lib.steppersyncmgr_gen_steps(ssm, move_time, move_time, 0.)
+        if ret:
+            raise Exception("Error in step generation benchmark")
+        ffi_lib.trapq_finalize_moves(trapq, move_time, move_time)
+        count += 1
+        elapsed = time.time() - start_time
+        if elapsed >= duration:
+            break
+    ffi_lib.serialqueue_exit(sq)
+    devnull.close()
+    return elapsed / count
+
+# Run benchmark_library() in a separate process
+def run_benchmark_process(destlib, duration=1.):
+    srcdir = os.path.dirname(os.path.realpath(__file__))
+    cmd = [sys.executable, os.path.join(srcdir, '__init__.py'),
+           '--benchmark', destlib, str(duration)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    out = proc.communicate()[0]
+    if proc.returncode:
+        raise Exception("Benchmark of %s failed" % (destlib,))
+    return float(out.strip())
+
+# Build all variants and select the fastest one
+def select_c_library():
+    libs = {'generic': build_c_library('generic')}
+    for variant in sorted(VARIANT_FLAGS):
+        if variant in libs:
+            continue
+        try:
+            libs[variant] = build_c_library(variant)
+        except Exception as e:
+            logging.info("C code variant %s unavailable: %s", variant, e)
+    # The selection is stored as a symlink to the fastest library
+    choicename = os.path.join(os.path.dirname(libs['generic']), DEST_LIB % (
+        'auto', get_build_hash([], " ".join(sorted(libs.values())))))
+    if os.path.exists(choicename):
+        return os.path.realpath(choicename)
+    results = {}
+    for variant, destlib in libs.items():
+        try:
+            results[variant] = run_benchmark_process(destlib)
+        except Exception as e:
+            logging.info("C code variant %s failed: %s", variant, e)
+    if not results:
+        return libs['generic']
+    variant = min(results, key=results.get)
+    logging.info("C code variant benchmark: %s (selected %s)",
+                 " ".join(["%s=%.3fms" % (v, t * 1000.)
+                           for v, t in sorted(results.items())]), variant)
+    try:
+        remove_stale_builds(os.path.dirname(choicename), 'auto', '')
+        os.symlink(libs[variant], choicename)
+    except os.error:
+        logging.exception("Unable to store C code variant selection")
+    return libs[variant]
+
+build_variant = 'generic'
+
+# Set the c_helper.so variant to use ('generic', 'native', or 'auto')
+def set_build_variant(variant):
+    global build_variant
+    build_variant = variant
+
+# Build the main c_helper.so c code library
+def check_build_c_library():
+    if build_variant == 'auto':
+        return select_c_library()
+    try:
+        return build_c_library(build_variant)
+    except Exception as e:
+        if build_variant == 'generic':
+            raise
+        logging.warning("Unable to use C code variant %s (%s) - using"
+                        " generic build", build_variant, e)
+    return build_c_library('generic')
+
 FFI_main = None
 FFI_lib = None
 pyhelper_logging_callback = None
@@ -348,4 +631,8 @@ def run_hub_ctrl(enable_power):
 
 
 if __name__ == '__main__':
-    get_ffi()
+    if len(sys.argv) == 4 and sys.argv[1] == '--benchmark':
+        print("%.9f" % (benchmark_library(sys.argv[2],
+                                          float(sys.argv[3])),))
+    else:
+        get_ffi()
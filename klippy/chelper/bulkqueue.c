@@ -0,0 +1,181 @@
+// Storage of bulk sensor data messages in a lock-free ring buffer
+//
+// Copyright (C) 2025  Kevin O'Connor <kevin@koconnor.net>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stddef.h> // offsetof
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // ARRAY_SIZE
+#include "msgblock.h" // msgblock_decode_buffer
+#include "pyhelper.h" // errorf
+#include "serialqueue.h" // serialqueue_add_fastreader
+
+struct bulkqueue_entry {
+    uint16_t sequence;
+    uint8_t len;
+    uint8_t data[MESSAGE_PAYLOAD_MAX];
+};
+
+// The ring has a single producer (the serialqueue thread) and a
+// single consumer (the host python code).  The 'head' is only written
+// by the producer and the 'tail' is only written by the consumer.
+struct bulkqueue {
+    struct fastreader fr;
+    struct bulkqueue_entry *entries;
+    uint32_t size, head, tail, dropped;
+};
+
+struct pull_bulk_message {
+    uint32_t sequence;
+    int len;
+    uint8_t data[MESSAGE_PAYLOAD_MAX];
+};
+
+// Handle a sensor_bulk_data message (callback from serialqueue fastreader)
+static void
+handle_bulk_data(struct fastreader *fr, uint8_t *data, int len)
+{
+    struct bulkqueue *bq = container_of(fr, struct bulkqueue, fr);
+
+    // Parse: sensor_bulk_data oid=%c sequence=%hu data=%*s
+    uint32_t fields[3];
+    uint8_t *buf;
+    int buf_len = msgblock_decode_buffer(fields, ARRAY_SIZE(fields), &buf
+                                         , data, len);
+    if (buf_len < 0)
+        return;
+
+    // Add to ring
+    uint32_t head = bq->head;
+    uint32_t tail = __atomic_load_n(&bq->tail, __ATOMIC_ACQUIRE);
+    if (head - tail >= bq->size) {
+        __atomic_store_n(&bq->dropped, bq->dropped + 1, __ATOMIC_RELAXED);
+        return;
+    }
+    struct bulkqueue_entry *e = &bq->entries[head & (bq->size - 1)];
+    e->sequence = fields[2];
+    e->len = buf_len;
+    memcpy(e->data, buf, buf_len);
+    __atomic_store_n(&bq->head, head + 1, __ATOMIC_RELEASE);
+}
+
+// Extract raw messages from the queue
+int __visible
+bulkqueue_pull(struct bulkqueue *bq, struct pull_bulk_message *p, int max)
+{
+    uint32_t tail = bq->tail;
+    uint32_t head = __atomic_load_n(&bq->head, __ATOMIC_ACQUIRE);
+    int count = 0;
+    while (tail != head && count < max) {
+        struct bulkqueue_entry *e = &bq->entries[tail & (bq->size - 1)];
+        p->sequence = e->sequence;
+        p->len = e->len;
+        memcpy(p->data, e->data, e->len);
+        p++;
+        count++;
+        tail++;
+    }
+    __atomic_store_n(&bq->tail, tail, __ATOMIC_RELEASE);
+    return count;
+}
+
+// Extract fixed size samples from the queue and calculate the time
+// of each sample.  Sample data is copied to 'data' and sample times
+// to 'times'.  Returns the number of samples extracted.
+int __visible
+bulkqueue_pull_samples(struct bulkqueue *bq, int bytes_per_sample
+                       , int samples_per_block, int64_t last_sequence
+                       , double time_base, double chip_base, double inv_freq
+                       , double *times, uint8_t *data, int max
+                       , int64_t *last_chip_clock)
+{
+    uint32_t tail = bq->tail;
+    uint32_t head = __atomic_load_n(&bq->head, __ATOMIC_ACQUIRE);
+    int count = 0;
+    while (tail != head) {
+        struct bulkqueue_entry *e = &bq->entries[tail & (bq->size - 1)];
+        // A message never holds more than one block of samples
+        int msg_samples = e->len / bytes_per_sample, i;
+        if (msg_samples > samples_per_block)
+            msg_samples = samples_per_block;
+        if (count + msg_samples > max)
+            break;
+        tail++;
+        // Determine 64bit message sequence from 16bit sequence
+        int32_t seq_diff = (e->sequence - last_sequence) & 0xffff;
+        seq_diff -= (seq_diff & 0x8000) << 1;
+        int64_t seq = last_sequence + seq_diff;
+        double msg_cdiff = seq * samples_per_block - chip_base;
+        for (i = 0; i < msg_samples; i++)
+            times[count + i] = time_base + (msg_cdiff + i) * inv_freq;
+        memcpy(&data[count * bytes_per_sample], e->data
+               , msg_samples * bytes_per_sample);
+        count += msg_samples;
+        if (msg_samples)
+            *last_chip_clock = seq * samples_per_block + msg_samples - 1;
+    }
+    __atomic_store_n(&bq->tail, tail, __ATOMIC_RELEASE);
+    return count;
+}
+
+// Discard all messages in the queue
+void __visible
+bulkqueue_clear(struct bulkqueue *bq)
+{
+    uint32_t head = __atomic_load_n(&bq->head, __ATOMIC_ACQUIRE);
+    __atomic_store_n(&bq->tail, head, __ATOMIC_RELEASE);
+}
+
+// Return the number of messages discarded due to a full queue
+uint32_t __visible
+bulkqueue_get_dropped(struct bulkqueue *bq)
+{
+    return __atomic_load_n(&bq->dropped, __ATOMIC_RELAXED);
+}
+
+// Start storing messages with the given message id and oid
+void __visible
+bulkqueue_setup(struct bulkqueue *bq, struct serialqueue *sq
+                , uint32_t msgtag, uint32_t oid)
+{
+    uint32_t prefix[] = {msgtag, oid};
+    struct queue_message *dummy = message_alloc_and_encode(
+        prefix, ARRAY_SIZE(prefix));
+    memcpy(bq->fr.prefix, dummy->msg, dummy->len);
+    bq->fr.prefix_len = dummy->len;
+    free(dummy);
+    bq->fr.func = handle_bulk_data;
+    bq->fr.exclusive = 1;
+    serialqueue_add_fastreader(sq, &bq->fr);
+}
+
+// Create a new 'struct bulkqueue' object
+struct bulkqueue * __visible
+bulkqueue_alloc(uint32_t size)
+{
+    struct bulkqueue *bq = malloc(sizeof(*bq));
+    memset(bq, 0, sizeof(*bq));
+    // Round size up to a power of two
+    bq->size = 1;
+    while (bq->size < size)
+        bq->size <<= 1;
+    bq->entries = malloc(bq->size * sizeof(*bq->entries));
+    if (!bq->entries) {
+        errorf("bulkqueue_alloc unable to allocate %u entries", bq->size);
+        free(bq);
+        return NULL;
+    }
+    return bq;
+}
+
+// Free a 'struct bulkqueue' (the owning serialqueue must not be active)
+void __visible
+bulkqueue_free(struct bulkqueue *bq)
+{
+    if (!bq)
+        return;
+    free(bq->entries);
+    free(bq);
+}
@@ -0,0 +1,139 @@
+// Velocity planning of queued toolhead moves ("look-ahead")
+//
+// Copyright (C) 2016-2025  Kevin O'Connor <kevin@koconnor.net>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "lookahead.h" // lookahead_flush
+
+// The code below must produce results identical to the python
+// LookAheadQueue.flush() code.  Note that this minimum helper mimics
+// the python min() function (the first value is returned on a tie).
+#define PYMIN(a, b) ((b) < (a) ? (b) : (a))
+
+struct lookahead_move {
+    double max_start_v2, max_cruise_v2, delta_v2;
+    double max_mcr_start_v2, mcr_delta_v2;
+    // Temporary storage during lookahead_flush()
+    double start_v2, cruise_v2, next_start_v2;
+    int has_cruise_v2;
+};
+
+struct lookahead {
+    struct lookahead_move *moves;
+    int move_count, move_alloc;
+};
+
+// Allocate a new 'lookahead' object
+struct lookahead * __visible
+lookahead_alloc(void)
+{
+    struct lookahead *la = malloc(sizeof(*la));
+    memset(la, 0, sizeof(*la));
+    return la;
+}
+
+// Free memory associated with a 'lookahead' object
+void __visible
+lookahead_free(struct lookahead *la)
+{
+    free(la->moves);
+    free(la);
+}
+
+// Discard all queued moves
+void __visible
+lookahead_reset(struct lookahead *la)
+{
+    la->move_count = 0;
+}
+
+// Add the junction limits of a new move to the end of the queue
+void __visible
+lookahead_add_move(struct lookahead *la, double max_start_v2
+                   , double max_cruise_v2, double delta_v2
+                   , double max_mcr_start_v2, double mcr_delta_v2)
+{
+    if (la->move_count >= la->move_alloc) {
+        int new_alloc = la->move_alloc ? la->move_alloc * 2 : 64;
+        la->moves = realloc(la->moves, new_alloc * sizeof(*la->moves));
+        la->move_alloc = new_alloc;
+    }
+    struct lookahead_move *m = &la->moves[la->move_count++];
+    m->max_start_v2 = max_start_v2;
+    m->max_cruise_v2 = max_cruise_v2;
+    m->delta_v2 = delta_v2;
+    m->max_mcr_start_v2 = max_mcr_start_v2;
+    m->mcr_delta_v2 = mcr_delta_v2;
+}
+
+// Determine the junction velocities of queued moves (assuming the
+// toolhead comes to a complete stop after the last move).  The number
+// of moves that are ready to be flushed is returned and their
+// velocities are stored in 'res' (which must have space for all queued
+// moves).  The flushed moves are removed from the queue.
+int __visible
+lookahead_flush(struct lookahead *la, int lazy
+                , struct lookahead_junction *res)
+{
+    int update_flush_count = lazy, flush_count = la->move_count;
+    // Traverse queue from last to first move and determine maximum
+    // junction speed assuming the robot comes to a complete stop
+    // after the last move.
+    double next_start_v2 = 0., next_mcr_start_v2 = 0., peak_cruise_v2 = 0.;
+    int pending_cv2_assign = 0, i;
+    for (i = flush_count - 1; i >= 0; i--) {
+        struct lookahead_move *m = &la->moves[i];
+        double reachable_start_v2 = next_start_v2 + m->delta_v2;
+        double start_v2 = PYMIN(m->max_start_v2, reachable_start_v2);
+        m->has_cruise_v2 = 0;
+        pending_cv2_assign++;
+        double reach_mcr_start_v2 = next_mcr_start_v2 + m->mcr_delta_v2;
+        double mcr_start_v2 = PYMIN(m->max_mcr_start_v2, reach_mcr_start_v2);
+        if (mcr_start_v2 < reach_mcr_start_v2) {
+            // It's possible for this move to accelerate
+            if (mcr_start_v2 + m->mcr_delta_v2 > next_mcr_start_v2
+                || pending_cv2_assign > 1) {
+                // This move can both accel and decel, or this is a
+                // full accel move followed by a full decel move
+                if (update_flush_count && peak_cruise_v2) {
+                    flush_count = i + pending_cv2_assign;
+                    update_flush_count = 0;
+                }
+                peak_cruise_v2 = (mcr_start_v2 + reach_mcr_start_v2) * .5;
+            }
+            double cruise_v2 = PYMIN((start_v2 + reachable_start_v2) * .5
+                                     , m->max_cruise_v2);
+            m->cruise_v2 = PYMIN(cruise_v2, peak_cruise_v2);
+            m->has_cruise_v2 = 1;
+            pending_cv2_assign = 0;
+        }
+        m->start_v2 = start_v2;
+        m->next_start_v2 = next_start_v2;
+        next_start_v2 = start_v2;
+        next_mcr_start_v2 = mcr_start_v2;
+    }
+    if (update_flush_count || !flush_count)
+        return 0;
+    // Traverse queue in forward direction to propagate cruise_v2
+    double prev_cruise_v2 = 0.;
+    for (i = 0; i < flush_count; i++) {
+        struct lookahead_move *m = &la->moves[i];
+        double cruise_v2 = m->cruise_v2;
+        if (!m->has_cruise_v2)
+            // This move can't accelerate - propagate cruise_v2 from previous
+            cruise_v2 = PYMIN(prev_cruise_v2, m->start_v2);
+        res[i].start_v2 = PYMIN(m->start_v2, cruise_v2);
+        res[i].cruise_v2 = cruise_v2;
+        res[i].end_v2 = PYMIN(m->next_start_v2, cruise_v2);
+        prev_cruise_v2 = cruise_v2;
+    }
+    // Remove processed moves from the queue
+    la->move_count -= flush_count;
+    memmove(la->moves, &la->moves[flush_count]
+            , la->move_count * sizeof(*la->moves));
+    return flush_count;
+}
@@ -0,0 +1,17 @@
+#ifndef LOOKAHEAD_H
+#define LOOKAHEAD_H
+
+struct lookahead_junction {
+    double start_v2, cruise_v2, end_v2;
+};
+
+struct lookahead *lookahead_alloc(void);
+void lookahead_free(struct lookahead *la);
+void lookahead_reset(struct lookahead *la);
+void lookahead_add_move(struct lookahead *la, double max_start_v2
+                        , double max_cruise_v2, double delta_v2
+                        , double max_mcr_start_v2, double mcr_delta_v2);
+int lookahead_flush(struct lookahead *la, int lazy
+                    , struct lookahead_junction *res);
+
+#endif // lookahead.h
@@ -118,6 +118,29 @@ msgblock_decode(uint32_t *data, int data_len, uint8_t *msg, int msg_len)
     return 0;
 }
 
+// Parse a message with VLQ integers followed by a trailing buffer
+// parameter.  Returns the length of the buffer (or -1 on error).
+int
+msgblock_decode_buffer(uint32_t *data, int data_len, uint8_t **buf
+                       , uint8_t *msg, int msg_len)
+{
+    uint8_t *p = &msg[MESSAGE_HEADER_SIZE];
+    uint8_t *end = &msg[msg_len - MESSAGE_TRAILER_SIZE];
+    while (data_len--) {
+        if (p >= end)
+            return -1;
+        *data++ = parse_int(&p);
+    }
+    if (p >= end)
+        return -1;
+    int buf_len = *p++;
+    if (p + buf_len != end)
+        // Invalid message
+        return -1;
+    *buf = p;
+    return buf_len;
+}
+
 
 /****************************************************************
  * Command queues
@@ -285,6 +285,17 @@ handle_message(struct serialqueue *sq, double eventtime, int len)
         list_add_tail(&qm->node, &received);
     }
 
+    // Check fast readers
+    struct fastreader *fr, *fastreader = NULL;
+    list_for_each_entry(fr, &sq->fast_readers, node) {
+        if (len < fr->prefix_len + MESSAGE_MIN
+            || memcmp(&sq->input_buf[MESSAGE_HEADER_SIZE]
+                      , fr->prefix, fr->prefix_len) != 0)
+            continue;
+        fastreader = fr;
+        break;
+    }
+
     // Process message
     if (len == MESSAGE_MIN) {
         // Ack/nak message
@@ -293,7 +304,7 @@ handle_message(struct serialqueue *sq, double eventtime, int len)
         else if (rseq > sq->ignore_nak_seq && !list_empty(&sq->sent_queue))
             // Duplicate Ack is a Nak - do fast retransmit
             pollreactor_update_timer(sq->pr, SQPT_RETRANSMIT, PR_NOW);
-    } else {
+    } else if (!fastreader || !fastreader->exclusive) {
         // Data message - add to receive queue
         struct queue_message *qm = message_fill(sq->input_buf, len);
         qm->sent_time = (rseq > sq->retransmit_seq
@@ -306,17 +317,11 @@ handle_message(struct serialqueue *sq, double eventtime, int len)
     if (!list_empty(&received))
         receive_append_wake(&sq->receiver, &received);
 
-    // Check fast readers
-    struct fastreader *fr;
-    list_for_each_entry(fr, &sq->fast_readers, node) {
-        if (len < fr->prefix_len + MESSAGE_MIN
-            || memcmp(&sq->input_buf[MESSAGE_HEADER_SIZE]
-                      , fr->prefix, fr->prefix_len) != 0)
-            continue;
+    if (fastreader) {
         // Release main lock and invoke callback
         pthread_mutex_lock(&sq->fast_reader_dispatch_lock);
         pthread_mutex_unlock(&sq->lock);
-        fr->func(fr, sq->input_buf, len);
+        fastreader->func(fastreader, sq->input_buf, len);
         pthread_mutex_unlock(&sq->fast_reader_dispatch_lock);
         return;
     }
@@ -944,43 +949,83 @@ serialqueue_send(struct serialqueue *sq, struct command_queue *cq, uint8_t *msg
     serialqueue_send_one(sq, cq, qm);
 }
 
+// Schedule the transmission of a series of messages (stored back to
+// back in 'msgs' with the length of each message in 'lens')
+void __visible
+serialqueue_send_multi(struct serialqueue *sq, struct command_queue *cq
+                       , uint8_t *msgs, int *lens, int count
+                       , uint64_t min_clock, uint64_t req_clock)
+{
+    struct list_head list;
+    list_init(&list);
+    int i;
+    for (i = 0; i < count; i++) {
+        struct queue_message *qm = message_fill(msgs, lens[i]);
+        qm->min_clock = min_clock;
+        qm->req_clock = req_clock;
+        list_add_tail(&qm->node, &list);
+        msgs += lens[i];
+    }
+    serialqueue_send_batch(sq, cq, &list);
+}
+
 // Return a message read from the serial port (or wait for one if none
 // available)
-void __visible
-serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+// Return up to 'max' received messages (waiting for at least one)
+int __visible
+serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *q
+                       , int max)
 {
     struct receiver *receiver = &sq->receiver;
+    struct list_head freeq;
+    list_init(&freeq);
     pthread_mutex_lock(&receiver->lock);
     // Wait for message to be available
     while (list_empty(&receiver->queue)) {
-        if (pollreactor_is_exit(sq->pr))
-            goto exit;
+        if (pollreactor_is_exit(sq->pr)) {
+            pthread_mutex_unlock(&receiver->lock);
+            return -1;
+        }
         receiver->waiting = 1;
         int ret = pthread_cond_wait(&receiver->cond, &receiver->lock);
         if (ret)
             report_errno("pthread_cond_wait", ret);
     }
 
-    // Remove message from queue
-    struct queue_message *qm = list_first_entry(
-        &receiver->queue, struct queue_message, node);
-    list_del(&qm->node);
-
-    // Copy message
-    memcpy(pqm->msg, qm->msg, qm->len);
-    pqm->len = qm->len;
-    pqm->sent_time = qm->sent_time;
-    pqm->receive_time = qm->receive_time;
-    pqm->notify_id = qm->notify_id;
-    if (qm->len)
-        qm = _debug_queue_add(&receiver->old_receive, qm);
+    // Remove and copy messages from queue
+    int count = 0;
+    while (count < max && !list_empty(&receiver->queue)) {
+        struct queue_message *qm = list_first_entry(
+            &receiver->queue, struct queue_message, node);
+        list_del(&qm->node);
+        struct pull_queue_message *pqm = &q[count++];
+        memcpy(pqm->msg, qm->msg, qm->len);
+        pqm->len = qm->len;
+        pqm->sent_time = qm->sent_time;
+        pqm->receive_time = qm->receive_time;
+        pqm->notify_id = qm->notify_id;
+        if (qm->len)
+            qm = _debug_queue_add(&receiver->old_receive, qm);
+        list_add_tail(&qm->node, &freeq);
+    }
     pthread_mutex_unlock(&receiver->lock);
-    message_free(qm);
-    return;
 
-exit:
-    pqm->len = -1;
-    pthread_mutex_unlock(&receiver->lock);
+    // Free messages (outside of lock)
+    while (!list_empty(&freeq)) {
+        struct queue_message *qm = list_first_entry(
+            &freeq, struct queue_message, node);
+        list_del(&qm->node);
+        message_free(qm);
+    }
+    return count;
+}
+
+// Return the next received message (waiting for one to be available)
+void __visible
+serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+{
+    if (serialqueue_pull_batch(sq, pqm, 1) < 0)
+        pqm->len = -1;
 }
 
 void __visible
@@ -14,6 +14,7 @@ typedef void (*fastreader_cb)(struct fastreader *fr, uint8_t *data, int len);
 struct fastreader {
     struct list_node node;
     fastreader_cb func;
+    int exclusive; // Don't add matching messages to the receive queue
     int prefix_len;
     uint8_t prefix[MESSAGE_MAX];
 };
@@ -42,6 +43,8 @@ void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
                       , uint8_t *msg, int len, uint64_t min_clock
                       , uint64_t req_clock, uint64_t notify_id);
 void serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm);
+int serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *q
+                           , int max);
 void serialqueue_set_wire_frequency(struct serialqueue *sq, double frequency);
 void serialqueue_set_receive_window(struct serialqueue *sq, int receive_window);
 void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
@@ -53,6 +53,8 @@ struct stepcompress {
     // History tracking
     int64_t last_position;
     struct list_head history_list;
+    // Profiling counters
+    uint64_t stat_steps, stat_msgs;
 };
 
 // Parameters of a single queue_step command
@@ -322,6 +324,15 @@ stepcompress_get_step_dir(struct stepcompress *sc)
     return sc->next_step_dir;
 }
 
+// Report the number of steps and queue_step messages generated
+void
+stepcompress_get_counts(struct stepcompress *sc, uint64_t *steps
+                        , uint64_t *msgs)
+{
+    *steps = sc->stat_steps;
+    *msgs = sc->stat_msgs;
+}
+
 // Determine the "print time" of the last_step_clock
 static void
 calc_last_step_print_time(struct stepcompress *sc)
@@ -361,6 +372,8 @@ add_move(struct stepcompress *sc, uint64_t first_clock, struct step_move *move)
         qm->req_clock = first_clock;
     list_add_tail(&qm->node, sc->msg_queue);
     sc->last_step_clock = last_clock;
+    sc->stat_steps += move->count;
+    sc->stat_msgs++;
 
     // Create and store move in history tracking
     struct history_steps *hs = malloc(sizeof(*hs));
@@ -638,3 +651,34 @@ stepcompress_extract_old(struct stepcompress *sc, struct pull_history_steps *p
     }
     return res;
 }
+
+// Export step history in chronological order.  The export stops
+// after a position reset marker (an entry with a zero step_count).
+int __visible
+stepcompress_export(struct stepcompress *sc, struct pull_history_steps *p
+                    , int max, uint64_t start_clock, uint64_t end_clock)
+{
+    // Find oldest history entry in the requested clock range
+    struct history_steps *hs, *first = NULL;
+    list_for_each_entry(hs, &sc->history_list, node) {
+        if (start_clock >= hs->last_clock)
+            break;
+        first = hs;
+    }
+    int res = 0;
+    for (hs = first; hs; hs = list_prev_entry(hs, node)) {
+        if (res >= max || end_clock <= hs->first_clock)
+            break;
+        p->first_clock = hs->first_clock;
+        p->last_clock = hs->last_clock;
+        p->start_position = hs->start_position;
+        p->step_count = hs->step_count;
+        p->interval = hs->interval;
+        p->add = hs->add;
+        p++;
+        res++;
+        if (!hs->step_count || list_is_first(&hs->node, &sc->history_list))
+            break;
+    }
+    return res;
+}
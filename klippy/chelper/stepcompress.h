@@ -22,6 +22,8 @@ void stepcompress_history_expire(struct stepcompress *sc, uint64_t end_clock);
 void stepcompress_free(struct stepcompress *sc);
 uint32_t stepcompress_get_oid(struct stepcompress *sc);
 int stepcompress_get_step_dir(struct stepcompress *sc);
+void stepcompress_get_counts(struct stepcompress *sc, uint64_t *steps
+                             , uint64_t *msgs);
 void stepcompress_set_time(struct stepcompress *sc
                            , double time_offset, double mcu_freq);
 int stepcompress_append(struct stepcompress *sc, int sdir
@@ -36,5 +38,8 @@ int64_t stepcompress_find_past_position(struct stepcompress *sc
 int stepcompress_extract_old(struct stepcompress *sc
                              , struct pull_history_steps *p, int max
                              , uint64_t start_clock, uint64_t end_clock);
+int stepcompress_export(struct stepcompress *sc
+                        , struct pull_history_steps *p, int max
+                        , uint64_t start_clock, uint64_t end_clock);
 
 #endif // stepcompress.h
@@ -44,6 +44,9 @@ struct syncemitter {
     double bg_gen_steps_time;
     uint64_t bg_flush_clock, bg_clear_history_clock;
     int32_t bg_result;
+    // Profiling (only updated by background thread)
+    double stat_gen_time, stat_flush_time;
+    uint64_t stat_gen_count;
 };
 
 // Return this emitters 'struct stepcompress' (or NULL if not allocated)
@@ -78,6 +81,20 @@ syncemitter_queue_msg(struct syncemitter *se, uint64_t req_clock
     list_add_tail(&qm->node, &se->msg_queue);
 }
 
+// Report step generation profiling counters.  The caller must not
+// call this while a step generation request is in progress.
+void __visible
+syncemitter_get_stats(struct syncemitter *se, struct syncemitter_stats *stats)
+{
+    memset(stats, 0, sizeof(*stats));
+    if (!se->sc)
+        return;
+    stats->gen_time = se->stat_gen_time;
+    stats->flush_time = se->stat_flush_time;
+    stats->gen_count = se->stat_gen_count;
+    stepcompress_get_counts(se->sc, &stats->step_count, &stats->msg_count);
+}
+
 // Generate steps (via itersolve) and flush
 static int32_t
 se_generate_steps(struct syncemitter *se)
@@ -88,11 +105,16 @@ se_generate_steps(struct syncemitter *se)
     uint64_t flush_clock = se->bg_flush_clock;
     uint64_t clear_history_clock = se->bg_clear_history_clock;
     // Generate steps
+    double start_time = get_monotonic();
     int32_t ret = itersolve_generate_steps(se->sk, se->sc, gen_steps_time);
+    double gen_end_time = get_monotonic();
+    se->stat_gen_time += gen_end_time - start_time;
+    se->stat_gen_count++;
     if (ret)
         return ret;
     // Flush steps
     ret = stepcompress_flush(se->sc, flush_clock);
+    se->stat_flush_time += get_monotonic() - gen_end_time;
     if (ret)
         return ret;
     // Clear history
@@ -346,6 +368,9 @@ steppersync_flush(struct steppersync *ss, uint64_t move_clock)
 
 struct steppersyncmgr {
     struct list_head ss_list;
+    // Pending step generation request (see steppersyncmgr_start_gen_steps)
+    int have_pending;
+    double pending_flush_time;
 };
 
 // Allocate a new 'steppersyncmgr' object
@@ -392,10 +417,13 @@ steppersyncmgr_alloc_steppersync(struct steppersyncmgr *ssm)
     return ss;
 }
 
-// Generate and flush steps
-int32_t __visible
-steppersyncmgr_gen_steps(struct steppersyncmgr *ssm, double flush_time
-                         , double gen_steps_time, double clear_history_time)
+// Start generating steps in the background threads.  The caller must
+// not modify the trapqs, stepper_kinematics, or stepcompress objects
+// until steppersyncmgr_finalize_gen_steps() is called.
+void __visible
+steppersyncmgr_start_gen_steps(struct steppersyncmgr *ssm, double flush_time
+                               , double gen_steps_time
+                               , double clear_history_time)
 {
     struct steppersync *ss;
     // Prepare trapqs for step generation
@@ -418,8 +446,21 @@ steppersyncmgr_gen_steps(struct steppersyncmgr *ssm, double flush_time
             se_start_gen_steps(se, gen_steps_time, flush_clock, clear_clock);
         }
     }
+    ssm->have_pending = 1;
+    ssm->pending_flush_time = flush_time;
+}
+
+// Wait for pending step generation to complete and transmit steps
+int32_t __visible
+steppersyncmgr_finalize_gen_steps(struct steppersyncmgr *ssm)
+{
+    if (!ssm->have_pending)
+        return 0;
+    ssm->have_pending = 0;
+    double flush_time = ssm->pending_flush_time;
     // Wait for step generation threads to complete
     int32_t res = 0;
+    struct steppersync *ss;
     list_for_each_entry(ss, &ssm->ss_list, ssm_node) {
         struct syncemitter *se;
         list_for_each_entry(se, &ss->se_list, ss_node) {
@@ -434,3 +475,15 @@ steppersyncmgr_gen_steps(struct steppersyncmgr *ssm, double flush_time
     }
     return res;
 }
+
+// Generate and flush steps
+int32_t __visible
+steppersyncmgr_gen_steps(struct steppersyncmgr *ssm, double flush_time
+                         , double gen_steps_time, double clear_history_time)
+{
+    int32_t res = steppersyncmgr_finalize_gen_steps(ssm);
+    steppersyncmgr_start_gen_steps(ssm, flush_time, gen_steps_time
+                                   , clear_history_time);
+    int32_t ret = steppersyncmgr_finalize_gen_steps(ssm);
+    return res ? res : ret;
+}
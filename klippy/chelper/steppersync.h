@@ -3,6 +3,11 @@
 
 #include <stdint.h> // uint64_t
 
+struct syncemitter_stats {
+    double gen_time, flush_time;
+    uint64_t gen_count, step_count, msg_count;
+};
+
 struct syncemitter;
 struct stepcompress *syncemitter_get_stepcompress(struct syncemitter *se);
 void syncemitter_set_stepper_kinematics(struct syncemitter *se
@@ -11,6 +16,8 @@ struct stepper_kinematics *syncemitter_get_stepper_kinematics(
     struct syncemitter *se);
 void syncemitter_queue_msg(struct syncemitter *se, uint64_t req_clock
                            , uint32_t *data, int len);
+void syncemitter_get_stats(struct syncemitter *se
+                           , struct syncemitter_stats *stats);
 
 struct steppersync;
 struct syncemitter *steppersync_alloc_syncemitter(
@@ -25,6 +32,10 @@ void steppersyncmgr_free(struct steppersyncmgr *ssm);
 struct serialqueue;
 struct steppersync *steppersyncmgr_alloc_steppersync(
     struct steppersyncmgr *ssm);
+void steppersyncmgr_start_gen_steps(struct steppersyncmgr *ssm
+                                    , double flush_time, double gen_steps_time
+                                    , double clear_history_time);
+int32_t steppersyncmgr_finalize_gen_steps(struct steppersyncmgr *ssm);
 int32_t steppersyncmgr_gen_steps(struct steppersyncmgr *ssm, double flush_time
                                  , double gen_steps_time
                                  , double clear_history_time);
@@ -271,3 +271,39 @@ trapq_extract_old(struct trapq *tq, struct pull_move *p, int max
     }
     return res;
 }
+
+// Export history of movement queue in chronological order
+int __visible
+trapq_export(struct trapq *tq, struct pull_move *p, int max
+             , double start_time, double end_time)
+{
+    // Find oldest history entry in the requested time range
+    struct move *m, *first = NULL;
+    list_for_each_entry(m, &tq->history, node) {
+        if (start_time >= m->print_time + m->move_t)
+            break;
+        first = m;
+    }
+    int res = 0;
+    for (m = first; m; m = list_prev_entry(m, node)) {
+        if (res >= max || end_time <= m->print_time)
+            return res;
+        copy_pull_move(p, m);
+        p++;
+        res++;
+        if (list_is_first(&m->node, &tq->history))
+            break;
+    }
+    // Export pending moves
+    list_for_each_entry(m, &tq->moves, node) {
+        if (res >= max || end_time <= m->print_time)
+            break;
+        if (start_time >= m->print_time + m->move_t
+            || (!m->start_v && !m->half_accel))
+            continue;
+        copy_pull_move(p, m);
+        p++;
+        res++;
+    }
+    return res;
+}
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2024  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, os, glob, re, time, logging, configparser, io
+import sys, os, glob, re, time, logging, configparser, io, hashlib
 
 error = configparser.Error
 
@@ -138,7 +138,15 @@ class ConfigWrapper:
 # Config file parsing (with include file support)
 ######################################################################
 
+def _digest(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
 class ConfigFileReader:
+    def __init__(self):
+        # List of files and include globs used to build the config
+        self.inputs = []
     def read_config_file(self, filename):
         try:
             f = open(filename, 'r')
@@ -148,7 +156,9 @@ class ConfigFileReader:
             msg = "Unable to open config file %s" % (filename,)
             logging.exception(msg)
             raise error(msg)
-        return data.replace('\r\n', '\n')
+        data = data.replace('\r\n', '\n')
+        self.inputs.append(('file', os.path.abspath(filename), _digest(data)))
+        return data
     def build_config_string(self, fileconfig):
         sfile = io.StringIO()
         fileconfig.write(sfile)
@@ -188,6 +198,7 @@ class ConfigFileReader:
             # Empty set is OK if wildcard but not for direct file reference
             raise error("Include file '%s' does not exist" % (include_glob,))
         include_filenames.sort()
+        self.inputs.append(('glob', include_glob, include_filenames))
         for include_filename in include_filenames:
             include_data = self.read_config_file(include_filename)
             self._parse_config(include_data, include_filename, fileconfig,
@@ -224,6 +235,34 @@ class ConfigFileReader:
         fileconfig = self._create_fileconfig()
         self._parse_config(data, filename, fileconfig, set())
         return fileconfig
+    # Support for caching parsed config files
+    def check_inputs(self, inputs):
+        for itype, name, value in inputs:
+            if itype == 'glob':
+                if sorted(glob.glob(name)) != value:
+                    return False
+                continue
+            try:
+                f = open(name, 'r')
+                data = f.read()
+                f.close()
+            except:
+                return False
+            if _digest(data.replace('\r\n', '\n')) != value:
+                return False
+        return True
+    def snapshot_fileconfig(self, fileconfig):
+        if fileconfig.defaults():
+            return None
+        return [(section, fileconfig.items(section))
+                for section in fileconfig.sections()]
+    def restore_fileconfig(self, snapshot):
+        fileconfig = self._create_fileconfig()
+        for section, items in snapshot:
+            fileconfig.add_section(section)
+            for option, value in items:
+                fileconfig.set(section, option, value)
+        return fileconfig
 
 
 ######################################################################
@@ -236,6 +275,9 @@ AUTOSAVE_HEADER = """
 #*#
 """
 
+# Parsed main config files from previous startups (keyed by filename)
+config_cache = {}
+
 class ConfigAutoSave:
     def __init__(self, printer):
         self.printer = printer
@@ -292,8 +334,23 @@ class ConfigAutoSave:
                 is_dup_field = True
                 lines[lineno] = '#' + lines[lineno]
         return "\n".join(lines)
+    def _load_cached_config(self, filename):
+        cached = config_cache.get(filename)
+        if cached is None:
+            return None
+        inputs, regular_snapshot, autosave_snapshot = cached
+        cfgrdr = ConfigFileReader()
+        if not cfgrdr.check_inputs(inputs):
+            return None
+        self.fileconfig = cfgrdr.restore_fileconfig(autosave_snapshot)
+        return cfgrdr.restore_fileconfig(regular_snapshot), self.fileconfig
     def load_main_config(self):
         filename = self.printer.get_start_args()['config_file']
+        # Reuse the parsed config if none of its input files have changed
+        res = self._load_cached_config(filename)
+        if res is not None:
+            logging.info("Config files unchanged - using cached config")
+            return res
         cfgrdr = ConfigFileReader()
         data = cfgrdr.read_config_file(filename)
         regular_data, autosave_data = self._find_autosave_data(data)
@@ -304,6 +361,13 @@ class ConfigAutoSave:
         self.fileconfig = cfgrdr.build_fileconfig(autosave_data, filename)
         cfgrdr.append_fileconfig(regular_fileconfig,
                                  autosave_data, '*AUTOSAVE*')
+        regular_snapshot = cfgrdr.snapshot_fileconfig(regular_fileconfig)
+        autosave_snapshot = cfgrdr.snapshot_fileconfig(self.fileconfig)
+        if regular_snapshot is None or autosave_snapshot is None:
+            config_cache.pop(filename, None)
+        else:
+            config_cache[filename] = (cfgrdr.inputs, regular_snapshot,
+                                      autosave_snapshot)
         return regular_fileconfig, self.fileconfig
     def get_status(self, eventtime):
         return {'save_config_pending': self.save_config_pending,
@@ -464,6 +528,7 @@ class PrinterConfig:
         self.deprecated = {}
         self.status_raw_config = {}
         self.status_warnings = []
+        self.status_generation = 0
     def get_printer(self):
         return self.printer
     def read_config(self, filename):
@@ -487,6 +552,7 @@ class PrinterConfig:
         self.printer.set_rollover_info("config", "\n".join(lines))
     def check_unused_options(self, config):
         self.validate.check_unused(config.fileconfig)
+        self.status_generation += 1
     # Deprecation warnings
     def _add_deprecated(self, data):
         key = tuple(list(data.items()))
@@ -494,6 +560,7 @@ class PrinterConfig:
             return False
         self.deprecated[key] = True
         self.status_warnings = self.status_warnings + [data]
+        self.status_generation += 1
         return True
     def runtime_warning(self, msg):
         res = {'type': 'runtime_warning', 'message': msg}
@@ -542,6 +609,7 @@ class PrinterConfig:
         self._add_deprecated(res)
     # Status reporting
     def _build_status_config(self, config):
+        self.status_generation += 1
         self.status_raw_config = {}
         for section in config.get_prefix_sections(''):
             self.status_raw_config[section.get_name()] = section_status = {}
@@ -553,8 +621,12 @@ class PrinterConfig:
         status.update(self.autosave.get_status(eventtime))
         status.update(self.validate.get_status(eventtime))
         return status
+    def get_status_generation(self, eventtime):
+        return self.status_generation
     # Autosave functions
     def set(self, section, option, value):
         self.autosave.set(section, option, value)
+        self.status_generation += 1
     def remove_section(self, section):
         self.autosave.remove_section(section)
+        self.status_generation += 1
@@ -135,11 +135,10 @@ class ADS1220:
     # Measurement decoding
     def _convert_samples(self, samples):
         adc_factor = 1. / (1 << 23)
-        count = 0
-        for ptime, val in samples:
-            samples[count] = (round(ptime, 6), val, round(val * adc_factor, 9))
-            count += 1
-        del samples[count:]
+        vals = samples.columns[0]
+        return bulk_sensor.SampleBatch(
+            bulk_sensor.scale_column(samples.times, 1.),
+            [vals, bulk_sensor.scale_column(vals, adc_factor, 9)])
 
     # Start, stop, and process message batches
     def _start_measurements(self):
@@ -164,8 +163,7 @@ class ADS1220:
         logging.info("ADS1220 finished '%s' measurements", self.name)
 
     def _process_batch(self, eventtime):
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
+        samples = self._convert_samples(self.ffreader.pull_samples())
         return {'data': samples, 'errors': self.last_error_count,
                 'overflows': self.ffreader.get_last_overflows()}
 
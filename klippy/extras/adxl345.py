@@ -3,7 +3,7 @@
 # Copyright (C) 2020-2023  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, time, collections, multiprocessing, os
+import logging, time, collections, os, bisect
 from . import bus, bulk_sensor
 
 # ADXL345 registers
@@ -72,18 +72,12 @@ class AccelQueryHelper:
     def get_samples(self):
         if not self.msgs:
             return self.samples
-        total = sum([len(m['data']) for m in self.msgs])
-        count = 0
-        self.samples = samples = [None] * total
+        self.samples = samples = []
         for msg in self.msgs:
-            for samp_time, x, y, z in msg['data']:
-                if samp_time < self.request_start_time:
-                    continue
-                if samp_time > self.request_end_time:
-                    break
-                samples[count] = Accel_Measurement(samp_time, x, y, z)
-                count += 1
-        del samples[count:]
+            data = msg['data']
+            start = bisect.bisect_left(data.times, self.request_start_time)
+            end = bisect.bisect_right(data.times, self.request_end_time)
+            samples.extend([Accel_Measurement(*s) for s in data[start:end]])
         return self.samples
     def write_to_file(self, filename):
         def write_impl():
@@ -99,6 +93,7 @@ class AccelQueryHelper:
                 f.write("%.6f,%.6f,%.6f,%.6f\n" % (
                     t, accel_x, accel_y, accel_z))
             f.close()
+        import multiprocessing
         write_proc = multiprocessing.Process(target=write_impl)
         write_proc.daemon = True
         write_proc.start()
@@ -243,22 +238,26 @@ class ADXL345:
     # Measurement decoding
     def _convert_samples(self, samples):
         (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
-        count = 0
-        for ptime, xlow, ylow, zlow, xzhigh, yzhigh in samples:
-            if yzhigh & 0x80:
-                self.last_error_count += 1
-                continue
-            rx = (xlow | ((xzhigh & 0x1f) << 8)) - ((xzhigh & 0x10) << 9)
-            ry = (ylow | ((yzhigh & 0x1f) << 8)) - ((yzhigh & 0x10) << 9)
-            rz = ((zlow | ((xzhigh & 0xe0) << 3) | ((yzhigh & 0xe0) << 6))
-                  - ((yzhigh & 0x40) << 7))
-            raw_xyz = (rx, ry, rz)
-            x = round(raw_xyz[x_pos] * x_scale, 6)
-            y = round(raw_xyz[y_pos] * y_scale, 6)
-            z = round(raw_xyz[z_pos] * z_scale, 6)
-            samples[count] = (round(ptime, 6), x, y, z)
-            count += 1
-        del samples[count:]
+        errors = [i for i, yzh in enumerate(samples.columns[4]) if yzh & 0x80]
+        if errors:
+            self.last_error_count += len(errors)
+            errors = set(errors)
+            samples = samples.select([i for i in range(len(samples))
+                                      if i not in errors])
+        xlow, ylow, zlow, xzhigh, yzhigh = samples.columns
+        rx = [(xl | ((xzh & 0x1f) << 8)) - ((xzh & 0x10) << 9)
+              for xl, xzh in zip(xlow, xzhigh)]
+        ry = [(yl | ((yzh & 0x1f) << 8)) - ((yzh & 0x10) << 9)
+              for yl, yzh in zip(ylow, yzhigh)]
+        rz = [((zl | ((xzh & 0xe0) << 3) | ((yzh & 0xe0) << 6))
+               - ((yzh & 0x40) << 7))
+              for zl, xzh, yzh in zip(zlow, xzhigh, yzhigh)]
+        raw_xyz = (rx, ry, rz)
+        return bulk_sensor.SampleBatch(
+            bulk_sensor.scale_column(samples.times, 1.),
+            [bulk_sensor.scale_column(raw_xyz[x_pos], x_scale),
+             bulk_sensor.scale_column(raw_xyz[y_pos], y_scale),
+             bulk_sensor.scale_column(raw_xyz[z_pos], z_scale)])
     # Start, stop, and process message batches
     def _start_measurements(self):
         # In case of miswiring, testing ADXL345 device ID prevents treating
@@ -291,8 +290,7 @@ class ADXL345:
         self.ffreader.note_end()
         logging.info("ADXL345 finished '%s' measurements", self.name)
     def _process_batch(self, eventtime):
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
+        samples = self._convert_samples(self.ffreader.pull_samples())
         if not samples:
             return {}
         return {'data': samples, 'errors': self.last_error_count,
@@ -3,7 +3,8 @@
 # Copyright (C) 2021,2022  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, math
+import logging, math, array
+import util
 from . import bus, bulk_sensor
 
 MIN_MSG_TIME = 0.100
@@ -15,6 +16,8 @@ TRINAMIC_DRIVERS = ["tmc2130", "tmc2208", "tmc2209", "tmc2240", "tmc2660",
 CALIBRATION_BITS = 6 # 64 entries
 ANGLE_BITS = 16 # angles range from 0..65535
 
+numpy = util.LazyModule('numpy', "Angle calibration requires numpy module")
+
 class AngleCalibration:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -23,10 +26,7 @@ class AngleCalibration:
         if self.stepper_name is None:
             # No calibration
             return
-        try:
-            import numpy
-        except:
-            raise config.error("Angle calibration requires numpy module")
+        numpy.check(config.error, self.printer.command_error)
         sconfig = config.getsection(self.stepper_name)
         sconfig.getint('microsteps', note_valid=False)
         self.tmc_module = self.mcu_stepper = None
@@ -79,7 +79,8 @@ class AngleCalibration:
         interp_bits = ANGLE_BITS - CALIBRATION_BITS
         interp_mask = (1 << interp_bits) - 1
         interp_round = 1 << (interp_bits - 1)
-        for i, (samp_time, angle) in enumerate(samples):
+        angles = samples.columns[0]
+        for i, angle in enumerate(angles):
             bucket = (angle & 0xffff) >> interp_bits
             cal1 = calibration[bucket]
             cal2 = calibration[bucket + 1]
@@ -90,7 +91,7 @@ class AngleCalibration:
             new_angle = angle + angle_diff
             if calibration_reversed:
                 new_angle = -new_angle
-            samples[i] = (samp_time, new_angle)
+            angles[i] = new_angle
         if self.mcu_pos_offset is None:
             self.calc_mcu_pos_offset(samples[0])
             if self.mcu_pos_offset is None:
@@ -110,7 +111,6 @@ class AngleCalibration:
             angles = list(reversed(angles))
         first_step = angles.index(min(angles))
         angles = angles[first_step:] + angles[:first_step]
-        import numpy
         eqs = numpy.zeros((full_steps, calibration_count))
         ans = numpy.zeros((full_steps,))
         for step, angle in enumerate(angles):
@@ -679,8 +679,9 @@ class Angle:
             time_shift = self.time_shift
             static_delay = self.sensor_helper.get_static_delay()
         # Process every message in raw_samples
-        count = error_count = 0
-        samples = [None] * (len(raw_samples) * SAMPLES_PER_BLOCK)
+        error_count = 0
+        samples = bulk_sensor.SampleBatch(array.array('d'), [[]])
+        add_time, add_angle = samples.times.append, samples.columns[0].append
         for params in raw_samples:
             seq_diff = (params['sequence'] - last_sequence) & 0xffff
             last_sequence += seq_diff
@@ -708,12 +709,10 @@ class Angle:
                 else:
                     # tcode is mcu clock offset shifted by time_shift
                     sclock = mclock + (tcode<<time_shift)
-                ptime = round(clock_to_print_time(sclock) - static_delay, 6)
-                samples[count] = (ptime, last_angle)
-                count += 1
+                add_time(round(clock_to_print_time(sclock) - static_delay, 6))
+                add_angle(last_angle)
         self.last_sequence = last_sequence
         self.last_angle = last_angle
-        del samples[count:]
         return samples, error_count
     # Start, stop, and process message batches
     def _is_measuring(self):
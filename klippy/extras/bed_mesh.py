@@ -130,6 +130,7 @@ class BedMesh:
         gcode_move = self.printer.load_object(config, 'gcode_move')
         gcode_move.set_move_transform(self)
         # initialize status dict
+        self.status_generation = 0
         self.update_status()
     def handle_connect(self):
         self.toolhead = self.printer.lookup_object('toolhead')
@@ -228,7 +229,10 @@ class BedMesh:
         self.last_position[:] = newpos
     def get_status(self, eventtime=None):
         return self.status
+    def get_status_generation(self, eventtime):
+        return self.status_generation
     def update_status(self):
+        self.status_generation += 1
         self.status = {
             "profile_name": "",
             "mesh_min": (0., 0.),
@@ -120,15 +120,12 @@ class BMI160:
         return aqh
     def _convert_samples(self, samples):
         (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
-        count = 0
-        for ptime, rx, ry, rz in samples:
-            raw_xyz = (rx, ry, rz)
-            x = round(raw_xyz[x_pos] * x_scale, 6)
-            y = round(raw_xyz[y_pos] * y_scale, 6)
-            z = round(raw_xyz[z_pos] * z_scale, 6)
-            samples[count] = (round(ptime, 6), x, y, z)
-            count += 1
-        del samples[count:]
+        raw_xyz = samples.columns
+        return bulk_sensor.SampleBatch(
+            bulk_sensor.scale_column(samples.times, 1.),
+            [bulk_sensor.scale_column(raw_xyz[x_pos], x_scale),
+             bulk_sensor.scale_column(raw_xyz[y_pos], y_scale),
+             bulk_sensor.scale_column(raw_xyz[z_pos], z_scale)])
     def _start_measurements(self):
         # 1. Force SPI Mode (Dummy Read)
         if self.bus_type == 'spi':
@@ -174,8 +171,7 @@ class BMI160:
         self.ffreader.note_end()
         logging.info("BMI160 finished '%s' measurements", self.name)
     def _process_batch(self, eventtime):
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
+        samples = self._convert_samples(self.ffreader.pull_samples())
         if not samples:
             return {}
         return {'data': samples, 'errors': self.last_error_count,
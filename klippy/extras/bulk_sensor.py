@@ -3,7 +3,8 @@
 # Copyright (C) 2020-2023  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading, struct
+import logging, threading, struct, itertools, array, sys
+import chelper
 
 # This "bulk sensor" module facilitates the processing of sensor chip
 # measurements that do not require the host to respond with low
@@ -22,7 +23,7 @@ BATCH_INTERVAL = 0.500
 # Helper to process accumulated messages in periodic batches
 class BatchBulkHelper:
     def __init__(self, printer, batch_cb, start_cb=None, stop_cb=None,
-                 batch_interval=BATCH_INTERVAL):
+                 batch_interval=BATCH_INTERVAL, webhooks_start_resp=None):
         self.printer = printer
         self.batch_cb = batch_cb
         if start_cb is None:
@@ -35,7 +36,9 @@ class BatchBulkHelper:
         self.batch_interval = batch_interval
         self.batch_timer = None
         self.client_cbs = []
-        self.webhooks_start_resp = {}
+        if webhooks_start_resp is None:
+            webhooks_start_resp = {}
+        self.webhooks_start_resp = webhooks_start_resp
     # Periodic batch processing
     def _start(self):
         if self.is_started:
@@ -90,48 +93,202 @@ class BatchBulkHelper:
         self.client_cbs.append(client_cb)
         self._start()
     # Webhooks registration
-    def _add_api_client(self, web_request):
+    def add_api_client(self, web_request):
         whbatch = BatchWebhooksClient(web_request)
         self.add_client(whbatch.handle_batch)
         web_request.send(self.webhooks_start_resp)
     def add_mux_endpoint(self, path, key, value, webhooks_start_resp):
         self.webhooks_start_resp = webhooks_start_resp
         wh = self.printer.lookup_object('webhooks')
-        wh.register_mux_endpoint(path, key, value, self._add_api_client)
+        wh.register_mux_endpoint(path, key, value, self.add_api_client)
+    def add_endpoint(self, path, webhooks_start_resp):
+        self.webhooks_start_resp = webhooks_start_resp
+        wh = self.printer.lookup_object('webhooks')
+        wh.register_endpoint(path, self.add_api_client)
+
+# Storage for a batch of sensor measurements.  The sample times and
+# each measurement channel are stored in separate columns (typically
+# array.array objects) so that batches may be processed, stored, and
+# exported without creating a Python object per measurement.  For
+# compatibility, a batch may also be accessed as a sequence of
+# (time, value1, value2, ...) tuples.
+class SampleBatch:
+    def __init__(self, times, columns):
+        self.times = times
+        self.columns = columns
+    def __len__(self):
+        return len(self.times)
+    def __iter__(self):
+        return iter(zip(self.times, *self.columns))
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return SampleBatch(self.times[index],
+                               [c[index] for c in self.columns])
+        return (self.times[index],) + tuple([c[index] for c in self.columns])
+    def select(self, indexes):
+        return SampleBatch(array.array('d', [self.times[i] for i in indexes]),
+                           [[c[i] for i in indexes] for c in self.columns])
+    def get_rows(self):
+        return list(zip(self.times, *self.columns))
+    # Return the samples as packed little-endian doubles (row major)
+    def pack(self):
+        cols = [self.times] + list(self.columns)
+        num_cols = len(cols)
+        out = array.array('d', [0.]) * (num_cols * len(self.times))
+        for i, col in enumerate(cols):
+            if type(col) != array.array or col.typecode != 'd':
+                col = array.array('d', col)
+            out[i::num_cols] = col
+        if sys.byteorder != 'little':
+            out.byteswap()
+        return out.tobytes(), num_cols
+
+# Return an array of values multiplied by 'scale' and rounded
+def scale_column(values, scale, ndigits=6):
+    return array.array('d', [round(v * scale, ndigits) for v in values])
+
+# Convert a batch of numeric samples to a packed array of doubles
+def pack_batch_data(msg):
+    data = msg.get('data')
+    if isinstance(data, SampleBatch):
+        msg = dict(msg)
+        if not data:
+            msg['data'] = []
+            return msg
+        try:
+            msg['data'], msg['data_columns'] = data.pack()
+        except TypeError:
+            # Batch contains non-numeric values (eg, None)
+            msg['data'] = data.get_rows()
+        return msg
+    if type(data) != list or not data:
+        return msg
+    try:
+        columns = len(data[0])
+        values = list(itertools.chain.from_iterable(data))
+        if len(values) != columns * len(data):
+            return msg
+        packed = struct.pack('<%dd' % (len(values),), *values)
+    except (TypeError, struct.error):
+        return msg
+    msg = dict(msg)
+    msg['data'] = packed
+    msg['data_columns'] = columns
+    return msg
 
 # A webhooks wrapper for use by BatchBulkHelper
 class BatchWebhooksClient:
     def __init__(self, web_request):
         self.cconn = web_request.get_client_connection()
         self.template = web_request.get_dict('response_template', {})
+        self.dropped_batches = 0
     def handle_batch(self, msg):
         if self.cconn.is_closed():
             return False
+        if self.cconn.check_bulk_backlog():
+            # Client is not keeping up - skip this batch
+            self.dropped_batches += 1
+            return True
+        if self.dropped_batches:
+            msg = dict(msg)
+            msg['dropped_batches'] = self.dropped_batches
+            self.dropped_batches = 0
+        if self.cconn.get_encoding() != "json":
+            # Binary connections receive sample data as a packed array
+            msg = pack_batch_data(msg)
+        elif isinstance(msg.get('data'), SampleBatch):
+            msg = dict(msg)
+            msg['data'] = msg['data'].get_rows()
         tmp = dict(self.template)
         tmp['params'] = msg
         self.cconn.send(tmp)
         return True
 
 SENSOR_BULK_FMT = "sensor_bulk_data oid=%c sequence=%hu data=%*s"
+BULK_QUEUE_SIZE = 4096
+PULL_COUNT = 256
 
 # Helper class to store incoming messages in a queue
 class BulkDataQueue:
     def __init__(self, mcu, msg_fmt=SENSOR_BULK_FMT, oid=None):
+        self.bulkqueue = None
+        if msg_fmt == SENSOR_BULK_FMT and oid is not None:
+            # Messages are stored in a C ring buffer by the serialqueue thread
+            self.ffi_main, self.ffi_lib = chelper.get_ffi()
+            bqw = mcu.alloc_bulk_queue(msg_fmt, oid, BULK_QUEUE_SIZE)
+            self.bulkqueue = bqw.get_bulkqueue()
+            self.pull_msgs = self.ffi_main.new('struct pull_bulk_message[%d]'
+                                               % (PULL_COUNT,))
+            self.pull_times = self.pull_data = None
+            return
         # Measurement storage (accessed from background thread)
         self.lock = threading.Lock()
         self.raw_samples = []
-        # Register callback with mcu
-        mcu.register_serial_response(self._handle_data, msg_fmt, oid)
+        # Register callback with mcu (messages with an oid are stored
+        # unparsed and only decoded when pulled from the queue)
+        self.is_raw = oid is not None
+        self.resp = mcu.register_serial_response(self._handle_data, msg_fmt,
+                                                 oid, is_raw=self.is_raw)
     def _handle_data(self, params):
         with self.lock:
             self.raw_samples.append(params)
+    def _pull_ring(self):
+        ffi_buffer = self.ffi_main.buffer
+        pull_msgs = self.pull_msgs
+        raw_samples = []
+        while 1:
+            count = self.ffi_lib.bulkqueue_pull(self.bulkqueue, pull_msgs,
+                                                PULL_COUNT)
+            raw_samples.extend([
+                {'sequence': m.sequence,
+                 'data': bytes(ffi_buffer(m.data, m.len))}
+                for m in pull_msgs[0:count]])
+            if count < PULL_COUNT:
+                return raw_samples
     def pull_queue(self):
+        if self.bulkqueue is not None:
+            return self._pull_ring()
         with self.lock:
             raw_samples = self.raw_samples
             self.raw_samples = []
-        return raw_samples
+        if not self.is_raw or not raw_samples:
+            return raw_samples
+        parse_raw = self.resp.parse_raw
+        return [parse_raw(msg) for msg in raw_samples]
+    # Extract fixed size samples (only available for sensor_bulk_data
+    # queues).  Returns an array of sample times, the raw sample data,
+    # and the chip clock of the last sample.
+    def pull_samples(self, bytes_per_sample, samples_per_block, last_sequence,
+                     time_base, chip_base, inv_freq):
+        max_samples = PULL_COUNT * samples_per_block
+        if self.pull_times is None:
+            self.pull_times = self.ffi_main.new('double[%d]' % (max_samples,))
+            self.pull_data = self.ffi_main.new(
+                'uint8_t[%d]' % (max_samples * bytes_per_sample,))
+            self.pull_clock = self.ffi_main.new('int64_t *')
+        ffi_buffer = self.ffi_main.buffer
+        times = array.array('d')
+        data = bytearray()
+        while 1:
+            count = self.ffi_lib.bulkqueue_pull_samples(
+                self.bulkqueue, bytes_per_sample, samples_per_block,
+                last_sequence, time_base, chip_base, inv_freq,
+                self.pull_times, self.pull_data, max_samples, self.pull_clock)
+            times.extend(array.array(
+                'd', ffi_buffer(self.pull_times, count * times.itemsize)[:]))
+            data.extend(ffi_buffer(self.pull_data, count * bytes_per_sample))
+            if count + samples_per_block <= max_samples:
+                return times, data, self.pull_clock[0]
+    def get_dropped(self):
+        if self.bulkqueue is None:
+            return 0
+        return self.ffi_lib.bulkqueue_get_dropped(self.bulkqueue)
     def clear_queue(self):
-        self.pull_queue()
+        if self.bulkqueue is not None:
+            self.ffi_lib.bulkqueue_clear(self.bulkqueue)
+            return
+        with self.lock:
+            self.raw_samples = []
 
 
 ######################################################################
@@ -209,11 +366,16 @@ class FixedFreqReader:
         self.mcu = mcu
         self.clock_sync = ClockSyncRegression(mcu, chip_clock_smooth)
         unpack = struct.Struct(unpack_fmt)
-        self.unpack_from = unpack.unpack_from
         self.bytes_per_sample = unpack.size
+        # Format for decoding many samples with a single struct call
+        self.unpack_columns = len(unpack.unpack(b'\x00' * unpack.size))
+        self.unpack_order, self.unpack_fields = '', unpack_fmt
+        if unpack_fmt[:1] in '@=<>!':
+            self.unpack_order = unpack_fmt[:1]
+            self.unpack_fields = unpack_fmt[1:]
         self.samples_per_block = MAX_BULK_MSG_SIZE // self.bytes_per_sample
         self.last_sequence = self.max_query_duration = 0
-        self.last_overflows = 0
+        self.last_overflows = self.start_dropped = 0
         self.bulk_queue = self.oid = self.query_status_cmd = None
     def setup_query_command(self, msgformat, oid, cq):
         # Lookup sensor query command (that responds with sensor_bulk_status)
@@ -225,12 +387,14 @@ class FixedFreqReader:
         # Read sensor_bulk_data messages and store in a queue
         self.bulk_queue = BulkDataQueue(self.mcu, oid=oid)
     def get_last_overflows(self):
-        return self.last_overflows
+        dropped = self.bulk_queue.get_dropped() - self.start_dropped
+        return self.last_overflows + dropped
     def _clear_duration_filter(self):
         self.max_query_duration = 1 << 31
     def note_start(self):
         self.last_sequence = 0
         self.last_overflows = 0
+        self.start_dropped = self.bulk_queue.get_dropped()
         # Clear local queue (clear any stale samples from previous session)
         self.bulk_queue.clear_queue()
         # Set initial clock
@@ -266,34 +430,22 @@ class FixedFreqReader:
             self.clock_sync.reset(avg_mcu_clock, chip_clock)
         else:
             self.clock_sync.update(avg_mcu_clock, chip_clock)
-    # Convert sensor_bulk_data responses into list of samples
+    # Convert sensor_bulk_data responses into a SampleBatch containing
+    # one column per field of 'unpack_fmt'
     def pull_samples(self):
         # Query MCU for sample timing and update clock synchronization
         self._update_clock()
-        # Pull sensor_bulk_data messages from local queue
-        raw_samples = self.bulk_queue.pull_queue()
-        if not raw_samples:
-            return []
-        # Load variables to optimize inner loop below
-        last_sequence = self.last_sequence
+        # Pull samples (and their timestamps) from local queue
         time_base, chip_base, inv_freq = self.clock_sync.get_time_translation()
-        unpack_from = self.unpack_from
-        bytes_per_sample = self.bytes_per_sample
-        samples_per_block = self.samples_per_block
-        # Process every message in raw_samples
-        count = seq = 0
-        samples = [None] * (len(raw_samples) * samples_per_block)
-        for params in raw_samples:
-            seq_diff = (params['sequence'] - last_sequence) & 0xffff
-            seq_diff -= (seq_diff & 0x8000) << 1
-            seq = last_sequence + seq_diff
-            msg_cdiff = seq * samples_per_block - chip_base
-            data = params['data']
-            for i in range(len(data) // bytes_per_sample):
-                ptime = time_base + (msg_cdiff + i) * inv_freq
-                udata = unpack_from(data, i * bytes_per_sample)
-                samples[count] = (ptime,) + udata
-                count += 1
-        self.clock_sync.set_last_chip_clock(seq * samples_per_block + i)
-        del samples[count:]
-        return samples
+        times, data, last_chip_clock = self.bulk_queue.pull_samples(
+            self.bytes_per_sample, self.samples_per_block, self.last_sequence,
+            time_base, chip_base, inv_freq)
+        cols = self.unpack_columns
+        if not times:
+            return SampleBatch(times, [()] * cols)
+        self.clock_sync.set_last_chip_clock(last_chip_clock)
+        # Decode all samples with a single struct call
+        count = len(times)
+        udata = struct.unpack_from(self.unpack_order
+                                   + self.unpack_fields * count, data)
+        return SampleBatch(times, [udata[i::cols] for i in range(cols)])
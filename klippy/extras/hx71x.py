@@ -93,14 +93,19 @@ class HX71xBase:
     # Measurement decoding
     def _convert_samples(self, samples):
         adc_factor = 1. / (1 << 23)
-        count = 0
-        for ptime, val in samples:
-            if val == SAMPLE_ERROR_DESYNC or val == SAMPLE_ERROR_LONG_READ:
-                self.last_error_count += 1
-                break  # additional errors are duplicates
-            samples[count] = (round(ptime, 6), val, round(val * adc_factor, 9))
-            count += 1
-        del samples[count:]
+        vals = samples.columns[0]
+        errors = [vals.index(err) for err in (SAMPLE_ERROR_DESYNC,
+                                              SAMPLE_ERROR_LONG_READ)
+                  if err in vals]
+        if errors:
+            self.last_error_count += 1
+            # Samples after the first error are discarded (additional
+            # errors are duplicates)
+            samples = samples[:min(errors)]
+            vals = samples.columns[0]
+        return bulk_sensor.SampleBatch(
+            bulk_sensor.scale_column(samples.times, 1.),
+            [vals, bulk_sensor.scale_column(vals, adc_factor, 9)])
 
     # Start, stop, and process message batches
     def _start_measurements(self):
@@ -127,8 +132,7 @@ class HX71xBase:
     def _process_batch(self, eventtime):
         prev_overflows = self.ffreader.get_last_overflows()
         prev_error_count = self.last_error_count
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
+        samples = self._convert_samples(self.ffreader.pull_samples())
         overflows = self.ffreader.get_last_overflows() - prev_overflows
         errors = self.last_error_count - prev_error_count
         if errors > 0:
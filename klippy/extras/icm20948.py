@@ -106,14 +106,12 @@ class ICM20948:
     # Measurement decoding
     def _convert_samples(self, samples):
         (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
-        count = 0
-        for ptime, rx, ry, rz in samples:
-            raw_xyz = (rx, ry, rz)
-            x = round(raw_xyz[x_pos] * x_scale, 6)
-            y = round(raw_xyz[y_pos] * y_scale, 6)
-            z = round(raw_xyz[z_pos] * z_scale, 6)
-            samples[count] = (round(ptime, 6), x, y, z)
-            count += 1
+        raw_xyz = samples.columns
+        return bulk_sensor.SampleBatch(
+            bulk_sensor.scale_column(samples.times, 1.),
+            [bulk_sensor.scale_column(raw_xyz[x_pos], x_scale),
+             bulk_sensor.scale_column(raw_xyz[y_pos], y_scale),
+             bulk_sensor.scale_column(raw_xyz[z_pos], z_scale)])
     # Start, stop, and process message batches
     def _start_measurements(self):
         # In case of miswiring, testing ICM20948 device ID prevents treating
@@ -159,8 +157,7 @@ class ICM20948:
         self.set_reg(REG_PWR_MGMT_1, SET_PWR_MGMT_1_SLEEP)
         self.set_reg(REG_PWR_MGMT_2, SET_PWR_MGMT_2_OFF)
     def _process_batch(self, eventtime):
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
+        samples = self._convert_samples(self.ffreader.pull_samples())
         if not samples:
             return {}
         return {'data': samples, 'errors': self.last_error_count,
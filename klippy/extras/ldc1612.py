@@ -3,7 +3,7 @@
 # Copyright (C) 2020-2024  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
+import logging, array
 from . import bus, bulk_sensor
 
 MIN_MSG_TIME = 0.100
@@ -153,35 +153,45 @@ class LDC1612:
     # Measurement decoding
     def _convert_samples(self, samples):
         freq_conv = self.freq_conv
-        count = 0
+        vals = samples.columns[0]
         errors = {}
         def log_once(msg):
             if not errors.get(msg, 0):
                 errors[msg] = 0
             errors[msg] += 1
-        for ptime, val in samples:
+        bad = [i for i, val in enumerate(vals)
+               if val > 0x03ffffff or val == 0x0]
+        discard = set()
+        for i in bad:
+            val = vals[i]
             mv = val & 0x0fffffff
-            if val > 0x03ffffff or val == 0x0:
-                self.last_error_count += 1
-                if (val >> 16 & 0xffff) == 0xffff:
-                    # Encoded error from sensor_ldc1612.c
-                    log_once(self.lookup_sensor_error(val & 0xffff))
-                    continue
-                error_bits = (val >> 28) & 0x0f
-                if error_bits & 0x8 or mv == 0x0000000:
-                    log_once("Frequency under valid range")
-                if error_bits & 0x4 or mv > 0x3ffffff:
-                    type = "hard" if error_bits & 0x4 else "soft"
-                    log_once("Frequency over valid %s range" % (type))
-                if error_bits & 0x2:
-                    log_once("Conversion Watchdog timeout")
-                if error_bits & 0x1:
-                    log_once("Amplitude Low/High warning")
-            samples[count] = (round(ptime, 6), round(freq_conv * mv, 3), 999.9)
-            count += 1
-        del samples[count:]
+            self.last_error_count += 1
+            if (val >> 16 & 0xffff) == 0xffff:
+                # Encoded error from sensor_ldc1612.c
+                log_once(self.lookup_sensor_error(val & 0xffff))
+                discard.add(i)
+                continue
+            error_bits = (val >> 28) & 0x0f
+            if error_bits & 0x8 or mv == 0x0000000:
+                log_once("Frequency under valid range")
+            if error_bits & 0x4 or mv > 0x3ffffff:
+                type = "hard" if error_bits & 0x4 else "soft"
+                log_once("Frequency over valid %s range" % (type))
+            if error_bits & 0x2:
+                log_once("Conversion Watchdog timeout")
+            if error_bits & 0x1:
+                log_once("Amplitude Low/High warning")
+        if discard:
+            samples = samples.select([i for i in range(len(vals))
+                                      if i not in discard])
+            vals = samples.columns[0]
         for msg in errors:
             logging.error("%s: %s (%d)" % (self.name, msg, errors[msg]))
+        freqs = array.array('d', [round(freq_conv * (val & 0x0fffffff), 3)
+                                  for val in vals])
+        return bulk_sensor.SampleBatch(
+            bulk_sensor.scale_column(samples.times, 1.),
+            [freqs, array.array('d', [999.9]) * len(freqs)])
     # Start, stop, and process message batches
     def _start_measurements(self):
         # In case of miswiring, testing LDC1612 device ID prevents treating
@@ -218,8 +228,7 @@ class LDC1612:
         self.ffreader.note_end()
         logging.info("LDC1612 finished '%s' measurements", self.name)
     def _process_batch(self, eventtime):
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
+        samples = self._convert_samples(self.ffreader.pull_samples())
         if not samples:
             return {}
         if self.calibration is not None:
@@ -6,7 +6,7 @@
 
 from . import hx71x
 from . import ads1220
-from .bulk_sensor import BatchWebhooksClient
+from .bulk_sensor import BatchWebhooksClient, SampleBatch
 import collections, itertools
 # We want either Python 3's zip() or Python 2's izip() but NOT 2's zip():
 zip_impl = zip
@@ -405,11 +405,11 @@ class LoadCell:
         overflows = msg.get("overflows")
         if data is None:
             return None
-        samples = []
-        for row in data:
-            # [time, grams, counts, tare_counts]
-            samples.append([row[0], self.counts_to_grams(row[1]), row[1],
-                            self.tare_counts])
+        # [time, grams, counts, tare_counts]
+        counts = data.columns[0]
+        grams = [self.counts_to_grams(c) for c in counts]
+        samples = SampleBatch(data.times, [grams, counts,
+                                           [self.tare_counts] * len(counts)])
         msg = {'data': samples, 'errors': errors, 'overflows': overflows}
         self.clients.send(msg)
         return True
@@ -4,10 +4,11 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math
-import mcu
+import mcu, util
 from . import probe, trigger_analog, load_cell, hx71x, ads1220
 
-np = None  # delay NumPy import until configuration time
+# delay NumPy import until first use
+np = util.LazyModule('numpy', "[load_cell_probe] requires the NumPy module")
 
 # MCU SOS filter scaled to "fractional grams" for consistent sensor precision
 FRAC_GRAMS_CONV = 32768.0
@@ -468,12 +469,8 @@ class LoadCellProbeCommands:
 class LoadCellPrinterProbe:
     def __init__(self, config):
         cfg_error = config.error
-        try:
-            global np
-            import numpy as np
-        except:
-            raise cfg_error("[load_cell_probe] requires the NumPy module")
         self._printer = config.get_printer()
+        np.check(cfg_error, self._printer.command_error)
         # Sensor types supported by load_cell_probe
         sensors = {}
         sensors.update(hx71x.HX71X_SENSOR_TYPES)
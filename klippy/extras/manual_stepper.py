@@ -65,6 +65,7 @@ class ManualStepper:
         dist = movepos - cp
         axis_r, accel_t, cruise_t, cruise_v = force_move.calc_move_time(
             dist, speed, accel)
+        self.motion_queuing.finalize_step_generation()
         self.trapq_append(self.trapq, movetime,
                           accel_t, cruise_t, accel_t,
                           cp, 0., 0., axis_r, 0., 0.,
@@ -11,6 +11,10 @@ BGFLUSH_HIGH_TIME = 0.400
 BGFLUSH_SG_LOW_TIME = 0.450
 BGFLUSH_SG_HIGH_TIME = 0.700
 BGFLUSH_EXTRA_TIME = 0.250
+BGFLUSH_SG_MIN_BATCH_TIME = 0.050
+BGFLUSH_SG_TARGET_WORK = 0.005
+SG_COST_SMOOTH = 0.25
+BGFLUSH_SG_FINALIZE_TIME = 0.005
 
 MOVE_HISTORY_EXPIRE = 30.
 MIN_KIN_TIME = 0.100
@@ -32,8 +36,13 @@ class PrinterMotionQueuing:
         self.steppersyncmgr = ffi_main.gc(ffi_lib.steppersyncmgr_alloc(),
                                           ffi_lib.steppersyncmgr_free)
         self.syncemitters = []
+        self.stepper_emitters = []
         self.steppersyncs = []
-        self.steppersyncmgr_gen_steps = ffi_lib.steppersyncmgr_gen_steps
+        self.steppersyncmgr_start_gen_steps = (
+            ffi_lib.steppersyncmgr_start_gen_steps)
+        self.steppersyncmgr_finalize_gen_steps = (
+            ffi_lib.steppersyncmgr_finalize_gen_steps)
+        self.sg_pending = None
         # History expiration
         self.clear_history_time = 0.
         # Flush notification callbacks
@@ -54,6 +63,18 @@ class PrinterMotionQueuing:
         self.do_kick_flush_timer = True
         self.last_flush_time = self.last_step_gen_time = 0.
         self.need_flush_time = self.need_step_gen_time = 0.
+        # Adaptive step generation batching
+        self.sg_cost = 0.
+        self.sg_active = False
+        self.sg_work_time = self.sg_gen_time = 0.
+        self.sg_batch_time = BGFLUSH_SG_HIGH_TIME - BGFLUSH_SG_LOW_TIME
+        # Flush statistics
+        self.stats_time = self.reactor.monotonic()
+        self.stats_wakeups = 0
+        self.stats_min_buffer = None
+        self.stats_profile = {}
+        self.step_profile = (0., {})
+        self.step_profile_wanted = False
         # "Drip" timing (for homing and probing moves)
         self.drip_start_times = []
         # Register handlers
@@ -65,9 +86,12 @@ class PrinterMotionQueuing:
         self.trapqs.append(trapq)
         return trapq
     def wipe_trapq(self, trapq):
+        self.finalize_step_generation()
         # Expire any remaining movement in the trapq (force to history list)
         self.trapq_finalize_moves(trapq, self.reactor.NEVER, 0.)
     def lookup_trapq_append(self):
+        # Callers must invoke finalize_step_generation() (directly or
+        # via a flush) before appending to a trapq
         ffi_main, ffi_lib = chelper.get_ffi()
         return ffi_lib.trapq_append
     # C steppersync tracking
@@ -80,11 +104,14 @@ class PrinterMotionQueuing:
         self.steppersyncs.append((mcu, ss))
         return ss
     def allocate_syncemitter(self, mcu, name, alloc_stepcompress=True):
-        name = name.encode("utf-8")[:15]
+        cname = name.encode("utf-8")[:15]
         ss = self._lookup_steppersync(mcu)
         ffi_main, ffi_lib = chelper.get_ffi()
-        se = ffi_lib.steppersync_alloc_syncemitter(ss, name, alloc_stepcompress)
+        se = ffi_lib.steppersync_alloc_syncemitter(ss, cname,
+                                                   alloc_stepcompress)
         self.syncemitters.append(se)
+        if alloc_stepcompress:
+            self.stepper_emitters.append((name, se))
         return se
     def setup_mcu_movequeue(self, mcu, serialqueue, move_count):
         # Setup steppersync object for the mcu's main movequeue
@@ -93,7 +120,60 @@ class PrinterMotionQueuing:
         ffi_lib.steppersync_setup_movequeue(ss, serialqueue, move_count)
         mcu_freq = float(mcu.seconds_to_clock(1.))
         ffi_lib.steppersync_set_time(ss, 0., mcu_freq)
+    def get_step_profile(self):
+        # Report cumulative step generation counters for each stepper
+        # along with the system time the counters were read.  If
+        # background step generation is active, the previous snapshot
+        # is returned (so that profiling does not serialize step
+        # generation) and a new snapshot is taken at the next finalize.
+        if self.sg_pending is not None:
+            self.step_profile_wanted = True
+            return self.step_profile
+        self.step_profile = self._read_step_profile()
+        return self.step_profile
+    def _read_step_profile(self):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        sestats = ffi_main.new('struct syncemitter_stats *')
+        res = {}
+        for name, se in self.stepper_emitters:
+            ffi_lib.syncemitter_get_stats(se, sestats)
+            res[name] = {'itersolve_time': sestats.gen_time,
+                         'stepcompress_time': sestats.flush_time,
+                         'gen_count': sestats.gen_count,
+                         'steps': sestats.step_count,
+                         'queue_steps': sestats.msg_count}
+        return self.reactor.monotonic(), res
+    def _stats_step_profile(self):
+        # Summarize step generation cost since the last stats report
+        profile_time, profile = self.get_step_profile()
+        last_profile = self.stats_profile
+        self.stats_profile = profile
+        gen_time = flush_time = max_time = 0.
+        steps = msgs = 0
+        max_name = None
+        for name, p in profile.items():
+            lp = last_profile.get(name)
+            if lp is None:
+                continue
+            se_gen_time = p['itersolve_time'] - lp['itersolve_time']
+            se_flush_time = p['stepcompress_time'] - lp['stepcompress_time']
+            gen_time += se_gen_time
+            flush_time += se_flush_time
+            steps += p['steps'] - lp['steps']
+            msgs += p['queue_steps'] - lp['queue_steps']
+            if se_gen_time + se_flush_time > max_time:
+                max_time = se_gen_time + se_flush_time
+                max_name = name
+        msg = " sg_itersolve_time=%.6f sg_stepcompress_time=%.6f" % (
+            gen_time, flush_time)
+        msg += " sg_steps=%d sg_queue_steps=%d" % (steps, msgs)
+        if msgs:
+            msg += " sg_compression=%.1f" % (float(steps) / msgs,)
+        if max_name is not None:
+            msg += " sg_max_stepper=%s" % (max_name.replace(' ', '_'),)
+        return msg
     def stats(self, eventtime):
+        self.finalize_step_generation()
         # Globally calibrate mcu clocks (and step generation clocks)
         sync_time = self.last_step_gen_time
         ffi_main, ffi_lib = chelper.get_ffi()
@@ -103,7 +183,17 @@ class PrinterMotionQueuing:
         # Calculate history expiration
         est_print_time = self.mcu.estimated_print_time(eventtime)
         self.clear_history_time = max(0., est_print_time - MOVE_HISTORY_EXPIRE)
-        return False, ""
+        # Report flush timer statistics
+        elapsed = max(eventtime - self.stats_time, .001)
+        msg = "flush_wakeups=%.1f sg_batch_time=%.3f" % (
+            self.stats_wakeups / elapsed, self.sg_batch_time)
+        if self.stats_min_buffer is not None:
+            msg += " min_sg_buffer=%.3f" % (self.stats_min_buffer,)
+        msg += self._stats_step_profile()
+        self.stats_time = eventtime
+        self.stats_wakeups = 0
+        self.stats_min_buffer = None
+        return False, msg
     # Flush notification callbacks
     def register_flush_callback(self, callback, can_add_trapq=False):
         if can_add_trapq:
@@ -119,6 +209,7 @@ class PrinterMotionQueuing:
     def get_kin_flush_delay(self):
         return self.kin_flush_delay
     def check_step_generation_scan_windows(self):
+        self.finalize_step_generation()
         ffi_main, ffi_lib = chelper.get_ffi()
         kin_flush_delay = SDS_CHECK_TIME
         for se in self.syncemitters:
@@ -135,7 +226,9 @@ class PrinterMotionQueuing:
     # Flush tracking
     def _handle_shutdown(self):
         self.can_pause = False
-    def _advance_flush_time(self, want_flush_time, want_step_gen_time=0.):
+    def _advance_flush_time(self, want_flush_time, want_step_gen_time=0.,
+                            pipeline=False):
+        self.finalize_step_generation()
         flush_time = max(want_flush_time, self.last_flush_time,
                          want_step_gen_time - STEPCOMPRESS_FLUSH_TIME)
         step_gen_time = max(want_step_gen_time, self.last_step_gen_time,
@@ -149,17 +242,36 @@ class PrinterMotionQueuing:
         clear_history_time = self.clear_history_time
         if not self.can_pause:
             clear_history_time = max(0., trapq_free_time - MOVE_HISTORY_EXPIRE)
-        # Generate stepper movement and transmit
-        ret = self.steppersyncmgr_gen_steps(self.steppersyncmgr, flush_time,
+        # Generate stepper movement (in background threads)
+        self.steppersyncmgr_start_gen_steps(self.steppersyncmgr, flush_time,
                                             step_gen_time, clear_history_time)
-        if ret:
-            raise self.mcu.error("Internal error in stepcompress")
+        self.sg_pending = (trapq_free_time, clear_history_time)
         self.last_flush_time = flush_time
         self.last_step_gen_time = step_gen_time
+        if not pipeline:
+            self.finalize_step_generation()
+    def finalize_step_generation(self):
+        # Wait for background step generation to complete and transmit
+        if self.sg_pending is None:
+            return
+        trapq_free_time, clear_history_time = self.sg_pending
+        self.sg_pending = None
+        start_time = self.reactor.monotonic()
+        ret = self.steppersyncmgr_finalize_gen_steps(self.steppersyncmgr)
+        if ret:
+            raise self.mcu.error("Internal error in stepcompress")
         # Move processed trapq entries to history list, and expire old history
         for trapq in self.trapqs:
             self.trapq_finalize_moves(trapq, trapq_free_time,
                                       clear_history_time)
+        if self.step_profile_wanted:
+            self.step_profile_wanted = False
+            self.step_profile = self._read_step_profile()
+        if self.sg_gen_time:
+            finalize_time = self.reactor.monotonic() - start_time
+            work_time = self.sg_work_time + finalize_time
+            self._note_step_gen_cost(work_time, self.sg_gen_time)
+            self.sg_gen_time = 0.
     def _await_flush_time(self, want_flush_time):
         while 1:
             if self.last_flush_time >= want_flush_time or not self.can_pause:
@@ -170,6 +282,17 @@ class PrinterMotionQueuing:
             if wait <= 0.:
                 return
             self.reactor.pause(systime + min(1., wait))
+    def _note_step_gen_cost(self, work_time, gen_time):
+        # Size step generation batches so that each flush takes roughly
+        # BGFLUSH_SG_TARGET_WORK of host time (avoids bursts under load)
+        cost = work_time / gen_time
+        self.sg_cost += (cost - self.sg_cost) * SG_COST_SMOOTH
+        max_batch_time = BGFLUSH_SG_HIGH_TIME - BGFLUSH_SG_LOW_TIME
+        batch_time = max_batch_time
+        if self.sg_cost * max_batch_time > BGFLUSH_SG_TARGET_WORK:
+            batch_time = max(BGFLUSH_SG_TARGET_WORK / self.sg_cost,
+                             BGFLUSH_SG_MIN_BATCH_TIME)
+        self.sg_batch_time = batch_time
     def flush_all_steps(self):
         flush_time = self.need_step_gen_time
         self._await_flush_time(flush_time)
@@ -179,12 +302,21 @@ class PrinterMotionQueuing:
         return kin_time + self.kin_flush_delay
     def _flush_handler(self, eventtime):
         try:
+            self.stats_wakeups += 1
+            self.finalize_step_generation()
             est_print_time = self.mcu.estimated_print_time(eventtime)
             aggr_sg_time = self.need_step_gen_time - 2.*self.kin_flush_delay
             if self.last_step_gen_time < aggr_sg_time:
                 # Actively stepping - want more aggressive flushing
+                if self.sg_active:
+                    # Track buffered step time (while continuously stepping)
+                    buffer_time = self.last_step_gen_time - est_print_time
+                    if (self.stats_min_buffer is None
+                        or buffer_time < self.stats_min_buffer):
+                        self.stats_min_buffer = buffer_time
+                self.sg_active = True
                 want_sg_time = est_print_time + BGFLUSH_SG_HIGH_TIME
-                batch_time = BGFLUSH_SG_HIGH_TIME - BGFLUSH_SG_LOW_TIME
+                batch_time = self.sg_batch_time
                 next_batch_time = self.last_step_gen_time + batch_time
                 if next_batch_time > est_print_time:
                     # Improve run-to-run reproducibility by batching from last
@@ -192,12 +324,25 @@ class PrinterMotionQueuing:
                         # Delay flushing until next wakeup
                         next_batch_time = self.last_step_gen_time
                     want_sg_time = next_batch_time
+                remain_time = aggr_sg_time - want_sg_time
+                if (want_sg_time > self.last_step_gen_time
+                    and remain_time < BGFLUSH_SG_MIN_BATCH_TIME):
+                    # Avoid a short trailing batch at the end of the queue
+                    want_sg_time = aggr_sg_time
                 want_sg_time = min(want_sg_time, aggr_sg_time)
                 # Flush motion queues (if needed)
                 if want_sg_time > self.last_step_gen_time:
-                    self._advance_flush_time(0., want_sg_time)
+                    # Start step generation and return to the reactor
+                    # while it runs in the background threads
+                    gen_time = want_sg_time - max(self.last_step_gen_time,
+                                                  est_print_time)
+                    start_time = self.reactor.monotonic()
+                    self._advance_flush_time(0., want_sg_time, pipeline=True)
+                    self.sg_work_time = self.reactor.monotonic() - start_time
+                    self.sg_gen_time = max(gen_time, 0.)
             else:
                 # Not stepping (or only step remnants) - use relaxed flushing
+                self.sg_active = False
                 want_flush_time = est_print_time + BGFLUSH_HIGH_TIME
                 max_flush_time = self.need_flush_time + BGFLUSH_EXTRA_TIME
                 want_flush_time = min(want_flush_time, max_flush_time)
@@ -207,13 +352,20 @@ class PrinterMotionQueuing:
             # Reschedule timer
             aggr_sg_time = self.need_step_gen_time - 2.*self.kin_flush_delay
             if self.last_step_gen_time < aggr_sg_time:
-                waketime = self.last_step_gen_time - BGFLUSH_SG_LOW_TIME
+                low_time = BGFLUSH_SG_HIGH_TIME - self.sg_batch_time
+                waketime = self.last_step_gen_time - low_time
             else:
                 self.do_kick_flush_timer = True
                 max_flush_time = self.need_flush_time + BGFLUSH_EXTRA_TIME
                 if self.last_flush_time >= max_flush_time:
-                    return self.reactor.NEVER
+                    if self.sg_pending is None:
+                        return self.reactor.NEVER
+                    return eventtime + BGFLUSH_SG_FINALIZE_TIME
                 waketime = self.last_flush_time - BGFLUSH_LOW_TIME
+            if self.sg_pending is not None:
+                # Transmit the generated steps on the next wakeup
+                return eventtime + min(waketime - est_print_time,
+                                       BGFLUSH_SG_FINALIZE_TIME)
             return eventtime + waketime - est_print_time
         except:
             logging.exception("Exception in flush_handler")
@@ -3,21 +3,57 @@
 # Copyright (C) 2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
+import logging, struct, sys
 import chelper
 from . import bulk_sensor
 
+EXPORT_BUFFER_SIZE = 256
+
+# Determine the python struct format of a C structure (for binary export)
+def lookup_binary_format(ctype, fmt):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    fmt = ('<' if sys.byteorder == 'little' else '>') + fmt
+    pad = ffi_main.sizeof(ctype) - struct.calcsize(fmt)
+    if pad:
+        fmt += '%dx' % (pad,)
+    return fmt
+
+# Encode the first 'count' entries of a C array for binary export
+def encode_binary(data, start, count):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    size = ffi_main.sizeof(data[0])
+    return bytearray(ffi_main.buffer(data, count * size)[start * size:])
+
 # Extract stepper queue_step messages
 class DumpStepper:
     def __init__(self, printer, mcu_stepper):
         self.printer = printer
         self.mcu_stepper = mcu_stepper
-        self.last_batch_clock = 0
-        self.batch_bulk = bulk_sensor.BatchBulkHelper(printer,
-                                                      self._process_batch)
+        self.last_batch_clock = self.last_bin_batch_clock = 0
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.export_buf = ffi_main.new('struct pull_history_steps[]',
+                                       EXPORT_BUFFER_SIZE)
         api_resp = {'header': ('interval', 'count', 'add')}
-        self.batch_bulk.add_mux_endpoint("motion_report/dump_stepper", "name",
-                                         mcu_stepper.get_name(), api_resp)
+        self.batch_bulk = bulk_sensor.BatchBulkHelper(
+            printer, self._process_batch, webhooks_start_resp=api_resp)
+        bin_api_resp = {
+            'header': ('first_clock', 'last_clock', 'start_position',
+                       'count', 'interval', 'add'),
+            'format': lookup_binary_format('struct pull_history_steps',
+                                           'QQqiii')}
+        self.bin_batch_bulk = bulk_sensor.BatchBulkHelper(
+            printer, self._process_bin_batch, webhooks_start_resp=bin_api_resp)
+        wh = self.printer.lookup_object('webhooks')
+        wh.register_mux_endpoint("motion_report/dump_stepper", "name",
+                                 mcu_stepper.get_name(), self._add_api_client)
+    def _add_api_client(self, web_request):
+        fmt = web_request.get_str('format', 'json')
+        if fmt == 'binary':
+            self.bin_batch_bulk.add_api_client(web_request)
+        elif fmt == 'json':
+            self.batch_bulk.add_api_client(web_request)
+        else:
+            raise web_request.error("Invalid format '%s'" % (fmt,))
     def get_step_queue(self, start_clock, end_clock):
         mcu_stepper = self.mcu_stepper
         res = []
@@ -43,29 +79,47 @@ class DumpStepper:
                        % (i, s.first_clock, s.start_position, s.interval,
                           s.step_count, s.add))
         logging.info('\n'.join(out))
-    def _process_batch(self, eventtime):
-        data, cdata = self.get_step_queue(self.last_batch_clock, 1<<63)
-        if not data:
-            return {}
-        for i, d in enumerate(data):
-            if not d.step_count:
-                # End block on a set_position marker to simplify timing
-                del data[i+1:]
-                break
+    def _export_steps(self, start_clock):
+        # Copy step history (up to the next position reset) into export_buf
+        while 1:
+            count = self.mcu_stepper.export_steps(self.export_buf,
+                                                  start_clock, 1<<63)
+            if count < len(self.export_buf):
+                return count
+            ffi_main, ffi_lib = chelper.get_ffi()
+            self.export_buf = ffi_main.new('struct pull_history_steps[]',
+                                           2 * len(self.export_buf))
+    def _batch_info(self, first, last):
         clock_to_print_time = self.mcu_stepper.get_mcu().clock_to_print_time
-        first = data[0]
-        first_clock = first.first_clock
-        first_time = clock_to_print_time(first_clock)
-        self.last_batch_clock = last_clock = data[-1].last_clock
-        last_time = clock_to_print_time(last_clock)
         mcu_pos = first.start_position
         start_position = self.mcu_stepper.mcu_to_commanded_position(mcu_pos)
         step_dist = self.mcu_stepper.get_step_dist()
-        tdata = [(s.interval, s.step_count, s.add) for s in data]
-        return {"data": tdata, "start_position": start_position,
+        return {"start_position": start_position,
                 "start_mcu_position": mcu_pos, "step_distance": step_dist,
-                "first_clock": first_clock, "first_step_time": first_time,
-                "last_clock": last_clock, "last_step_time": last_time}
+                "first_clock": first.first_clock,
+                "first_step_time": clock_to_print_time(first.first_clock),
+                "last_clock": last.last_clock,
+                "last_step_time": clock_to_print_time(last.last_clock)}
+    def _process_batch(self, eventtime):
+        count = self._export_steps(self.last_batch_clock)
+        if not count:
+            return {}
+        data = self.export_buf
+        self.last_batch_clock = data[count-1].last_clock
+        msg = self._batch_info(data[0], data[count-1])
+        msg["data"] = [(s.interval, s.step_count, s.add)
+                       for s in data[0:count]]
+        return msg
+    def _process_bin_batch(self, eventtime):
+        count = self._export_steps(self.last_bin_batch_clock)
+        if not count:
+            return {}
+        data = self.export_buf
+        self.last_bin_batch_clock = data[count-1].last_clock
+        msg = self._batch_info(data[0], data[count-1])
+        msg["data"] = encode_binary(data, 0, count)
+        msg["count"] = count
+        return msg
 
 NEVER_TIME = 9999999999999999.
 
@@ -76,13 +130,33 @@ class DumpTrapQ:
         self.name = name
         self.trapq = trapq
         self.last_batch_msg = (0., 0.)
+        self.last_bin_batch = (0., 0.)
         self.motion_queuing = printer.lookup_object("motion_queuing")
-        self.batch_bulk = bulk_sensor.BatchBulkHelper(printer,
-                                                      self._process_batch)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.export_buf = ffi_main.new('struct pull_move[]',
+                                       EXPORT_BUFFER_SIZE)
         api_resp = {'header': ('time', 'duration', 'start_velocity',
                                'acceleration', 'start_position', 'direction')}
-        self.batch_bulk.add_mux_endpoint("motion_report/dump_trapq",
-                                         "name", name, api_resp)
+        self.batch_bulk = bulk_sensor.BatchBulkHelper(
+            printer, self._process_batch, webhooks_start_resp=api_resp)
+        bin_api_resp = {
+            'header': ('time', 'duration', 'start_velocity', 'acceleration',
+                       'start_x', 'start_y', 'start_z',
+                       'direction_x', 'direction_y', 'direction_z'),
+            'format': lookup_binary_format('struct pull_move', 'dddddddddd')}
+        self.bin_batch_bulk = bulk_sensor.BatchBulkHelper(
+            printer, self._process_bin_batch, webhooks_start_resp=bin_api_resp)
+        wh = self.printer.lookup_object('webhooks')
+        wh.register_mux_endpoint("motion_report/dump_trapq", "name", name,
+                                 self._add_api_client)
+    def _add_api_client(self, web_request):
+        fmt = web_request.get_str('format', 'json')
+        if fmt == 'binary':
+            self.bin_batch_bulk.add_api_client(web_request)
+        elif fmt == 'json':
+            self.batch_bulk.add_api_client(web_request)
+        else:
+            raise web_request.error("Invalid format '%s'" % (fmt,))
     def extract_trapq(self, start_time, end_time):
         ffi_main, ffi_lib = chelper.get_ffi()
         res = []
@@ -121,12 +195,23 @@ class DumpTrapQ:
                move.start_z + move.z_r * dist)
         velocity = move.start_v + move.accel * move_time
         return pos, velocity
+    def _export_moves(self, start_time):
+        # Copy trapq moves (in chronological order) into export_buf
+        ffi_main, ffi_lib = chelper.get_ffi()
+        while 1:
+            count = ffi_lib.trapq_export(self.trapq, self.export_buf,
+                                         len(self.export_buf), start_time,
+                                         NEVER_TIME)
+            if count < len(self.export_buf):
+                return count
+            self.export_buf = ffi_main.new('struct pull_move[]',
+                                           2 * len(self.export_buf))
     def _process_batch(self, eventtime):
         qtime = self.last_batch_msg[0] + min(self.last_batch_msg[1], 0.100)
-        data, cdata = self.extract_trapq(qtime, NEVER_TIME)
+        count = self._export_moves(qtime)
         d = [(m.print_time, m.move_t, m.start_v, m.accel,
               (m.start_x, m.start_y, m.start_z), (m.x_r, m.y_r, m.z_r))
-             for m in data]
+             for m in self.export_buf[0:count]]
         if d:
             start_drip_time = self.motion_queuing.check_drip_timing()
             if start_drip_time is not None:
@@ -139,6 +224,60 @@ class DumpTrapQ:
             return {}
         self.last_batch_msg = d[-1]
         return {"data": d}
+    def _process_bin_batch(self, eventtime):
+        last_time, last_duration = self.last_bin_batch
+        count = self._export_moves(last_time + min(last_duration, 0.100))
+        data = self.export_buf
+        start_drip_time = self.motion_queuing.check_drip_timing()
+        if start_drip_time is not None:
+            # If homing, delay sending trapq entries that may change
+            while (count and data[count-1].print_time
+                   + data[count-1].move_t >= start_drip_time):
+                count -= 1
+        start = 0
+        if count:
+            first = data[0]
+            if (first.print_time, first.move_t) == self.last_bin_batch:
+                start = 1
+        if start >= count:
+            return {}
+        self.last_bin_batch = (data[count-1].print_time, data[count-1].move_t)
+        return {"data": encode_binary(data, start, count),
+                "count": count - start}
+
+# Report step generation cost of each stepper
+class DumpStepProfile:
+    def __init__(self, printer, motion_queuing):
+        self.printer = printer
+        self.motion_queuing = motion_queuing
+        self.last_profile = {}
+        self.last_time = 0.
+        self.batch_bulk = bulk_sensor.BatchBulkHelper(
+            printer, self._process_batch, self._start)
+        api_resp = {'header': ('itersolve_time', 'stepcompress_time',
+                               'steps', 'queue_steps', 'compression')}
+        self.batch_bulk.add_endpoint("motion_report/step_profile", api_resp)
+    def _start(self):
+        self.last_time, self.last_profile = (
+            self.motion_queuing.get_step_profile())
+    def _process_batch(self, eventtime):
+        profile_time, profile = self.motion_queuing.get_step_profile()
+        if profile_time <= self.last_time:
+            # No new snapshot since the last report
+            return {}
+        last_profile = self.last_profile
+        data = {}
+        for name, p in profile.items():
+            lp = last_profile.get(name, p)
+            steps = p['steps'] - lp['steps']
+            msgs = p['queue_steps'] - lp['queue_steps']
+            data[name] = (p['itersolve_time'] - lp['itersolve_time'],
+                          p['stepcompress_time'] - lp['stepcompress_time'],
+                          steps, msgs, float(steps) / msgs if msgs else 0.)
+        elapsed = profile_time - self.last_time
+        self.last_profile = profile
+        self.last_time = profile_time
+        return {"data": data, "elapsed": elapsed}
 
 STATUS_REFRESH_TIME = 0.250
 
@@ -147,6 +286,8 @@ class PrinterMotionReport:
         self.printer = config.get_printer()
         self.steppers = {}
         self.dtrapqs = {}
+        motion_queuing = self.printer.load_object(config, 'motion_queuing')
+        self.step_profile = DumpStepProfile(self.printer, motion_queuing)
         # get_status information
         self.next_status_time = 0.
         gcode = self.printer.lookup_object('gcode')
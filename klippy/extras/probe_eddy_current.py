@@ -3,7 +3,7 @@
 # Copyright (C) 2021-2024  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, math, bisect
+import logging, math, bisect, array
 import mcu
 from . import ldc1612, trigger_analog, probe, manual_probe
 
@@ -44,29 +44,32 @@ class EddyCalibration:
         cal = sorted([(c[1], c[0]) for c in cal])
         self.cal_freqs = [c[0] for c in cal]
         self.cal_zpos = [c[1] for c in cal]
+    def _lookup_zpos(self, adj_freq):
+        pos = bisect.bisect(self.cal_freqs, adj_freq)
+        if pos >= len(self.cal_zpos):
+            return -OUT_OF_RANGE
+        elif pos == 0:
+            return OUT_OF_RANGE
+        # XXX - could further optimize and avoid div by zero
+        this_freq = self.cal_freqs[pos]
+        prev_freq = self.cal_freqs[pos - 1]
+        this_zpos = self.cal_zpos[pos]
+        prev_zpos = self.cal_zpos[pos - 1]
+        gain = (this_zpos - prev_zpos) / (this_freq - prev_freq)
+        offset = prev_zpos - prev_freq * gain
+        return adj_freq * gain + offset
     def apply_calibration(self, samples):
         cur_temp = self.drift_comp.get_temperature()
-        for i, (samp_time, freq, dummy_z) in enumerate(samples):
-            adj_freq = self.drift_comp.adjust_freq(freq, cur_temp)
-            pos = bisect.bisect(self.cal_freqs, adj_freq)
-            if pos >= len(self.cal_zpos):
-                zpos = -OUT_OF_RANGE
-            elif pos == 0:
-                zpos = OUT_OF_RANGE
-            else:
-                # XXX - could further optimize and avoid div by zero
-                this_freq = self.cal_freqs[pos]
-                prev_freq = self.cal_freqs[pos - 1]
-                this_zpos = self.cal_zpos[pos]
-                prev_zpos = self.cal_zpos[pos - 1]
-                gain = (this_zpos - prev_zpos) / (this_freq - prev_freq)
-                offset = prev_zpos - prev_freq * gain
-                zpos = adj_freq * gain + offset
-            samples[i] = (samp_time, freq, round(zpos, 6))
+        adjust_freq = self.drift_comp.adjust_freq
+        lookup_zpos = self._lookup_zpos
+        freqs, zpos = samples.columns
+        zpos[:] = array.array('d', [
+            round(lookup_zpos(adjust_freq(freq, cur_temp)), 6)
+            for freq in freqs])
     def freq_to_height(self, freq):
-        dummy_sample = [(0., freq, 0.)]
-        self.apply_calibration(dummy_sample)
-        return dummy_sample[0][2]
+        cur_temp = self.drift_comp.get_temperature()
+        adj_freq = self.drift_comp.adjust_freq(freq, cur_temp)
+        return round(self._lookup_zpos(adj_freq), 6)
     def height_to_freq(self, height):
         # XXX - could optimize lookup
         rev_zpos = list(reversed(self.cal_zpos))
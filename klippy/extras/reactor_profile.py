@@ -0,0 +1,68 @@
+# Reactor callback latency tracking
+#
+# Copyright (C) 2025  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import logging
+
+REPORT_COUNT = 5
+
+class PrinterReactorProfile:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.slow_time = config.getfloat('slow_callback_time', 0.050,
+                                         above=0.)
+        self.profile = self.reactor.enable_profile(self.slow_time)
+        self.status = self._build_status()
+        # Register webhooks endpoint
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("reactor_profile/dump_profile",
+                                   self._handle_dump_profile)
+    def _get_worst(self, index, count=REPORT_COUNT):
+        cbs = self.profile.callbacks
+        worst = sorted(cbs.keys(), key=(lambda k: cbs[k][index]),
+                       reverse=True)
+        return [(k, round(cbs[k][index], 6)) for k in worst[:count]
+                if cbs[k][index] > 0.]
+    def _build_status(self):
+        profile = self.profile
+        return {
+            'histogram_bounds': list(profile.BUCKETS),
+            'callback_histogram': list(profile.run_histogram),
+            'lateness_histogram': list(profile.late_histogram),
+            'slowest_callbacks': self._get_worst(2),
+            'late_callbacks': self._get_worst(3),
+            'slow_callback_count': sum([i[4] for i in
+                                        profile.callbacks.values()]),
+        }
+    def _handle_dump_profile(self, web_request):
+        profile = self.profile
+        callbacks = {k: {'count': i[0], 'total_time': round(i[1], 6),
+                         'max_time': round(i[2], 6),
+                         'max_lateness': round(i[3], 6), 'slow_count': i[4]}
+                     for k, i in profile.callbacks.items()}
+        web_request.send({
+            'slow_callback_time': self.slow_time,
+            'histogram_bounds': list(profile.BUCKETS),
+            'callback_histogram': list(profile.run_histogram),
+            'lateness_histogram': list(profile.late_histogram),
+            'callbacks': callbacks})
+    def stats(self, eventtime):
+        (max_time, max_key), (max_late, late_key), slow = \
+            self.profile.reset_interval()
+        if slow:
+            cbs = self.profile.callbacks
+            logging.info("Slow reactor callbacks: %s", " ".join(
+                ["%s(count=%d max=%.3f)" % (k, c, cbs[k][2])
+                 for k, c in sorted(slow.items())]))
+        self.status = self._build_status()
+        return (False, "reactor_max_time=%.6f reactor_max_cb=%s"
+                " reactor_max_late=%.6f reactor_late_cb=%s reactor_slow=%d"
+                % (max_time, max_key, max_late, late_key,
+                   sum(slow.values())))
+    def get_status(self, eventtime):
+        return self.status
+
+def load_config(config):
+    return PrinterReactorProfile(config)
@@ -3,7 +3,7 @@
 # Copyright (C) 2018-2024  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, sys, logging, io
+import os, sys, re, json, bisect, logging, io, threading, collections, codecs
 
 VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
 
@@ -13,6 +13,216 @@ DEFAULT_ERROR_GCODE = """
 {% endif %}
 """
 
+# Maximum number of file lines to run per acquisition of the gcode mutex
+BATCH_LINES = 64
+
+
+######################################################################
+# File reading
+######################################################################
+
+READ_SIZE = 8192
+
+# Read file data directly from the reactor thread
+class FileReader:
+    def __init__(self, reactor, f):
+        self.reactor = reactor
+        self.file = f
+        self.max_stall = 0.
+    def seek(self, pos):
+        self.file.seek(pos)
+    def read(self):
+        start_time = self.reactor.monotonic()
+        data = self.file.read(READ_SIZE)
+        self.max_stall = max(self.max_stall,
+                             self.reactor.monotonic() - start_time)
+        return data
+    def close(self):
+        pass
+
+# Read file data from a background thread ahead of the print
+class ReadAheadReader:
+    def __init__(self, reactor, f, window):
+        self.reactor = reactor
+        # Use a separate descriptor so that the file offset of 'f' is
+        # never changed by the background thread
+        self.fd = os.open(f.name, os.O_RDONLY)
+        self.decoder = codecs.getincrementaldecoder(f.encoding)()
+        self.max_chunks = max(2, window // READ_SIZE)
+        self.max_stall = 0.
+        # Shared with background thread
+        self.lock = threading.Condition()
+        self.chunks = collections.deque()
+        self.read_pos = self.generation = 0
+        self.is_eof = True
+        self.must_exit = False
+        self.waiter = None
+        self.bg_thread = threading.Thread(target=self._bg_thread)
+        self.bg_thread.daemon = True
+        self.bg_thread.start()
+    def seek(self, pos):
+        with self.lock:
+            self.read_pos = pos
+            self.generation += 1
+            self.chunks.clear()
+            self.is_eof = False
+            self.lock.notify()
+    def read(self):
+        while 1:
+            start_time = self.reactor.monotonic()
+            with self.lock:
+                if self.chunks:
+                    data = self.chunks.popleft()
+                    self.lock.notify()
+                else:
+                    data = None
+                    self.waiter = completion = self.reactor.completion()
+            self.max_stall = max(self.max_stall,
+                                 self.reactor.monotonic() - start_time)
+            if data is None:
+                completion.wait()
+                continue
+            if isinstance(data, Exception):
+                raise data
+            return data
+    def close(self):
+        with self.lock:
+            self.must_exit = True
+            self.lock.notify()
+    def _bg_thread(self):
+        generation = pos = 0
+        while 1:
+            with self.lock:
+                while (not self.must_exit and generation == self.generation
+                       and (self.is_eof
+                            or len(self.chunks) >= self.max_chunks)):
+                    self.lock.wait()
+                if self.must_exit:
+                    break
+                if generation != self.generation:
+                    generation = self.generation
+                    pos = self.read_pos
+                    self.decoder.reset()
+            try:
+                os.lseek(self.fd, pos, os.SEEK_SET)
+                raw = os.read(self.fd, READ_SIZE)
+                data = self.decoder.decode(raw, not raw)
+            except Exception as e:
+                raw = b""
+                data = e
+            with self.lock:
+                if generation != self.generation:
+                    # A seek occurred - discard data
+                    continue
+                pos += len(raw)
+                if raw and not data:
+                    # Partial multi-byte character
+                    continue
+                self.chunks.append(data)
+                self.is_eof = not raw
+                waiter = self.waiter
+                self.waiter = None
+            if waiter is not None:
+                self.reactor.async_complete(waiter, None)
+        os.close(self.fd)
+
+
+######################################################################
+# G-Code file index
+######################################################################
+
+INDEX_VERSION = 1
+INDEX_BLOCK_SIZE = 65536
+
+index_r = re.compile(br'^(?:(?P<layer>;LAYER_CHANGE|;LAYER:'
+                     br'|SET_PRINT_STATS_INFO[^\n]*CURRENT_LAYER=)'
+                     br'|(?P<object>EXCLUDE_OBJECT_DEFINE[^\n]*)'
+                     br'|;TIME:(?P<time>[0-9.]+)'
+                     br'|; estimated printing time[^=\n]*=(?P<ptime>[^\n]*))',
+                     re.M)
+duration_r = re.compile(r'([0-9.]+)\s*([dhms])')
+object_name_r = re.compile(r'NAME=(\S+)', re.I)
+
+# Scan a g-code file and return a dictionary describing its layout
+def build_file_index(filename, st):
+    checkpoints = []
+    layers = {}
+    objects = []
+    estimated_time = None
+    with open(filename, 'rb') as f:
+        offset = line_num = 0
+        partial = b''
+        while 1:
+            data = f.read(INDEX_BLOCK_SIZE)
+            if not data:
+                break
+            data = partial + data
+            end = data.rfind(b'\n') + 1
+            if not end:
+                partial = data
+                continue
+            block, partial = data[:end], data[end:]
+            # Note line number of first line in block
+            checkpoints.append((line_num, offset))
+            for m in index_r.finditer(block):
+                if m.group('layer') is not None:
+                    layers.setdefault(m.group('layer')[:9], []).append(
+                        offset + m.start())
+                elif m.group('object') is not None:
+                    objects.append((offset + m.start(),
+                                    m.group('object').decode().strip()))
+                elif m.group('time') is not None:
+                    estimated_time = float(m.group('time'))
+                elif estimated_time is None:
+                    mult = {'d': 86400., 'h': 3600., 'm': 60., 's': 1.}
+                    estimated_time = sum(
+                        float(v) * mult[u] for v, u in duration_r.findall(
+                            m.group('ptime').decode()))
+            line_num += block.count(b'\n')
+            offset += end
+    if partial:
+        line_num += 1
+    # Only use one type of layer marker (in order of preference)
+    layer_offsets = []
+    for marker in [b';LAYER_CH', b';LAYER:', b'SET_PRINT']:
+        if marker in layers:
+            layer_offsets = layers[marker]
+            break
+    return {'version': INDEX_VERSION, 'size': st.st_size,
+            'mtime': st.st_mtime, 'line_count': line_num,
+            'checkpoints': checkpoints, 'layers': layer_offsets,
+            'objects': objects, 'estimated_time': estimated_time}
+
+# Load a file index from its cache file (or build and cache a new index)
+def load_file_index(filename):
+    st = os.stat(filename)
+    dirname, basename = os.path.split(filename)
+    index_filename = os.path.join(dirname, '.' + basename + '.index')
+    try:
+        with open(index_filename, 'r') as f:
+            index = json.load(f)
+        if (index.get('version') == INDEX_VERSION
+            and index.get('size') == st.st_size
+            and index.get('mtime') == st.st_mtime):
+            return index
+    except (IOError, OSError, ValueError):
+        pass
+    index = build_file_index(filename, st)
+    try:
+        temp_filename = index_filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.rename(temp_filename, index_filename)
+    except (IOError, OSError):
+        logging.info("virtual_sdcard: unable to write index file %s",
+                     index_filename)
+    return index
+
+
+######################################################################
+# Virtual sdcard
+######################################################################
+
 class VirtualSD:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -21,6 +231,12 @@ class VirtualSD:
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
         self.current_file = None
         self.file_position = self.file_size = 0
+        self.read_ahead_window = config.getint('read_ahead_window', 0,
+                                               minval=0)
+        self.index_files = config.getboolean('index_files', False)
+        self.file_index = None
+        self.file_index_objects = []
+        self.reader = None
         # Print Stat Tracking
         self.print_stats = self.printer.load_object(config, 'print_stats')
         # Work timer
@@ -28,6 +244,8 @@ class VirtualSD:
         self.must_pause_work = self.cmd_from_sd = False
         self.next_file_position = 0
         self.work_timer = None
+        self.lines_processed = self.last_stats_lines = 0
+        self.last_stats_time = 0.
         # Error handling
         gcode_macro = self.printer.load_object(config, 'gcode_macro')
         self.on_error_gcode = gcode_macro.load_template(
@@ -44,6 +262,9 @@ class VirtualSD:
         self.gcode.register_command(
             "SDCARD_PRINT_FILE", self.cmd_SDCARD_PRINT_FILE,
             desc=self.cmd_SDCARD_PRINT_FILE_help)
+        self.gcode.register_command(
+            "SDCARD_SEEK", self.cmd_SDCARD_SEEK,
+            desc=self.cmd_SDCARD_SEEK_help)
         self.printer.register_event_handler("klippy:analyze_shutdown",
                                             self._handle_analyze_shutdown)
     def _handle_analyze_shutdown(self, msg, details):
@@ -61,9 +282,16 @@ class VirtualSD:
                          readpos, repr(data[:readcount]),
                          self.file_position, repr(data[readcount:]))
     def stats(self, eventtime):
-        if self.work_timer is None:
+        lines = self.lines_processed - self.last_stats_lines
+        elapsed = eventtime - self.last_stats_time
+        self.last_stats_lines = self.lines_processed
+        self.last_stats_time = eventtime
+        if self.work_timer is None or self.reader is None:
             return False, ""
-        return True, "sd_pos=%d" % (self.file_position,)
+        max_stall = self.reader.max_stall
+        self.reader.max_stall = 0.
+        return True, "sd_pos=%d sd_lines_per_sec=%.0f sd_read_stall=%.6f" % (
+            self.file_position, lines / max(elapsed, .001), max_stall)
     def get_file_list(self, check_subdirs=False):
         if check_subdirs:
             flist = []
@@ -96,7 +324,60 @@ class VirtualSD:
             'is_active': self.is_active(),
             'file_position': self.file_position,
             'file_size': self.file_size,
+            'file_index': self._get_index_status(),
+        }
+    # File index handling
+    def _start_file_index(self, filename):
+        self.file_index = None
+        if not self.index_files:
+            return
+        def bg_build_index():
+            try:
+                index = load_file_index(filename)
+            except:
+                logging.exception("virtual_sdcard index %s", filename)
+                return
+            self.reactor.register_async_callback(
+                (lambda e: self._set_file_index(filename, index)))
+        bg_thread = threading.Thread(target=bg_build_index)
+        bg_thread.daemon = True
+        bg_thread.start()
+    def _set_file_index(self, filename, index):
+        if self.file_path() != filename or index['size'] != self.file_size:
+            # File changed while index was being built
+            return
+        self.file_index = index
+        self.file_index_objects = [
+            m.group(1).upper() for m in [object_name_r.search(line)
+                                         for offset, line in index['objects']]
+            if m is not None]
+        logging.info("virtual_sdcard: indexed %s (%d lines, %d layers)",
+                     filename, index['line_count'], len(index['layers']))
+    def _get_index_status(self):
+        index = self.file_index
+        if index is None or self.current_file is None:
+            return None
+        layer = bisect.bisect_right(index['layers'], self.file_position)
+        return {
+            'line_count': index['line_count'],
+            'layer_count': len(index['layers']),
+            'current_layer': layer,
+            'estimated_time': index['estimated_time'],
+            'objects': self.file_index_objects,
         }
+    def _find_line_position(self, line_num):
+        checkpoints = self.file_index['checkpoints']
+        pos = bisect.bisect_right([cp[0] for cp in checkpoints], line_num)
+        if not pos:
+            return 0
+        cp_line, offset = checkpoints[pos - 1]
+        # Scan forward from the checkpoint to the requested line
+        with open(self.file_path(), 'rb') as f:
+            f.seek(offset)
+            for i in range(line_num - cp_line):
+                if not f.readline():
+                    break
+            return f.tell()
     def file_path(self):
         if self.current_file:
             return self.current_file.name
@@ -135,6 +416,7 @@ class VirtualSD:
             self.current_file.close()
             self.current_file = None
         self.file_position = self.file_size = 0
+        self.file_index = None
         self.print_stats.reset()
         self.printer.send_event("virtual_sdcard:reset_file")
     cmd_SDCARD_RESET_FILE_help = "Clears a loaded SD File. Stops the print "\
@@ -155,6 +437,24 @@ class VirtualSD:
             filename = filename[1:]
         self._load_file(gcmd, filename, check_subdirs=True)
         self.do_resume()
+    cmd_SDCARD_SEEK_help = "Set the position of a loaded SD file to the" \
+        " start of a given layer or line"
+    def cmd_SDCARD_SEEK(self, gcmd):
+        if self.work_timer is not None:
+            raise gcmd.error("SD busy")
+        if self.file_index is None:
+            raise gcmd.error("File index not available")
+        layer = gcmd.get_int('LAYER', None, minval=1)
+        if layer is not None:
+            layers = self.file_index['layers']
+            if layer > len(layers):
+                raise gcmd.error("File has only %d layers" % (len(layers),))
+            pos = layers[layer - 1]
+        else:
+            line_num = gcmd.get_int('LINE', minval=1)
+            pos = self._find_line_position(line_num - 1)
+        self.file_position = pos
+        gcmd.respond_info("SD position set to %d" % (pos,))
     def cmd_M20(self, gcmd):
         # List SD card
         files = self.get_file_list()
@@ -196,6 +496,7 @@ class VirtualSD:
         self.file_position = 0
         self.file_size = fsize
         self.print_stats.set_current_file(filename)
+        self._start_file_index(fname)
     def cmd_M24(self, gcmd):
         # Start/resume SD print
         self.do_resume()
@@ -222,15 +523,46 @@ class VirtualSD:
     def is_cmd_from_sd(self):
         return self.cmd_from_sd
     # Background work timer
+    def _dispatch_batch(self, lines, gcode_mutex):
+        # Run consecutive lines from the file without releasing the gcode
+        # mutex between them.  The batch ends early if a pause is
+        # requested, another task is waiting on the mutex, or a command
+        # changes the file position.  Returns True if a seek is needed.
+        run_script = self.gcode.run_script_from_command
+        for i in range(BATCH_LINES):
+            line = lines.pop()
+            if sys.version_info.major >= 3:
+                next_file_position = self.file_position + len(line.encode()) + 1
+            else:
+                next_file_position = self.file_position + len(line) + 1
+            self.next_file_position = next_file_position
+            run_script(line)
+            self.lines_processed += 1
+            self.file_position = self.next_file_position
+            if self.next_file_position != next_file_position:
+                return True
+            if (not lines or self.must_pause_work
+                or gcode_mutex.has_waiters()):
+                break
+        return False
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
+        reader = None
         try:
-            self.current_file.seek(self.file_position)
+            if self.read_ahead_window:
+                reader = ReadAheadReader(self.reactor, self.current_file,
+                                         self.read_ahead_window)
+            else:
+                reader = FileReader(self.reactor, self.current_file)
+            reader.seek(self.file_position)
         except:
             logging.exception("virtual_sdcard seek")
+            if reader is not None:
+                reader.close()
             self.work_timer = None
             return self.reactor.NEVER
+        self.reader = reader
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
         partial_input = ""
@@ -240,7 +572,7 @@ class VirtualSD:
             if not lines:
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    data = reader.read()
                 except:
                     logging.exception("virtual_sdcard read")
                     break
@@ -261,16 +593,11 @@ class VirtualSD:
             if gcode_mutex.test():
                 self.reactor.pause(self.reactor.monotonic() + 0.050)
                 continue
-            # Dispatch command
+            # Dispatch commands
             self.cmd_from_sd = True
-            line = lines.pop()
-            if sys.version_info.major >= 3:
-                next_file_position = self.file_position + len(line.encode()) + 1
-            else:
-                next_file_position = self.file_position + len(line) + 1
-            self.next_file_position = next_file_position
             try:
-                self.gcode.run_script(line)
+                with gcode_mutex:
+                    need_seek = self._dispatch_batch(lines, gcode_mutex)
             except self.gcode.error as e:
                 error_message = str(e)
                 try:
@@ -282,18 +609,21 @@ class VirtualSD:
                 logging.exception("virtual_sdcard dispatch")
                 break
             self.cmd_from_sd = False
-            self.file_position = self.next_file_position
             # Do we need to skip around?
-            if self.next_file_position != next_file_position:
+            if need_seek:
                 try:
-                    self.current_file.seek(self.file_position)
+                    reader.seek(self.file_position)
                 except:
                     logging.exception("virtual_sdcard seek")
+                    reader.close()
+                    self.reader = None
                     self.work_timer = None
                     return self.reactor.NEVER
                 lines = []
                 partial_input = ""
         logging.info("Exiting SD card print (position %d)", self.file_position)
+        reader.close()
+        self.reader = None
         self.work_timer = None
         self.cmd_from_sd = False
         if error_message is not None:
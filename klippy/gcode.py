@@ -199,23 +199,35 @@ class GCodeDispatch:
         self._respond_state("Ready")
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*])')
+    # Upper case "traditional" commands with only single letter numeric
+    # parameters (eg, "G1 X10 Y20 E.5") may be split on whitespace.  This
+    # produces the same result as args_r parsing, but at much lower cost.
+    simple_r = re.compile(r'[GM][0-9]+(?: +[A-Z][-+.0-9]*)* *$')
+    def _parse_line(self, line):
+        # Ignore comments
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        if self.simple_r.match(line) is not None:
+            words = line.split()
+            return words[0], { w[0]: w[1:] for w in words }
+        # Break line into parts and determine command
+        parts = self.args_r.split(line.upper())
+        if ''.join(parts[:2]) == 'N':
+            # Skip line number at start of command
+            cmd = ''.join(parts[3:5]).strip()
+        else:
+            cmd = ''.join(parts[:3]).strip()
+        # Build gcode "params" dictionary
+        params = { parts[i]: parts[i+1].strip()
+                   for i in range(1, len(parts), 2) }
+        return cmd, params
     def _process_commands(self, commands, need_ack=True):
+        parse_line = self._parse_line
         for line in commands:
-            # Ignore comments and leading/trailing spaces
-            line = origline = line.strip()
-            cpos = line.find(';')
-            if cpos >= 0:
-                line = line[:cpos]
-            # Break line into parts and determine command
-            parts = self.args_r.split(line.upper())
-            if ''.join(parts[:2]) == 'N':
-                # Skip line number at start of command
-                cmd = ''.join(parts[3:5]).strip()
-            else:
-                cmd = ''.join(parts[:3]).strip()
-            # Build gcode "params" dictionary
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(1, len(parts), 2) }
+            # Ignore leading/trailing spaces
+            origline = line.strip()
+            cmd, params = parse_line(origline)
             gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
             # Invoke handler for command
             handler = self.gcode_handlers.get(cmd, self.cmd_default)
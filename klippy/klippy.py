@@ -5,7 +5,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, os, gc, optparse, logging, time, collections, importlib
-import util, reactor, queuelogger, msgproto
+import util, reactor, queuelogger, msgproto, chelper
 import gcode, configfile, pins, mcu, toolhead, webhooks
 
 message_ready = "Printer is ready"
@@ -35,6 +35,11 @@ class Printer:
         self.run_result = None
         self.event_handlers = {}
         self.objects = collections.OrderedDict()
+        self.startup_timeline = []
+        self.startup_last_time = 0.
+        self.import_times = []
+        self.init_times = []
+        self.load_nested_time = 0.
         # Init printer components that must be setup prior to config
         for m in [gcode, webhooks]:
             m.add_early_printer_objects(self)
@@ -100,7 +105,15 @@ class Printer:
             if default is not configfile.sentinel:
                 return default
             raise self.config_error("Unable to load module '%s'" % (section,))
-        mod = importlib.import_module('extras.' + module_name)
+        # Track module import time (only the first import of a module
+        # has a cost; it includes the modules it imports)
+        mod_name = 'extras.' + module_name
+        is_imported = mod_name in sys.modules
+        load_start = self.reactor.monotonic()
+        mod = importlib.import_module(mod_name)
+        import_time = self.reactor.monotonic() - load_start
+        if not is_imported:
+            self.import_times.append((import_time, mod_name))
         init_func = 'load_config'
         if len(module_parts) > 1:
             init_func = 'load_config_prefix'
@@ -109,13 +122,37 @@ class Printer:
             if default is not configfile.sentinel:
                 return default
             raise self.config_error("Unable to load module '%s'" % (section,))
+        outer_nested_time = self.load_nested_time
         self.objects[section] = init_func(config.getsection(section))
+        # Track init time (excluding other objects loaded during init)
+        load_time = self.reactor.monotonic() - load_start
+        nested_time = self.load_nested_time - outer_nested_time
+        self.init_times.append((load_time - import_time - nested_time,
+                                section))
+        self.load_nested_time = outer_nested_time + load_time
         return self.objects[section]
+    def _note_startup_phase(self, phase):
+        curtime = self.reactor.monotonic()
+        self.startup_timeline.append((phase, curtime - self.startup_last_time))
+        self.startup_last_time = curtime
+    def _log_startup_timeline(self):
+        timeline = self.startup_timeline
+        logging.info("Startup timeline: %s total=%.3fs",
+                     " ".join(["%s=%.3fs" % (p, t) for p, t in timeline]),
+                     sum([t for p, t in timeline]))
+        # Report slowest module imports and object inits
+        for desc, times in [("imports", self.import_times),
+                            ("inits", self.init_times)]:
+            slowest = sorted(times, reverse=True)[:10]
+            logging.info("Slowest module %s: %s total=%.3fs", desc,
+                         " ".join(["%s=%.3fs" % (n, t) for t, n in slowest]),
+                         sum([t for t, n in times]))
     def _read_config(self):
         self.objects['configfile'] = pconfig = configfile.PrinterConfig(self)
         config = pconfig.read_main_config()
         if self.bglogger is not None:
             pconfig.log_config(config)
+        self._note_startup_phase("config")
         # Create printer components
         for m in [pins, mcu]:
             m.add_printer_objects(config)
@@ -125,14 +162,21 @@ class Printer:
             m.add_printer_objects(config)
         # Validate that there are no undefined parameters in the config file
         pconfig.check_unused_options(config)
+        self._note_startup_phase("objects")
     def _connect(self, eventtime):
+        self.startup_last_time = self.reactor.monotonic()
         try:
             self._read_config()
+            self.send_event_parallel("klippy:mcu_attach")
             self.send_event("klippy:mcu_identify")
+            self._note_startup_phase("mcu_identify")
+            self.send_event_parallel("klippy:mcu_configure")
+            self._note_startup_phase("mcu_configure")
             for cb in self.event_handlers.get("klippy:connect", []):
                 if self.state_message is not message_startup:
                     return
                 cb()
+            self._note_startup_phase("connect")
         except (self.config_error, pins.error) as e:
             logging.exception("Config error")
             self._set_state("%s\n%s" % (str(e), message_restart))
@@ -163,6 +207,8 @@ class Printer:
                     if self.state_message is not message_ready:
                         return
                     cb()
+            self._note_startup_phase("ready")
+            self._log_startup_timeline()
         except Exception as e:
             logging.exception("Unhandled exception during ready callback")
             self.invoke_shutdown("Internal error during ready callback: %s"
@@ -225,6 +271,22 @@ class Printer:
         self.event_handlers.setdefault(event, []).append(callback)
     def send_event(self, event, *params):
         return [cb(*params) for cb in self.event_handlers.get(event, [])]
+    def send_event_parallel(self, event, *params):
+        # Run each handler in its own reactor greenlet (so that handlers
+        # waiting on different mcus overlap) and wait for all to finish
+        def run_handler(cb):
+            try:
+                return cb(*params), None
+            except Exception as e:
+                return None, e
+        completions = [
+            self.reactor.register_callback((lambda e, cb=cb: run_handler(cb)))
+            for cb in self.event_handlers.get(event, [])]
+        results = [completion.wait() for completion in completions]
+        for res, exc in results:
+            if exc is not None:
+                raise exc
+        return [res for res, exc in results]
     def request_exit(self, result):
         if self.run_result is None:
             self.run_result = result
@@ -278,9 +340,15 @@ def main():
     opts.add_option("-d", "--dictionary", dest="dictionary", type="string",
                     action="callback", callback=arg_dictionary,
                     help="file to read for mcu protocol dictionary")
+    opts.add_option("--chelper-variant", dest="chelper_variant",
+                    type="choice", choices=['generic', 'native', 'auto'],
+                    default='generic',
+                    help="C helper build: generic, native, or auto"
+                    " (benchmark and select the fastest)")
     opts.add_option("--import-test", action="store_true",
                     help="perform an import module test")
     options, args = opts.parse_args()
+    chelper.set_build_variant(options.chelper_variant)
     if options.import_test:
         import_test()
     if len(args) != 1:
@@ -130,22 +130,59 @@ class CommandWrapper:
 
 # Wrapper for long-lived serial subscriptions (callbacks via background thread)
 class AsyncResponseWrapper:
-    def __init__(self, conn_helper, cfg_helper, callback, msgformat, oid=None):
+    def __init__(self, conn_helper, cfg_helper, callback, msgformat, oid=None,
+                 is_raw=False):
         self._serial = conn_helper.get_serial()
         self._callback = callback
         self._msgformat = msgformat
         self._name = msgformat.split()[0]
         self._oid = oid
+        self._is_raw = is_raw
+        self._parse = None
         if cfg_helper.is_config_finalized():
             self._register()
         else:
             self._serial.register_response((lambda p: None), self._name, oid)
             cfg_helper.register_post_init_callback(self._register)
     def _register(self):
-        self._serial.get_msgparser().lookup_command(self._msgformat)
-        self._serial.register_response(self._callback, self._name, self._oid)
+        mp = self._serial.get_msgparser().lookup_command(self._msgformat)
+        self._parse = mp.parse
+        if self._is_raw:
+            self._serial.register_raw_response(self._callback,
+                                               self._msgformat, self._oid)
+        else:
+            self._serial.register_response(self._callback, self._name,
+                                           self._oid)
     def unregister(self):
-        self._serial.register_response(None, self._name, self._oid)
+        if self._is_raw:
+            self._serial.register_raw_response(None, self._msgformat,
+                                               self._oid)
+        else:
+            self._serial.register_response(None, self._name, self._oid)
+    def parse_raw(self, msg):
+        # Decode a message block passed to an is_raw callback
+        return self._parse(msg, msgproto.MESSAGE_HEADER_SIZE)[0]
+
+
+# Wrapper for bulk sensor messages stored in a C ring buffer
+class BulkQueueWrapper:
+    def __init__(self, conn_helper, cfg_helper, msgformat, oid, size):
+        self._serial = conn_helper.get_serial()
+        self._msgformat = msgformat
+        self._oid = oid
+        self._bulkqueue = self._serial.alloc_bulk_queue(size)
+        if cfg_helper.is_config_finalized():
+            self._register()
+        else:
+            name = msgformat.split()[0]
+            self._serial.register_response((lambda p: None), name, oid)
+            cfg_helper.register_post_init_callback(self._register)
+    def _register(self):
+        self._serial.get_msgparser().lookup_command(self._msgformat)
+        self._serial.setup_bulk_queue(self._bulkqueue, self._msgformat,
+                                      self._oid)
+    def get_bulkqueue(self):
+        return self._bulkqueue
 
 
 ######################################################################
@@ -789,11 +826,13 @@ class MCUConnectHelper:
             if not (self._serialport.startswith("/dev/rpmsg_")
                     or self._serialport.startswith("/tmp/klipper_host_")):
                 self._baud = config.getint('baud', 250000, minval=2400)
+        self._attach_start_time = self._attach_duration = 0.
         # Shutdown tracking
         self._emergency_stop_cmd = None
         self._is_shutdown = self._is_timeout = False
         self._shutdown_msg = ""
         # Register handlers
+        printer.register_event_handler("klippy:mcu_attach", self._mcu_attach)
         printer.register_event_handler("klippy:mcu_identify",
                                        self._mcu_identify)
         self._restart_helper = MCURestartHelper(config, self)
@@ -810,6 +849,10 @@ class MCUConnectHelper:
         return self._serialport, self._baud
     def get_restart_helper(self):
         return self._restart_helper
+    def get_attach_start_time(self):
+        return self._attach_start_time
+    def get_attach_duration(self):
+        return self._attach_duration
     def _handle_shutdown(self, params):
         if self._is_shutdown:
             return
@@ -869,11 +912,15 @@ class MCUConnectHelper:
             self._clocksync.connect(self._serial)
         except serialhdl.error as e:
             raise error(str(e))
-    def _mcu_identify(self):
+    def _mcu_attach(self):
+        self._attach_start_time = self._reactor.monotonic()
         if self._mcu.is_fileoutput():
             self._attach_file()
         else:
             self._attach()
+        self._attach_duration = (self._reactor.monotonic()
+                                 - self._attach_start_time)
+    def _mcu_identify(self):
         logging.info(self.log_info())
         # Setup shutdown handling
         self._emergency_stop_cmd = self._mcu.lookup_command("emergency_stop")
@@ -1000,7 +1047,7 @@ class MCUConfigHelper:
         printer.lookup_object('pins').register_chip(self._name, mcu)
         printer.register_event_handler("klippy:mcu_identify",
                                        self._mcu_identify)
-        printer.register_event_handler("klippy:connect", self._connect)
+        printer.register_event_handler("klippy:mcu_configure", self._connect)
     def _finalize_config(self):
         # Build config commands
         for cb in self._config_callbacks:
@@ -1019,9 +1066,10 @@ class MCUConfigHelper:
         self._config_crc = zlib.crc32(encoded_config) & 0xffffffff
         self._config_cmds.append("finalize_config crc=%d" % (self._config_crc,))
     def _send_cfg_init_commands(self, cmds):
+        # Queue all commands at once - the serialqueue keeps a window of
+        # blocks in flight (and handles retransmits) during the upload
         try:
-            for c in cmds:
-                self._serial.send(c)
+            self._serial.send_multi(cmds)
         except msgproto.enumeration_error as e:
             enum_name, enum_value = e.get_enum_params()
             if enum_name == 'pin':
@@ -1046,6 +1094,7 @@ class MCUConfigHelper:
         return config_params
     def _connect(self):
         # Finalize the config and check if a restart is needed
+        connect_time = self._reactor.monotonic()
         restart_helper = self._conn_helper.get_restart_helper()
         config_params = self._send_get_config()
         if not config_params['is_config']:
@@ -1068,8 +1117,11 @@ class MCUConfigHelper:
                             % (self._name,))
             cfg_init_cmds = self._restart_cmds + self._init_cmds
         # Send config and init messages
+        upload_time = self._reactor.monotonic()
         self._send_cfg_init_commands(cfg_init_cmds)
         config_params = self._send_get_config()
+        curtime = self._reactor.monotonic()
+        upload_time = curtime - upload_time
         if not config_params['is_config'] and not self._mcu.is_fileoutput():
             raise error("Unable to configure MCU '%s'" % (self._name,))
         # Run post_init callbacks
@@ -1086,6 +1138,11 @@ class MCUConfigHelper:
         # Log config information
         move_msg = "Configured MCU '%s' (%d moves)" % (self._name, move_count)
         logging.info(move_msg)
+        logging.info("MCU '%s' ready in %.3fs (attach=%.3fs config=%.3fs"
+                     " upload=%.3fs for %d commands)", self._name,
+                     curtime - self._conn_helper.get_attach_start_time(),
+                     self._conn_helper.get_attach_duration(),
+                     curtime - connect_time, upload_time, len(cfg_init_cmds))
         log_info = self._conn_helper.log_info() + "\n" + move_msg
         self._printer.set_rollover_info(self._name, log_info, log=False)
     def _mcu_identify(self):
@@ -1201,9 +1258,12 @@ class MCU:
             return None
     def alloc_command_queue(self):
         return self._serial.alloc_command_queue()
-    def register_serial_response(self, cb, msg, oid=None):
+    def register_serial_response(self, cb, msg, oid=None, is_raw=False):
         return AsyncResponseWrapper(self._conn_helper, self._config_helper,
-                                    cb, msg, oid)
+                                    cb, msg, oid, is_raw)
+    def alloc_bulk_queue(self, msgformat, oid, size):
+        return BulkQueueWrapper(self._conn_helper, self._config_helper,
+                                msgformat, oid, size)
     def check_valid_response(self, msgformat):
         try:
             self._serial.get_msgparser().lookup_command(msgformat)
@@ -159,6 +159,65 @@ def convert_msg_format(msgformat):
         msgformat = msgformat.replace(c, '%s')
     return msgformat
 
+# Generate python code to encode/decode an integer parameter
+def _gen_int_encode(var):
+    return [
+        "if %s >= 0x60 or %s < -0x20:" % (var, var),
+        " if %s >= 0x3000 or %s < -0x1000:" % (var, var),
+        "  if %s >= 0x180000 or %s < -0x80000:" % (var, var),
+        "   if %s >= 0xc000000 or %s < -0x4000000:" % (var, var),
+        "    out.append((%s>>28) & 0x7f | 0x80)" % (var,),
+        "   out.append((%s>>21) & 0x7f | 0x80)" % (var,),
+        "  out.append((%s>>14) & 0x7f | 0x80)" % (var,),
+        " out.append((%s>>7) & 0x7f | 0x80)" % (var,),
+        "out.append(%s & 0x7f)" % (var,)]
+
+def _gen_int_parse(var, signed):
+    res = "v" if signed else "int(v & 0xffffffff)"
+    return [
+        "c = s[pos]",
+        "pos += 1",
+        "if c < 0x60:",
+        " %s = c" % (var,),
+        "else:",
+        " v = c & 0x7f",
+        " if (c & 0x60) == 0x60:",
+        "  v |= -0x20",
+        " while c & 0x80:",
+        "  c = s[pos]",
+        "  pos += 1",
+        "  v = (v<<7) | (c & 0x7f)",
+        " %s = %s" % (var, res)]
+
+# Build specialized encode() and parse() functions for a message format
+def compile_format(msgid_bytes, param_names):
+    ns = {}
+    enc = ["def encode(params):", " out = %s" % (list(msgid_bytes),)]
+    dec = ["def parse(s, pos):", " pos += %d" % (len(msgid_bytes),)]
+    out_vars = []
+    for i, (name, t) in enumerate(param_names):
+        var = "v%d" % (i,)
+        out_vars.append("%s: %s" % (repr(name), var))
+        enc.append(" %s = params[%d]" % (var, i))
+        if type(t) in (PT_uint32, PT_int32, PT_uint16, PT_int16, PT_byte):
+            enc.extend([" " + l for l in _gen_int_encode(var)])
+            dec.extend([" " + l for l in _gen_int_parse(var, t.signed)])
+        elif t.is_dynamic_string:
+            enc.extend([" out.append(len(%s))" % (var,),
+                        " out.extend(bytearray(%s))" % (var,)])
+            dec.extend([" l = s[pos]",
+                        " %s = bytes(bytearray(s[pos+1:pos+l+1]))" % (var,),
+                        " pos += l + 1"])
+        else:
+            # Enumerations (and any other type) use the type's methods
+            ns['t%d' % (i,)] = t
+            enc.append(" t%d.encode(out, %s)" % (i, var))
+            dec.append(" %s, pos = t%d.parse(s, pos)" % (var, i))
+    enc.append(" return out")
+    dec.append(" return {%s}, pos" % (", ".join(out_vars),))
+    exec("\n".join(enc + dec), ns)
+    return ns['encode'], ns['parse']
+
 class MessageFormat:
     def __init__(self, msgid_bytes, msgformat, enumerations={}):
         self.msgid_bytes = msgid_bytes
@@ -168,23 +227,11 @@ class MessageFormat:
         self.param_names = lookup_params(msgformat, enumerations)
         self.param_types = [t for name, t in self.param_names]
         self.name_to_type = dict(self.param_names)
-    def encode(self, params):
-        out = list(self.msgid_bytes)
-        for i, t in enumerate(self.param_types):
-            t.encode(out, params[i])
-        return out
+        # encode(params) and parse(s, pos) are generated per message
+        self.encode, self.parse = compile_format(msgid_bytes,
+                                                 self.param_names)
     def encode_by_name(self, **params):
-        out = list(self.msgid_bytes)
-        for name, t in self.param_names:
-            t.encode(out, params[name])
-        return out
-    def parse(self, s, pos):
-        pos += len(self.msgid_bytes)
-        out = {}
-        for name, t in self.param_names:
-            v, pos = t.parse(s, pos)
-            out[name] = v
-        return out, pos
+        return self.encode([params[name] for name, t in self.param_names])
     def format_params(self, params):
         out = []
         for name, t in self.param_names:
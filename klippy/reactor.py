@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2025  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, queue
+import os, gc, select, math, time, logging, queue, heapq, bisect
 import greenlet
 import chelper, util
 
@@ -18,6 +18,8 @@ class ReactorTimer:
         self.callback = callback
         self.waketime = waketime
         self.timer_is_running = False
+        self.timer_seq = None
+        self.profile_key = None
 
 class ReactorCompletion:
     class sentinel: pass
@@ -58,6 +60,7 @@ class ReactorFileHandler:
         self.fd = fd
         self.read_callback = read_callback
         self.write_callback = write_callback
+        self.profile_keys = None
 
 class ReactorGreenlet(greenlet.greenlet):
     def __init__(self, run):
@@ -74,6 +77,8 @@ class ReactorMutex:
         self.unlock = self.__exit__
     def test(self):
         return self.is_locked
+    def has_waiters(self):
+        return not not self.queue
     def __enter__(self):
         if not self.is_locked:
             self.is_locked = True
@@ -101,6 +106,63 @@ class ReactorPreventPause:
     def __exit__(self, type=None, value=None, tb=None):
         self.reactor._prevent_pause_count -= 1
 
+# Optional tracking of callback run time and timer lateness
+class ReactorProfile:
+    BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005,
+               0.010, 0.020, 0.050, 0.100, 0.200, 0.500)
+    def __init__(self, slow_time):
+        self.slow_time = slow_time
+        self.run_histogram = [0] * (len(self.BUCKETS) + 1)
+        self.late_histogram = [0] * (len(self.BUCKETS) + 1)
+        # callbacks = {key: [count, total_time, max_time, max_late, slow]}
+        self.callbacks = {}
+        self.interval_slow = {}
+        self.interval_max = (0., None)
+        self.interval_max_late = (0., None)
+    def note_callback(self, key, run_time, late):
+        info = self.callbacks.get(key)
+        if info is None:
+            info = self.callbacks[key] = [0, 0., 0., 0., 0]
+        if run_time is not None:
+            self.run_histogram[bisect.bisect(self.BUCKETS, run_time)] += 1
+            info[0] += 1
+            info[1] += run_time
+            info[2] = max(info[2], run_time)
+            if run_time >= self.slow_time:
+                info[4] += 1
+                self.interval_slow[key] = self.interval_slow.get(key, 0) + 1
+            if run_time > self.interval_max[0]:
+                self.interval_max = (run_time, key)
+        if late is not None:
+            self.late_histogram[bisect.bisect(self.BUCKETS, late)] += 1
+            info[3] = max(info[3], late)
+            if late > self.interval_max_late[0]:
+                self.interval_max_late = (late, key)
+    def reset_interval(self):
+        res = (self.interval_max, self.interval_max_late, self.interval_slow)
+        self.interval_slow = {}
+        self.interval_max = self.interval_max_late = (0., None)
+        return res
+
+# Determine a descriptive name for a callback (used when profiling)
+def lookup_callback_name(callback):
+    obj = getattr(callback, '__self__', None)
+    if isinstance(obj, ReactorCallback):
+        callback = obj.callback
+        obj = getattr(callback, '__self__', None)
+    code = getattr(getattr(callback, '__func__', callback), '__code__', None)
+    if code is None:
+        name = getattr(callback, '__name__', '?')
+        if obj is not None:
+            name = "%s.%s" % (type(obj).__name__, name)
+        return name
+    qualname = getattr(code, 'co_qualname', code.co_name)
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    if qualname.endswith('>'):
+        # Lambda or similar - note the line number
+        return "%s:%s:%d" % (module, qualname, code.co_firstlineno)
+    return "%s:%s" % (module, qualname)
+
 class SelectReactor:
     NOW = _NOW
     NEVER = _NEVER
@@ -111,9 +173,14 @@ class SelectReactor:
         # Python garbage collection
         self._check_gc = gc_checking
         self._last_gc_times = [0., 0., 0.]
-        # Timers
-        self._timers = []
+        # Timers - a heap of (waketime, seq, timer) entries.  Entries are
+        # invalidated (instead of removed) when a timer is updated.
+        self._timer_heap = []
+        self._timer_adds = []
+        self._timer_seq = 0
+        self._timer_count = 0
         self._next_timer = self.NEVER
+        self._profile = None
         # Callbacks
         self._pipe_fds = None
         self._async_queue = queue.Queue()
@@ -132,24 +199,59 @@ class SelectReactor:
         self._prevent_pause_count = 0
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
+    # Callback profiling
+    def enable_profile(self, slow_time):
+        if self._profile is None:
+            self._profile = ReactorProfile(slow_time)
+        return self._profile
+    def _profile_callback(self, callback, key, eventtime, waketime):
+        g_dispatch = self._g_dispatch
+        start_time = self.monotonic()
+        res = callback(eventtime)
+        run_time = self.monotonic() - start_time
+        if g_dispatch is not self._g_dispatch:
+            # Callback paused - run time not known
+            run_time = None
+        late = None
+        if waketime > self.NOW:
+            late = max(0., start_time - waketime)
+        self._profile.note_callback(key, run_time, late)
+        return res
     # Timers
+    def _schedule_timer(self, timer_handler, waketime):
+        timer_handler.waketime = waketime
+        self._timer_seq += 1
+        timer_handler.timer_seq = seq = self._timer_seq
+        if waketime < self.NEVER:
+            # New entries are added to the heap on the next _check_timers()
+            self._timer_adds.append((waketime, seq, timer_handler))
+            self._next_timer = min(self._next_timer, waketime)
+    def _merge_timer_adds(self):
+        heap = self._timer_heap
+        adds = self._timer_adds
+        self._timer_adds = []
+        if len(heap) + len(adds) > 4 * self._timer_count + 64:
+            # Discard invalidated entries
+            heap[:] = [e for e in heap + adds if e[2].timer_seq == e[1]]
+            heapq.heapify(heap)
+            return
+        for entry in adds:
+            heapq.heappush(heap, entry)
     def update_timer(self, timer_handler, waketime):
-        if timer_handler.timer_is_running:
+        if timer_handler.timer_is_running or timer_handler.timer_seq is None:
             return
-        timer_handler.waketime = waketime
-        self._next_timer = min(self._next_timer, waketime)
+        self._schedule_timer(timer_handler, waketime)
     def register_timer(self, callback, waketime=NEVER):
         timer_handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
-        self._next_timer = min(self._next_timer, waketime)
+        self._timer_count += 1
+        self._schedule_timer(timer_handler, waketime)
         return timer_handler
     def unregister_timer(self, timer_handler):
+        if timer_handler.timer_seq is None:
+            raise ValueError("Timer not registered")
         timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
-        timers.pop(timers.index(timer_handler))
-        self._timers = timers
+        timer_handler.timer_seq = None
+        self._timer_count -= 1
     def _check_timers(self, eventtime, busy):
         if eventtime < self._next_timer:
             if busy:
@@ -167,20 +269,39 @@ class SelectReactor:
                     gc.collect(gc_level)
                     return 0.
             return min(1., max(.001, self._next_timer - eventtime))
-        self._next_timer = self.NEVER
+        if self._timer_adds:
+            self._merge_timer_adds()
+        # Timers scheduled during this pass are not run until the next pass
+        heap = self._timer_heap
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            waketime = t.waketime
-            if eventtime >= waketime:
-                t.waketime = self.NEVER
-                t.timer_is_running = True
-                t.waketime = waketime = t.callback(eventtime)
-                t.timer_is_running = False
-                if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._next_timer = min(self._next_timer, waketime)
+        profile = self._profile
+        while heap and eventtime >= heap[0][0]:
+            waketime, seq, t = heapq.heappop(heap)
+            if t.timer_seq != seq:
+                continue
+            t.waketime = self.NEVER
+            t.timer_is_running = True
+            if profile is None:
+                waketime = t.callback(eventtime)
+            else:
+                if t.profile_key is None:
+                    t.profile_key = lookup_callback_name(t.callback)
+                waketime = self._profile_callback(t.callback, t.profile_key,
+                                                  eventtime, waketime)
+            t.timer_is_running = False
+            if t.timer_seq is None:
+                # Timer unregistered itself
+                t.waketime = waketime
+            else:
+                self._schedule_timer(t, waketime)
+            if g_dispatch is not self._g_dispatch:
+                self._end_greenlet(g_dispatch)
+                return 0.
+        if self._timer_adds:
+            self._merge_timer_adds()
+        while heap and heap[0][2].timer_seq != heap[0][1]:
+            heapq.heappop(heap)
+        self._next_timer = heap[0][0] if heap else self.NEVER
         return 0.
     # Callbacks and Completions
     def completion(self):
@@ -289,6 +410,8 @@ class SelectReactor:
         elif is_writeable:
             self._write_fds.append(fd)
     def _check_fds(self, eventtime, hdls):
+        if self._profile is not None:
+            return self._check_fds_profile(eventtime, hdls)
         g_dispatch = self._g_dispatch
         for fd, event in hdls:
             hdl = self._fds.get(fd, self._dummy_fd_hdl)
@@ -303,6 +426,27 @@ class SelectReactor:
                     self._end_greenlet(g_dispatch)
                     return self.monotonic()
         return eventtime
+    def _check_fds_profile(self, eventtime, hdls):
+        g_dispatch = self._g_dispatch
+        for fd, event in hdls:
+            hdl = self._fds.get(fd, self._dummy_fd_hdl)
+            if hdl.profile_keys is None:
+                hdl.profile_keys = (lookup_callback_name(hdl.read_callback),
+                                    lookup_callback_name(hdl.write_callback))
+            if event & self._READ:
+                self._profile_callback(hdl.read_callback, hdl.profile_keys[0],
+                                       eventtime, self.NOW)
+                if g_dispatch is not self._g_dispatch:
+                    self._end_greenlet(g_dispatch)
+                    return self.monotonic()
+            if event & self._WRITE:
+                self._profile_callback(hdl.write_callback,
+                                       hdl.profile_keys[1], eventtime,
+                                       self.NOW)
+                if g_dispatch is not self._g_dispatch:
+                    self._end_greenlet(g_dispatch)
+                    return self.monotonic()
+        return eventtime
     # Main loop
     def _dispatch_loop(self):
         self._g_dispatch = greenlet.getcurrent()
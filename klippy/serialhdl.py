@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading, os
+import logging, threading, os, struct, zlib
 import serial
 
 import msgproto, chelper, util
@@ -11,6 +11,11 @@ import msgproto, chelper, util
 class error(Exception):
     pass
 
+# Maximum number of messages to process per pull from the serialqueue
+PULL_BATCH_SIZE = 32
+# Storage location for decoded data dictionaries
+DICT_CACHE_DIR = "~/.cache/klipper/dict"
+
 class SerialReader:
     def __init__(self, reactor, mcu_name=""):
         self.reactor = reactor
@@ -35,35 +40,60 @@ class SerialReader:
         self.handlers = {}
         self.register_response(self._handle_unknown_init, '#unknown')
         self.register_response(self.handle_output, '#output')
+        self.raw_handlers = {}
+        self.raw_msgids = set()
+        self.msgid_parser = msgproto.PT_int32()
+        self.bulk_queues = []
         # Sent message notification tracking
         self.last_notify_id = 0
         self.pending_notifications = {}
     def _bg_thread(self):
         name_short = ("serialhdl %s" % (self.mcu_name))[:15]
         self.ffi_lib.set_thread_name(name_short.encode('utf-8'))
-        response = self.ffi_main.new('struct pull_queue_message *')
+        responses = self.ffi_main.new('struct pull_queue_message[%d]'
+                                      % (PULL_BATCH_SIZE,))
+        ffi_buffer = self.ffi_main.buffer
         while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
+            count = self.ffi_lib.serialqueue_pull_batch(
+                self.serialqueue, responses, PULL_BATCH_SIZE)
             if count < 0:
                 break
-            if response.notify_id:
-                params = {'#sent_time': response.sent_time,
-                          '#receive_time': response.receive_time}
-                completion = self.pending_notifications.pop(response.notify_id)
-                self.reactor.async_complete(completion, params)
-                continue
-            params = self.msgparser.parse(response.msg[0:count])
-            params['#sent_time'] = response.sent_time
-            params['#receive_time'] = response.receive_time
-            hdl = (params['#name'], params.get('oid'))
-            try:
-                with self.lock:
-                    hdl = self.handlers.get(hdl, self.handle_default)
-                    hdl(params)
-            except:
-                logging.exception("%sException in serial callback",
-                                  self.warn_prefix)
+            with self.lock:
+                for i in range(count):
+                    response = responses[i]
+                    if response.notify_id:
+                        params = {'#sent_time': response.sent_time,
+                                  '#receive_time': response.receive_time}
+                        completion = self.pending_notifications.pop(
+                            response.notify_id)
+                        self.reactor.async_complete(completion, params)
+                        continue
+                    msg = bytearray(ffi_buffer(response.msg, response.len))
+                    if self.raw_handlers:
+                        # Check for a raw handler for this message and oid
+                        msgid, pos = self.msgid_parser.parse(
+                            msg, msgproto.MESSAGE_HEADER_SIZE)
+                        if msgid in self.raw_msgids:
+                            oid, pos = self.msgid_parser.parse(msg, pos)
+                            hdl = self.raw_handlers.get((msgid, oid))
+                            if hdl is not None:
+                                try:
+                                    hdl(msg)
+                                except:
+                                    logging.exception(
+                                        "%sException in serial callback",
+                                        self.warn_prefix)
+                                continue
+                    params = self.msgparser.parse(msg)
+                    params['#sent_time'] = response.sent_time
+                    params['#receive_time'] = response.receive_time
+                    hdl = (params['#name'], params.get('oid'))
+                    try:
+                        hdl = self.handlers.get(hdl, self.handle_default)
+                        hdl(params)
+                    except:
+                        logging.exception("%sException in serial callback",
+                                          self.warn_prefix)
     def _error(self, msg, *params):
         raise error(self.warn_prefix + (msg % params))
     def _get_identify_data(self, eventtime):
@@ -83,6 +113,75 @@ class SerialReader:
                     # Done
                     return identify_data
                 identify_data += msgdata
+    # Data dictionary cache
+    def _query_identify(self, offset):
+        msg = "identify offset=%d count=%d" % (offset, 40)
+        while 1:
+            params = self.send_with_response(msg, 'identify_response')
+            if params['offset'] == offset:
+                return bytes(params['data'])
+    def _get_identify_key(self, eventtime):
+        # Find the size of the compressed data dictionary with a binary
+        # search and read its zlib trailer (an adler32 of the contents)
+        try:
+            low, high = 0, 4096
+            while self._query_identify(high):
+                low, high = high, high * 2
+            while high - low > 40:
+                mid = (low + high) // 2
+                if self._query_identify(mid):
+                    low = mid
+                else:
+                    high = mid
+            size = low + len(self._query_identify(low))
+            trailer = self._query_identify(max(0, size - 4))[-4:]
+        except error as e:
+            logging.exception("%sWait for identify_response",
+                              self.warn_prefix)
+            return None
+        if len(trailer) != 4:
+            return None
+        return size, struct.unpack('>I', trailer)[0]
+    def _get_dict_cache_name(self, key):
+        return os.path.join(os.path.expanduser(DICT_CACHE_DIR),
+                            "dict-%d-%08x.json" % key)
+    def _load_cached_dict(self):
+        cache_dir = os.path.expanduser(DICT_CACHE_DIR)
+        if not os.path.isdir(cache_dir) or not os.listdir(cache_dir):
+            return None
+        completion = self.reactor.register_callback(self._get_identify_key)
+        key = completion.wait(self.reactor.monotonic() + 5.)
+        if key is None:
+            return None
+        try:
+            f = open(self._get_dict_cache_name(key), 'rb')
+            data = f.read()
+            f.close()
+        except (IOError, OSError):
+            return None
+        if zlib.adler32(data) & 0xffffffff != key[1]:
+            logging.info("%sIgnoring corrupt data dictionary cache",
+                         self.warn_prefix)
+            return None
+        logging.info("%sUsing cached data dictionary (size=%d crc=%08x)",
+                     self.warn_prefix, key[0], key[1])
+        return data
+    def _store_cached_dict(self, identify_data, data):
+        if len(identify_data) < 4:
+            return
+        key = (len(identify_data), struct.unpack('>I', identify_data[-4:])[0])
+        fname = self._get_dict_cache_name(key)
+        tempname = "%s.%d.tmp" % (fname, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(fname)):
+                os.makedirs(os.path.dirname(fname))
+            f = open(tempname, 'wb')
+            f.write(data)
+            f.close()
+            os.rename(tempname, fname)
+        except (IOError, OSError) as e:
+            logging.info("%sUnable to store data dictionary cache: %s",
+                         self.warn_prefix, e)
     def _start_session(self, serial_dev, serial_fd_type=b'u', client_id=0):
         self.serial_dev = serial_dev
         self.serialqueue = self.ffi_main.gc(
@@ -93,14 +192,21 @@ class SerialReader:
         self.background_thread = threading.Thread(target=self._bg_thread)
         self.background_thread.start()
         # Obtain and load the data dictionary from the firmware
-        completion = self.reactor.register_callback(self._get_identify_data)
-        identify_data = completion.wait(self.reactor.monotonic() + 5.)
-        if identify_data is None:
-            logging.info("%sTimeout on connect", self.warn_prefix)
-            self.disconnect()
-            return False
         msgparser = msgproto.MessageParser(warn_prefix=self.warn_prefix)
-        msgparser.process_identify(identify_data)
+        dict_data = self._load_cached_dict()
+        if dict_data is not None:
+            msgparser.process_identify(dict_data, decompress=False)
+        else:
+            completion = self.reactor.register_callback(
+                self._get_identify_data)
+            identify_data = completion.wait(self.reactor.monotonic() + 5.)
+            if identify_data is None:
+                logging.info("%sTimeout on connect", self.warn_prefix)
+                self.disconnect()
+                return False
+            msgparser.process_identify(identify_data)
+            self._store_cached_dict(identify_data,
+                                    msgparser.get_raw_data_dictionary())
         self.msgparser = msgparser
         self.register_response(self.handle_unknown, '#unknown')
         # Setup baud adjust
@@ -247,6 +353,28 @@ class SerialReader:
                 del self.handlers[name, oid]
             else:
                 self.handlers[name, oid] = callback
+    # Store messages for a bulk sensor oid in a C ring buffer (filled by
+    # the serialqueue thread without invoking python)
+    def alloc_bulk_queue(self, size):
+        bulkqueue = self.ffi_main.gc(self.ffi_lib.bulkqueue_alloc(size),
+                                     self.ffi_lib.bulkqueue_free)
+        # Queue must not be freed while the serialqueue is active
+        self.bulk_queues.append(bulkqueue)
+        return bulkqueue
+    def setup_bulk_queue(self, bulkqueue, msgformat, oid):
+        msgtag = self.msgparser.lookup_msgid(msgformat) & 0xffffffff
+        self.ffi_lib.bulkqueue_setup(bulkqueue, self.serialqueue, msgtag, oid)
+    # Register a handler that is passed the unparsed message block (the
+    # message must have an 'oid' as its first parameter).  The handler
+    # is invoked from the background thread.
+    def register_raw_response(self, callback, msgformat, oid):
+        msgid = self.msgparser.lookup_msgid(msgformat)
+        with self.lock:
+            if callback is None:
+                del self.raw_handlers[msgid, oid]
+            else:
+                self.raw_handlers[msgid, oid] = callback
+            self.raw_msgids = set([k[0] for k in self.raw_handlers])
     # Command sending
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
         self.ffi_lib.serialqueue_send(self.serialqueue, cmd_queue,
@@ -265,6 +393,19 @@ class SerialReader:
     def send(self, msg, minclock=0, reqclock=0):
         cmd = self.msgparser.create_command(msg)
         self.raw_send(cmd, minclock, reqclock, self.default_cmd_queue)
+    def send_multi(self, msgs, minclock=0, reqclock=0):
+        # Queue a series of commands with a single call to the serialqueue
+        cmds = [self.msgparser.create_command(msg) for msg in msgs]
+        if not cmds:
+            return
+        data = bytearray()
+        for cmd in cmds:
+            data.extend(cmd)
+        lens = self.ffi_main.new('int[]', [len(cmd) for cmd in cmds])
+        self.ffi_lib.serialqueue_send_multi(
+            self.serialqueue, self.default_cmd_queue,
+            self.ffi_main.new('uint8_t[]', bytes(data)), lens, len(cmds),
+            minclock, reqclock)
     def send_with_response(self, msg, response):
         cmd = self.msgparser.create_command(msg)
         src = SerialRetryCommand(self, response)
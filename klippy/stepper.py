@@ -44,7 +44,8 @@ class MCU_stepper:
         self._mcu_position_offset = 0.
         self._reset_cmd_tag = self._get_position_cmd = None
         self._active_callbacks = []
-        motion_queuing = printer.load_object(config, 'motion_queuing')
+        self._motion_queuing = motion_queuing = printer.load_object(
+            config, 'motion_queuing')
         sname = self._name.split()[-1]
         self._syncemitter = motion_queuing.allocate_syncemitter(mcu, sname)
         ffi_main, ffi_lib = chelper.get_ffi()
@@ -148,21 +149,25 @@ class MCU_stepper:
         invert_dir = not not invert_dir
         if invert_dir == self._invert_dir:
             return
+        self._motion_queuing.finalize_step_generation()
         self._invert_dir = invert_dir
         ffi_main, ffi_lib = chelper.get_ffi()
         ffi_lib.stepcompress_set_invert_sdir(self._stepqueue, invert_dir)
         self._mcu.get_printer().send_event("stepper:set_dir_inverted", self)
     def calc_position_from_coord(self, coord):
+        self._motion_queuing.finalize_step_generation()
         ffi_main, ffi_lib = chelper.get_ffi()
         return ffi_lib.itersolve_calc_position_from_coord(
             self._stepper_kinematics, coord[0], coord[1], coord[2])
     def set_position(self, coord):
         mcu_pos = self.get_mcu_position()
+        self._motion_queuing.finalize_step_generation()
         sk = self._stepper_kinematics
         ffi_main, ffi_lib = chelper.get_ffi()
         ffi_lib.itersolve_set_position(sk, coord[0], coord[1], coord[2])
         self._set_mcu_position(mcu_pos)
     def get_commanded_position(self):
+        self._motion_queuing.finalize_step_generation()
         ffi_main, ffi_lib = chelper.get_ffi()
         return ffi_lib.itersolve_get_commanded_pos(self._stepper_kinematics)
     def get_mcu_position(self, cmd_pos=None):
@@ -177,6 +182,7 @@ class MCU_stepper:
         mcu_pos_dist = mcu_pos * self._step_dist
         self._mcu_position_offset = mcu_pos_dist - self.get_commanded_position()
     def get_past_mcu_position(self, print_time):
+        self._motion_queuing.finalize_step_generation()
         clock = self._mcu.print_time_to_clock(print_time)
         ffi_main, ffi_lib = chelper.get_ffi()
         pos = ffi_lib.stepcompress_find_past_position(self._stepqueue, clock)
@@ -184,14 +190,21 @@ class MCU_stepper:
     def mcu_to_commanded_position(self, mcu_pos):
         return mcu_pos * self._step_dist - self._mcu_position_offset
     def dump_steps(self, count, start_clock, end_clock):
+        self._motion_queuing.finalize_step_generation()
         ffi_main, ffi_lib = chelper.get_ffi()
         data = ffi_main.new('struct pull_history_steps[]', count)
         count = ffi_lib.stepcompress_extract_old(self._stepqueue, data, count,
                                                  start_clock, end_clock)
         return (data, count)
+    def export_steps(self, data, start_clock, end_clock):
+        self._motion_queuing.finalize_step_generation()
+        ffi_main, ffi_lib = chelper.get_ffi()
+        return ffi_lib.stepcompress_export(self._stepqueue, data, len(data),
+                                           start_clock, end_clock)
     def get_stepper_kinematics(self):
         return self._stepper_kinematics
     def set_stepper_kinematics(self, sk):
+        self._motion_queuing.finalize_step_generation()
         old_sk = self._stepper_kinematics
         mcu_pos = 0
         if old_sk is not None:
@@ -203,6 +216,7 @@ class MCU_stepper:
         self._set_mcu_position(mcu_pos)
         return old_sk
     def note_homing_end(self):
+        self._motion_queuing.finalize_step_generation()
         ffi_main, ffi_lib = chelper.get_ffi()
         ret = ffi_lib.stepcompress_reset(self._stepqueue, 0)
         if ret:
@@ -219,6 +233,7 @@ class MCU_stepper:
             last_pos = -last_pos
         print_time = self._mcu.estimated_print_time(params['#receive_time'])
         clock = self._mcu.print_time_to_clock(print_time)
+        self._motion_queuing.finalize_step_generation()
         ffi_main, ffi_lib = chelper.get_ffi()
         ret = ffi_lib.stepcompress_set_last_position(self._stepqueue, clock,
                                                      last_pos)
@@ -229,6 +244,7 @@ class MCU_stepper:
     def get_trapq(self):
         return self._trapq
     def set_trapq(self, tq):
+        self._motion_queuing.finalize_step_generation()
         ffi_main, ffi_lib = chelper.get_ffi()
         if tq is None:
             tq = ffi_main.NULL
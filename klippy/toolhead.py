@@ -12,22 +12,31 @@ import mcu, chelper, kinematics.extruder
 
 # Class to track each move request
 class Move:
+    # Many Move objects are created during a print - use slots to
+    # reduce their memory footprint and allocation overhead.
+    __slots__ = (
+        'toolhead', 'start_pos', 'end_pos', 'accel', 'junction_deviation',
+        'timing_callbacks', 'is_kinematic_move', 'axes_d', 'axes_r',
+        'move_d', 'min_move_t', 'max_start_v2', 'max_cruise_v2', 'delta_v2',
+        'next_junction_v2', 'max_mcr_start_v2', 'mcr_delta_v2',
+        'start_v', 'cruise_v', 'end_v', 'accel_t', 'cruise_t', 'decel_t')
     def __init__(self, toolhead, start_pos, end_pos, speed):
         self.toolhead = toolhead
-        self.start_pos = tuple(start_pos)
-        self.end_pos = tuple(end_pos)
+        self.start_pos = start_pos = tuple(start_pos)
+        self.end_pos = end_pos = tuple(end_pos)
         self.accel = toolhead.max_accel
         self.junction_deviation = toolhead.junction_deviation
-        self.timing_callbacks = []
+        self.timing_callbacks = ()
         velocity = min(speed, toolhead.max_velocity)
         self.is_kinematic_move = True
-        self.axes_d = axes_d = [ep - sp for sp, ep in zip(start_pos, end_pos)]
-        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
+        self.axes_d = axes_d = tuple([ep - sp
+                                      for sp, ep in zip(start_pos, end_pos)])
+        dx, dy, dz = axes_d[:3]
+        self.move_d = move_d = math.sqrt(sum((dx*dx, dy*dy, dz*dz)))
         if move_d < .000000001:
             # Extrude only move
-            self.end_pos = ((start_pos[0], start_pos[1], start_pos[2])
-                            + self.end_pos[3:])
-            axes_d[0] = axes_d[1] = axes_d[2] = 0.
+            self.end_pos = start_pos[:3] + end_pos[3:]
+            self.axes_d = axes_d = (0., 0., 0.) + axes_d[3:]
             self.move_d = move_d = max([abs(ad) for ad in axes_d[3:]])
             inv_move_d = 0.
             if move_d:
@@ -37,7 +46,7 @@ class Move:
             self.is_kinematic_move = False
         else:
             inv_move_d = 1. / move_d
-        self.axes_r = [d * inv_move_d for d in axes_d]
+        self.axes_r = tuple([d * inv_move_d for d in axes_d])
         self.min_move_t = move_d / velocity
         # Junction speeds are tracked in velocity squared.  The
         # delta_v2 is the maximum amount of this squared-velocity that
@@ -192,6 +201,54 @@ class LookAheadQueue:
         # Check if enough moves have been queued to reach the target flush time.
         return self.junction_flush <= 0.
 
+# Look-ahead queue that performs the junction velocity planning in C.
+# It produces results identical to the LookAheadQueue class above.
+class CLookAheadQueue(LookAheadQueue):
+    def __init__(self):
+        LookAheadQueue.__init__(self)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.planner = ffi_main.gc(ffi_lib.lookahead_alloc(),
+                                   ffi_lib.lookahead_free)
+        self.lookahead_add_move = ffi_lib.lookahead_add_move
+        self.lookahead_flush = ffi_lib.lookahead_flush
+        self.junction_buf = ffi_main.new('struct lookahead_junction[]', 64)
+        self.junction_buf_size = 64
+    def reset(self):
+        LookAheadQueue.reset(self)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        ffi_lib.lookahead_reset(self.planner)
+    def flush(self, lazy=False):
+        self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        queue = self.queue
+        if len(queue) > self.junction_buf_size:
+            self.junction_buf_size = size = 2 * len(queue)
+            ffi_main, ffi_lib = chelper.get_ffi()
+            self.junction_buf = ffi_main.new('struct lookahead_junction[]',
+                                             size)
+        junctions = self.junction_buf
+        flush_count = self.lookahead_flush(self.planner, lazy, junctions)
+        if not flush_count:
+            return []
+        res = queue[:flush_count]
+        del queue[:flush_count]
+        for move, j in zip(res, junctions[0:flush_count]):
+            move.set_junction(j.start_v2, j.cruise_v2, j.end_v2)
+        return res
+    def add_move(self, move):
+        queue = self.queue
+        queue.append(move)
+        if len(queue) == 1:
+            self.lookahead_add_move(self.planner, move.max_start_v2,
+                                    move.max_cruise_v2, move.delta_v2,
+                                    move.max_mcr_start_v2, move.mcr_delta_v2)
+            return
+        move.calc_junction(queue[-2])
+        self.lookahead_add_move(self.planner, move.max_start_v2,
+                                move.max_cruise_v2, move.delta_v2,
+                                move.max_mcr_start_v2, move.mcr_delta_v2)
+        self.junction_flush -= move.min_move_t
+        return self.junction_flush <= 0.
+
 BUFFER_TIME_HIGH = 1.0
 BUFFER_TIME_START = 0.250
 PRIMING_CMD_TIME = 0.100
@@ -202,7 +259,7 @@ class ToolHead:
         self.printer = config.get_printer()
         self.reactor = self.printer.get_reactor()
         self.mcu = self.printer.lookup_object('mcu')
-        self.lookahead = LookAheadQueue()
+        self.lookahead = CLookAheadQueue()
         self.lookahead.set_flush_time(BUFFER_TIME_HIGH)
         self.commanded_pos = [0., 0., 0., 0.]
         # Velocity and acceleration control
@@ -277,6 +334,7 @@ class ToolHead:
             self.need_check_pause = -1.
             self._calc_print_time()
         # Queue moves into trapezoid motion queue (trapq)
+        self.motion_queuing.finalize_step_generation()
         next_move_time = self.print_time
         with self.reactor.assert_no_pause():
             for move in moves:
@@ -463,6 +521,7 @@ class ToolHead:
             self.lookahead.add_move(submit_move)
         moves = self.lookahead.flush()
         self._calc_print_time()
+        self.motion_queuing.finalize_step_generation()
         start_time = end_time = self.print_time
         for move in moves:
             self.trapq_append(
@@ -526,8 +585,13 @@ class ToolHead:
     def register_lookahead_callback(self, callback):
         last_move = self.lookahead.get_last()
         if last_move is None:
-            callback(self.get_last_move_time())
+            last_move_time = self.get_last_move_time()
+            # Callback may alter kinematics used by background step gen
+            self.motion_queuing.finalize_step_generation()
+            callback(last_move_time)
             return
+        if not last_move.timing_callbacks:
+            last_move.timing_callbacks = []
         last_move.timing_callbacks.append(callback)
     def get_max_velocity(self):
         return self.max_velocity, self.max_accel
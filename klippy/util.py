@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, os, pty, fcntl, termios, signal, logging, json, time
-import subprocess, traceback, shlex
+import subprocess, traceback, shlex, importlib
 
 
 ######################################################################
@@ -109,6 +109,47 @@ def setup_python2_wrappers():
 setup_python2_wrappers()
 
 
+######################################################################
+# Deferred module imports
+######################################################################
+
+# Check if a module is installed (without actually importing it)
+def has_module(name):
+    try:
+        import importlib.util
+    except ImportError:
+        # Python 2
+        import imp
+        try:
+            imp.find_module(name)
+        except ImportError:
+            return False
+        return True
+    return importlib.util.find_spec(name) is not None
+
+# Wrapper that delays a (slow) module import until the module is used.
+# The check() method should be called at config time - it reports a
+# missing module as a config error.  An installed module that fails
+# to import raises 'run_error' on first use.
+class LazyModule:
+    def __init__(self, name, msg):
+        self._lazy_name = name
+        self._lazy_msg = msg
+        self._lazy_error = ImportError
+        self._lazy_module = None
+    def check(self, cfg_error, run_error):
+        if not has_module(self._lazy_name):
+            raise cfg_error(self._lazy_msg)
+        self._lazy_error = run_error
+    def __getattr__(self, attr):
+        if self._lazy_module is None:
+            try:
+                self._lazy_module = importlib.import_module(self._lazy_name)
+            except Exception as e:
+                raise self._lazy_error("%s (%s)" % (self._lazy_msg, e))
+        return getattr(self._lazy_module, attr)
+
+
 ######################################################################
 # General system and software information
 ######################################################################
@@ -3,7 +3,8 @@
 # Copyright (C) 2020 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license
-import logging, socket, os, sys, errno, collections
+import logging, socket, os, sys, errno, collections, struct, base64
+import itertools
 import gcode
 
 try:
@@ -28,15 +29,35 @@ except ImportError:
                 return {json_loads_byteify(k, True): json_loads_byteify(v, True)
                         for k, v in data.items()}
             return data
+    # Binary data (stored in a bytearray) is sent as a base64 string
+    def json_default(obj):
+        if isinstance(obj, bytearray):
+            return base64.b64encode(bytes(obj)).decode()
+        raise TypeError("Object of type '%s' is not JSON serializable"
+                        % (type(obj).__name__,))
     def json_dumps(obj):
-        return json.dumps(obj, separators=(',', ':')).encode()
+        return json.dumps(obj, separators=(',', ':'),
+                          default=json_default).encode()
     def json_loads(data):
         return json.loads(data, object_hook=json_loads_byteify)
+    msgpack_dumps = msgpack_loads = None
 else:
     json_dumps = msgspec.json.encode
     json_loads = msgspec.json.decode
+    msgpack_dumps = msgspec.msgpack.encode
+    msgpack_loads = msgspec.msgpack.decode
+
+# Available message encodings (selected by a client via "info" request)
+ENCODINGS = ["json"]
+if msgpack_dumps is not None:
+    ENCODINGS.append("msgpack")
+# Messages in "msgpack" encoding are prefixed with a 4 byte length
+MSGPACK_HEADER = struct.Struct(">I")
 
 REQUEST_LOG_SIZE = 20
+SEND_CHUNK_COUNT = 64
+BULK_HIGH_WATER = 256 * 1024
+MAX_SEND_QUEUE = 32 * 1024 * 1024
 
 class WebRequestError(gcode.CommandError):
     def __init__(self, message,):
@@ -54,7 +75,7 @@ class WebRequest:
     error = WebRequestError
     def __init__(self, client_conn, request):
         self.client_conn = client_conn
-        base_request = json_loads(request)
+        base_request = client_conn.decode_message(request)
         if type(base_request) != dict:
             raise ValueError("Not a top-level dictionary")
         self.id = base_request.get('id', None)
@@ -120,6 +141,7 @@ class ServerSocket:
         self.reactor = printer.get_reactor()
         self.sock = self.fd_handle = None
         self.clients = {}
+        self.last_dropped = 0
         start_args = printer.get_start_args()
         server_address = start_args.get('apiserver')
         is_fileinput = (start_args.get('debuginput') is not None)
@@ -176,13 +198,21 @@ class ServerSocket:
 
     def stats(self, eventtime):
         # Called once per second - check for idle clients
+        send_queue = dropped = 0
         for client in list(self.clients.values()):
             if client.is_blocking:
                 client.blocking_count -= 1
                 if client.blocking_count < 0:
                     logging.info("Closing unresponsive client %s", client.uid)
                     client.close()
-        return False, ""
+            send_queue += client.send_queue_size
+            dropped += client.dropped_batches
+        last_dropped = self.last_dropped
+        self.last_dropped = dropped
+        if not send_queue and dropped == last_dropped:
+            return False, ""
+        return False, "webhooks: send_queue=%d dropped_batches=%d" % (
+            send_queue, dropped)
 
 class ClientConnection:
     def __init__(self, server, sock):
@@ -194,7 +224,13 @@ class ClientConnection:
         self.sock = sock
         self.fd_handle = self.reactor.register_fd(
             self.sock.fileno(), self.process_received, self._do_send)
-        self.partial_data = self.send_buffer = b""
+        self.partial_data = b""
+        self.send_queue = collections.deque()
+        self.send_queue_size = 0
+        self.dropped_batches = 0
+        self.can_sendmsg = hasattr(sock, 'sendmsg')
+        self.encoding = "json"
+        self.next_encoding = None
         self.is_blocking = False
         self.blocking_count = 0
         self.set_client_info("?", "New connection")
@@ -234,6 +270,32 @@ class ClientConnection:
     def is_closed(self):
         return self.fd_handle is None
 
+    def get_encoding(self):
+        return self.encoding
+
+    def set_encoding(self, encoding):
+        # New encoding takes effect after the current response is sent
+        self.next_encoding = encoding
+
+    def decode_message(self, data):
+        if self.encoding == "msgpack":
+            return msgpack_loads(data)
+        return json_loads(data)
+
+    def _split_frames(self, data):
+        data = self.partial_data + data
+        frames = []
+        pos = 0
+        while len(data) - pos >= MSGPACK_HEADER.size:
+            mlen = MSGPACK_HEADER.unpack_from(data, pos)[0]
+            end = pos + MSGPACK_HEADER.size + mlen
+            if end > len(data):
+                break
+            frames.append(data[pos + MSGPACK_HEADER.size:end])
+            pos = end
+        self.partial_data = data[pos:]
+        return frames
+
     def process_received(self, eventtime):
         try:
             data = self.sock.recv(4096)
@@ -248,9 +310,12 @@ class ClientConnection:
             # Socket Closed
             self.close()
             return
-        requests = data.split(b'\x03')
-        requests[0] = self.partial_data + requests[0]
-        self.partial_data = requests.pop()
+        if self.encoding == "msgpack":
+            requests = self._split_frames(data)
+        else:
+            requests = data.split(b'\x03')
+            requests[0] = self.partial_data + requests[0]
+            self.partial_data = requests.pop()
         for req in requests:
             self.request_log.append((eventtime, req))
             try:
@@ -275,42 +340,88 @@ class ClientConnection:
             web_request.set_error(WebRequestError(str(e)))
             self.printer.invoke_shutdown(msg)
         result = web_request.finish()
-        if result is None:
-            return
-        self.send(result)
+        if result is not None:
+            self.send(result)
+        if self.next_encoding is not None:
+            self.encoding = self.next_encoding
+            self.next_encoding = None
 
     def send(self, data):
         try:
-            jmsg = json_dumps(data)
-            self.send_buffer += jmsg + b"\x03"
+            if self.encoding == "msgpack":
+                msg = msgpack_dumps(data)
+                msg = MSGPACK_HEADER.pack(len(msg)) + msg
+            else:
+                msg = json_dumps(data) + b"\x03"
         except (TypeError, ValueError) as e:
-            msg = ("json encoding error: %s" % (str(e),))
+            msg = ("%s encoding error: %s" % (self.encoding, str(e)))
             logging.exception(msg)
             self.printer.invoke_shutdown(msg)
             return
+        self._queue_send(msg)
+
+    def send_encoded(self, jmsg):
+        # Send a message that is already encoded in json
+        self._queue_send(jmsg + b"\x03")
+
+    def _queue_send(self, msg):
+        if self.fd_handle is None:
+            return
+        self.send_queue.append(msg)
+        self.send_queue_size += len(msg)
+        if self.send_queue_size > MAX_SEND_QUEUE:
+            logging.info("Closing client %s with excessive send backlog",
+                         self.uid)
+            self.close()
+            return
         if not self.is_blocking:
             self._do_send()
 
+    # Bulk data senders may skip messages when the client falls behind
+    def check_bulk_backlog(self):
+        if self.send_queue_size <= BULK_HIGH_WATER:
+            return False
+        self.dropped_batches += 1
+        return True
+
     def _do_send(self, eventtime=None):
         if self.fd_handle is None:
             return
+        send_queue = self.send_queue
         try:
-            sent = self.sock.send(self.send_buffer)
+            if self.can_sendmsg and len(send_queue) > 1:
+                chunks = list(itertools.islice(send_queue, SEND_CHUNK_COUNT))
+                sent = self.sock.sendmsg(chunks)
+            elif send_queue:
+                sent = self.sock.send(send_queue[0])
+            else:
+                sent = 0
         except socket.error as e:
             if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
                 logging.info("webhooks: socket write error %d" % (self.uid,))
                 self.close()
                 return
             sent = 0
-        if sent < len(self.send_buffer):
+        # Remove sent data from queue
+        self.send_queue_size -= sent
+        made_progress = sent > 0
+        while sent:
+            chunk = send_queue[0]
+            if sent < len(chunk):
+                send_queue[0] = memoryview(chunk)[sent:]
+                break
+            sent -= len(chunk)
+            send_queue.popleft()
+        if send_queue:
             if not self.is_blocking:
                 self.reactor.set_fd_wake(self.fd_handle, False, True)
                 self.is_blocking = True
                 self.blocking_count = 5
+            elif made_progress:
+                self.blocking_count = 5
         elif self.is_blocking:
             self.reactor.set_fd_wake(self.fd_handle, True, False)
             self.is_blocking = False
-        self.send_buffer = self.send_buffer[sent:]
 
 class WebHooks:
     def __init__(self, printer):
@@ -377,6 +488,12 @@ class WebHooks:
         start_args = self.printer.get_start_args()
         for sa in ['log_file', 'config_file', 'software_version', 'cpu_info']:
             response[sa] = start_args.get(sa)
+        encoding = web_request.get_str('encoding', None)
+        if encoding is not None:
+            if encoding not in ENCODINGS:
+                encoding = "json"
+            web_request.get_client_connection().set_encoding(encoding)
+            response['encoding'] = encoding
         web_request.send(response)
 
     def _handle_estop_request(self, web_request):
@@ -467,14 +584,25 @@ class GCodeHelper:
             self.is_output_registered = True
 
 SUBSCRIPTION_REFRESH_TIME = .25
+MIN_REFRESH_TIME = .050
+
+# Tracking of subscribed clients sharing a refresh interval
+class QueryStatusGroup:
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_time = 0.
+        self.clients = {}
+        self.baselines = {}
+        self.last_query = {}
+        self.last_generations = {}
 
 class QueryStatusHelper:
     def __init__(self, printer):
         self.printer = printer
         self.clients = {}
+        self.groups = {}
         self.pending_queries = []
         self.query_timer = None
-        self.last_query = {}
         # Register webhooks
         webhooks = printer.lookup_object('webhooks')
         webhooks.register_endpoint("objects/list", self._handle_list)
@@ -484,53 +612,184 @@ class QueryStatusHelper:
         objects = [n for n, o in self.printer.lookup_objects()
                    if hasattr(o, 'get_status')]
         web_request.send({'objects': objects})
+    def _query_object(self, obj_name, eventtime, query):
+        res = query.get(obj_name)
+        if res is None:
+            po = self.printer.lookup_object(obj_name, None)
+            if po is None or not hasattr(po, 'get_status'):
+                res = query[obj_name] = {}
+            else:
+                res = query[obj_name] = po.get_status(eventtime)
+        return res
+    def _query_generation(self, obj_name, eventtime, generations):
+        # Objects may provide a generation counter that changes whenever
+        # their get_status() information changes
+        if obj_name in generations:
+            return generations[obj_name]
+        po = self.printer.lookup_object(obj_name, None)
+        get_generation = getattr(po, 'get_status_generation', None)
+        gen = None
+        if get_generation is not None:
+            gen = get_generation(eventtime)
+        generations[obj_name] = gen
+        return gen
+    def _update_group(self, group, eventtime, query, generations):
+        last_query = group.last_query
+        last_generations = group.last_generations
+        gquery = group.last_query = {}
+        ggenerations = group.last_generations = {}
+        # Clients with identical subscriptions share the encoded updates
+        diffs = {}
+        encoded = {}
+        params_start = (b'{"eventtime":' + json_dumps(eventtime)
+                        + b',"status":{')
+        for cconn, subscription, template, tmpl_enc in list(
+                group.clients.values()):
+            # A new client's first update is relative to the status it
+            # was sent when subscribing (not the group's last update)
+            baseline = group.baselines.pop(cconn, None)
+            if cconn.is_closed():
+                del group.clients[cconn]
+                del self.clients[cconn]
+                continue
+            is_json = cconn.get_encoding() == "json"
+            cquery = []
+            cstatus = {}
+            for obj_name, req_items in subscription.items():
+                res = gquery.get(obj_name)
+                lres = last_query.get(obj_name, {})
+                if res is None:
+                    gen = self._query_generation(obj_name, eventtime,
+                                                 generations)
+                    if gen is None:
+                        res = self._query_object(obj_name, eventtime, query)
+                    else:
+                        ggenerations[obj_name] = gen
+                        if last_generations.get(obj_name) == gen:
+                            res = last_query.get(obj_name)
+                        if res is None:
+                            res = self._query_object(obj_name, eventtime,
+                                                     query)
+                    gquery[obj_name] = res
+                if baseline is not None:
+                    if req_items is None:
+                        req_items = tuple(res.keys())
+                    bres = baseline.get(obj_name, {})
+                    cres = {ri: res.get(ri, None) for ri in req_items
+                            if res.get(ri, None) != bres.get(ri)}
+                    if not cres:
+                        continue
+                    if not is_json:
+                        cstatus[obj_name] = cres
+                        continue
+                    cquery.append(json_dumps(obj_name) + b":"
+                                  + json_dumps(cres))
+                    continue
+                if res is lres:
+                    # Object reported no changes - nothing to send
+                    continue
+                if req_items is None:
+                    req_items = tuple(res.keys())
+                    if req_items:
+                        subscription[obj_name] = req_items
+                key = (obj_name, req_items)
+                cres = diffs.get(key)
+                if cres is None:
+                    cres = diffs[key] = {}
+                    for ri in req_items:
+                        rd = res.get(ri, None)
+                        if rd != lres.get(ri):
+                            cres[ri] = rd
+                if not cres:
+                    continue
+                if not is_json:
+                    cstatus[obj_name] = cres
+                    continue
+                enc = encoded.get(key)
+                if enc is None:
+                    enc = json_dumps(obj_name) + b":" + json_dumps(cres)
+                    encoded[key] = enc
+                cquery.append(enc)
+            # Send data
+            if cquery:
+                cconn.send_encoded(tmpl_enc + params_start
+                                   + b",".join(cquery) + b"}}}")
+            elif cstatus:
+                tmp = dict(template)
+                tmp['params'] = {'eventtime': eventtime, 'status': cstatus}
+                cconn.send(tmp)
     def _do_query(self, eventtime):
-        last_query = self.last_query
-        query = self.last_query = {}
+        query = {}
+        generations = {}
         msglist = self.pending_queries
         self.pending_queries = []
-        msglist.extend(self.clients.values())
-        # Generate get_status() info for each client
         reactor = self.printer.get_reactor()
         with reactor.assert_no_pause():
-            for cconn, subscription, send_func, template in msglist:
-                is_query = cconn is None
-                if not is_query and cconn.is_closed():
-                    del self.clients[cconn]
-                    continue
-                # Query each requested printer object
+            # Generate get_status() info for each pending query
+            for subscription, complete in msglist:
                 cquery = {}
                 for obj_name, req_items in subscription.items():
-                    res = query.get(obj_name, None)
-                    if res is None:
-                        po = self.printer.lookup_object(obj_name, None)
-                        if po is None or not hasattr(po, 'get_status'):
-                            res = query[obj_name] = {}
-                        else:
-                            res = query[obj_name] = po.get_status(eventtime)
+                    res = self._query_object(obj_name, eventtime, query)
                     if req_items is None:
-                        req_items = list(res.keys())
+                        req_items = tuple(res.keys())
                         if req_items:
                             subscription[obj_name] = req_items
-                    lres = last_query.get(obj_name, {})
-                    cres = {}
-                    for ri in req_items:
-                        rd = res.get(ri, None)
-                        if is_query or rd != lres.get(ri):
-                            cres[ri] = rd
-                    if cres or is_query:
-                        cquery[obj_name] = cres
-                # Send data
-                if cquery or is_query:
-                    tmp = dict(template)
-                    tmp['params'] = {'eventtime': eventtime, 'status': cquery}
-                    send_func(tmp)
-        if not query:
+                    cquery[obj_name] = {ri: res.get(ri, None)
+                                        for ri in req_items}
+                complete({'params': {'eventtime': eventtime,
+                                     'status': cquery}})
+            # Generate updates for each subscription group that is due
+            next_time = reactor.NEVER
+            for interval, group in list(self.groups.items()):
+                if eventtime >= group.next_time:
+                    try:
+                        self._update_group(group, eventtime, query,
+                                           generations)
+                    except (TypeError, ValueError) as e:
+                        msg = ("json encoding error: %s" % (str(e),))
+                        logging.exception(msg)
+                        self.printer.invoke_shutdown(msg)
+                    group.next_time = eventtime + interval
+                if not group.clients:
+                    del self.groups[interval]
+                    continue
+                next_time = min(next_time, group.next_time)
+        if not self.groups:
             # Unregister timer if there are no longer any subscriptions
             reactor.unregister_timer(self.query_timer)
             self.query_timer = None
-            return reactor.NEVER
-        return eventtime + SUBSCRIPTION_REFRESH_TIME
+        return next_time
+    def add_subscription(self, cconn, objects, template, interval,
+                         status=None):
+        self.remove_subscription(cconn)
+        group = self.groups.get(interval)
+        is_new_group = group is None
+        if is_new_group:
+            group = self.groups[interval] = QueryStatusGroup(interval)
+        # Encode the start of the response template for later updates
+        template = dict(template)
+        template.pop('params', None)
+        tmpl_enc = json_dumps(template)[:-1]
+        if template:
+            tmpl_enc += b","
+        tmpl_enc += b'"params":'
+        group.clients[cconn] = (cconn, objects, template, tmpl_enc)
+        if status is not None:
+            group.baselines[cconn] = status
+        self.clients[cconn] = group
+        self._start_timer(is_new_group)
+    def remove_subscription(self, cconn):
+        group = self.clients.pop(cconn, None)
+        if group is not None:
+            del group.clients[cconn]
+            group.baselines.pop(cconn, None)
+    def _start_timer(self, reschedule=False):
+        reactor = self.printer.get_reactor()
+        if self.query_timer is None:
+            qt = reactor.register_timer(self._do_query, reactor.NOW)
+            self.query_timer = qt
+        elif self.pending_queries or reschedule:
+            reactor.update_timer(self.query_timer, reactor.NOW)
     def _handle_query(self, web_request, is_subscribe=False):
         objects = web_request.get_dict('objects')
         # Validate subscription format
@@ -541,23 +800,26 @@ class QueryStatusHelper:
                 for ri in v:
                     if type(ri) != str:
                         raise web_request.error("Invalid argument")
+                objects[k] = tuple(v)
+        template = web_request.get_dict('response_template', {})
+        interval = web_request.get_float('refresh_interval',
+                                         SUBSCRIPTION_REFRESH_TIME)
+        if interval < MIN_REFRESH_TIME:
+            raise web_request.error("Invalid refresh_interval")
         # Add to pending queries
         cconn = web_request.get_client_connection()
-        template = web_request.get_dict('response_template', {})
-        if is_subscribe and cconn in self.clients:
-            del self.clients[cconn]
+        if is_subscribe:
+            self.remove_subscription(cconn)
         reactor = self.printer.get_reactor()
         complete = reactor.completion()
-        self.pending_queries.append((None, objects, complete.complete, {}))
-        # Start timer if needed
-        if self.query_timer is None:
-            qt = reactor.register_timer(self._do_query, reactor.NOW)
-            self.query_timer = qt
+        self.pending_queries.append((objects, complete.complete))
+        self._start_timer()
         # Wait for data to be queried
         msg = complete.wait()
         web_request.send(msg['params'])
         if is_subscribe:
-            self.clients[cconn] = (cconn, objects, cconn.send, template)
+            self.add_subscription(cconn, objects, template, interval,
+                                  msg['params']['status'])
     def _handle_subscribe(self, web_request):
         self._handle_query(web_request, is_subscribe=True)
 
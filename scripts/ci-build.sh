@@ -81,3 +81,7 @@ finish_test klippy "Test invoke klippy (Python3)"
 start_test klippy "Test invoke klippy (Python2)"
 $PYTHON2 scripts/test_klippy.py -d ${DICTDIR} test/klippy/*.test
 finish_test klippy "Test invoke klippy (Python2)"
+
+start_test klippy "Verify C lookahead planner"
+$PYTHON scripts/hostbench.py -t 0 lookahead
+finish_test klippy "Verify C lookahead planner"
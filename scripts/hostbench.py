@@ -0,0 +1,696 @@
+#!/usr/bin/env python3
+# Micro-benchmarks of performance sensitive klippy host code
+#
+# Copyright (C) 2025  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, logging, math, glob, re, gc, json, tracemalloc
+KLIPPER_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(os.path.join(KLIPPER_DIR, 'klippy'))
+import reactor, klippy, toolhead, chelper
+
+# Run 'func' repeatedly for at least 'duration' seconds and return the
+# number of calls to 'func' per second
+def measure_rate(func, count, duration):
+    total = 0
+    start_time = time.perf_counter()
+    while 1:
+        func()
+        total += count
+        elapsed = time.perf_counter() - start_time
+        if elapsed >= duration:
+            return total / elapsed
+
+# Create a minimal printer object (no config file and no mcu)
+def make_printer():
+    start_args = {'debuginput': os.devnull, 'gcode_fd': None}
+    return klippy.Printer(reactor.Reactor(), None, start_args)
+
+
+######################################################################
+# G-Code parsing and dispatch
+######################################################################
+
+GCODE_LINES = [
+    "G1 X100.125 Y80.5 E0.03251",
+    "G1 X100.411 Y80.916 E0.01802 ; perimeter",
+    "G0 F9000 X95.2 Y110.73",
+    "G1 F1800 X96.004 Y111.2 E0.04 ",
+    "G2 X110.2 Y95.1 I5.2 J-3.35 E0.251",
+    "M104 S215",
+    "M106 S127.5",
+    "G1 Z0.6 F600",
+]
+
+def bench_gcode(options):
+    printer = make_printer()
+    gcode = printer.lookup_object('gcode')
+    def cmd_noop(gcmd):
+        pass
+    for cmd in ['G0', 'G1', 'G2', 'M104', 'M106']:
+        gcode.register_command(cmd, cmd_noop)
+    gcode._handle_ready()
+    # Lower case lines take the generic (regex split) parsing path
+    for desc, lines in [("generic", [l.lower() for l in GCODE_LINES]),
+                        ("fast", GCODE_LINES)]:
+        lines = lines * 128
+        rate = measure_rate(lambda: gcode._process_commands(lines, False),
+                            len(lines), options.duration)
+        print("gcode %-8s %10.0f lines/sec" % (desc, rate))
+
+
+######################################################################
+# Toolhead look-ahead planning
+######################################################################
+
+# Minimal toolhead object suitable for creating toolhead.Move objects
+class BenchToolHead:
+    def __init__(self, max_velocity=300., max_accel=3000., scv=5.,
+                 min_cruise_ratio=0.5):
+        self.max_velocity = max_velocity
+        self.max_accel = max_accel
+        self.junction_deviation = scv**2 * (math.sqrt(2.) - 1.) / max_accel
+        self.mcr_pseudo_accel = max_accel * (1. - min_cruise_ratio)
+        self.extra_axes = [BenchExtruder()]
+
+# Extruder junction and speed limits (similar to kinematics/extruder.py)
+class BenchExtruder:
+    instant_corner_v = 1.
+    max_e_velocity = 80.
+    max_e_accel = 1500.
+    def check_move(self, move, ea_index):
+        if not move.is_kinematic_move:
+            inv_extrude_r = 1. / abs(move.axes_r[ea_index])
+            move.limit_speed(self.max_e_velocity * inv_extrude_r,
+                             self.max_e_accel * inv_extrude_r)
+    def calc_junction(self, prev_move, move, ea_index):
+        diff_r = move.axes_r[ea_index] - prev_move.axes_r[ea_index]
+        if diff_r:
+            return (self.instant_corner_v / abs(diff_r))**2
+        return move.max_cruise_v2
+    def process_move(self, print_time, move, ea_index):
+        pass
+
+# Extract the G0/G1 moves from the regression test corpus
+move_param_r = re.compile(r'([XYZEF])([-+]?[0-9.]+)')
+def load_corpus_moves():
+    moves = []
+    for fname in sorted(glob.glob(os.path.join(KLIPPER_DIR, 'test', 'klippy',
+                                               '*.gcode'))
+                        + glob.glob(os.path.join(KLIPPER_DIR, 'test', 'klippy',
+                                                 '*.test'))):
+        pos = [0., 0., 0., 0.]
+        speed = 25.
+        is_relative = False
+        f = open(fname, 'r')
+        for line in f:
+            line = line.split(';', 1)[0].strip().upper()
+            if line.startswith('G91'):
+                is_relative = True
+            elif line.startswith('G90'):
+                is_relative = False
+            elif line.startswith('G28'):
+                pos = [0., 0., 0., pos[3]]
+            if not line.startswith('G0 ') and not line.startswith('G1 '):
+                continue
+            newpos = list(pos)
+            for axis, val in move_param_r.findall(line):
+                try:
+                    val = float(val)
+                except ValueError:
+                    continue
+                if axis == 'F':
+                    if val > 0.:
+                        speed = val / 60.
+                    continue
+                idx = 'XYZE'.index(axis)
+                newpos[idx] = pos[idx] + val if is_relative else val
+            moves.append((pos, newpos, speed))
+            pos = newpos
+        f.close()
+    return moves
+
+# Generate tessellated curves (similar to slicer output of round parts)
+def gen_curve_moves():
+    moves = []
+    pos = [0., 0., 0.2, 0.]
+    for radius, segments, speed in [(0.5, 16, 50.), (5., 64, 100.),
+                                    (20., 360, 150.), (60., 720, 300.),
+                                    (2., 400, 250.)]:
+        for i in range(segments * 3):
+            angle = 2. * math.pi * i / segments
+            # Vary the radius slightly to create uneven segment lengths
+            r = radius * (1. + 0.05 * math.sin(7. * angle))
+            newpos = [100. + r * math.cos(angle), 100. + r * math.sin(angle),
+                      pos[2], pos[3] + 0.03 * r / radius]
+            moves.append((pos, newpos, speed))
+            pos = newpos
+        # Travel and layer change between curves
+        newpos = [20., 20., pos[2] + 0.2, pos[3] - 1.]
+        moves.append((pos, newpos, 200.))
+        moves.append((newpos, [20., 20., newpos[2], pos[3]], 35.))
+        pos = [20., 20., newpos[2], pos[3]]
+    return moves
+
+# Create toolhead.Move objects (with kinematic and extruder limits)
+def build_moves(th, move_params):
+    extruder = th.extra_axes[0]
+    moves = []
+    for start_pos, end_pos, speed in move_params:
+        move = toolhead.Move(th, start_pos, end_pos, speed)
+        if not move.move_d:
+            continue
+        if move.is_kinematic_move and move.axes_d[2]:
+            z_ratio = move.move_d / abs(move.axes_d[2])
+            move.limit_speed(10. * z_ratio, 100. * z_ratio)
+        if move.axes_d[3]:
+            extruder.check_move(move, 3)
+        moves.append(move)
+    return moves
+
+# Run a list of moves through a look-ahead queue
+def run_lookahead(lookahead, moves):
+    lookahead.reset()
+    lookahead.set_flush_time(toolhead.BUFFER_TIME_HIGH)
+    out = []
+    for move in moves:
+        if lookahead.add_move(move):
+            out.extend(lookahead.flush(lazy=True))
+    out.extend(lookahead.flush())
+    return out
+
+def bench_lookahead(options):
+    move_params = load_corpus_moves() + gen_curve_moves()
+    # Verify the C planner produces identical results to the python code
+    fields = ['start_v', 'cruise_v', 'end_v', 'accel_t', 'cruise_t', 'decel_t']
+    for desc, th in [("default", BenchToolHead()),
+                     ("fast", BenchToolHead(500., 20000., 8., 0.)),
+                     ("slow", BenchToolHead(100., 500., 1., 0.9))]:
+        py_moves = run_lookahead(toolhead.LookAheadQueue(),
+                                 build_moves(th, move_params))
+        c_moves = run_lookahead(toolhead.CLookAheadQueue(),
+                                build_moves(th, move_params))
+        py_res = [[getattr(m, f) for f in fields] for m in py_moves]
+        c_res = [[getattr(m, f) for f in fields] for m in c_moves]
+        if py_res != c_res:
+            for i, (pr, cr) in enumerate(zip(py_res, c_res)):
+                if pr != cr:
+                    break
+            sys.stderr.write("Lookahead mismatch (%s) at move %d: %s vs %s\n"
+                             % (desc, i, pr, cr))
+            sys.exit(-1)
+    print("lookahead verified %d moves" % (len(py_res),))
+    moves = build_moves(BenchToolHead(), move_params)
+    for desc, lookahead in [("python", toolhead.LookAheadQueue()),
+                            ("c", toolhead.CLookAheadQueue())]:
+        rate = measure_rate(lambda: run_lookahead(lookahead, moves),
+                            len(moves), options.duration)
+        print("lookahead %-8s %10.0f moves/sec" % (desc, rate))
+
+
+######################################################################
+# Toolhead move queuing
+######################################################################
+
+# Run the ToolHead.move() and ToolHead._process_lookahead() code
+# without a config file, kinematics, or micro-controller
+class BenchMoveToolHead(toolhead.ToolHead):
+    def __init__(self):
+        self.reactor = reactor.Reactor()
+        self.lookahead = toolhead.CLookAheadQueue()
+        self.lookahead.set_flush_time(toolhead.BUFFER_TIME_HIGH)
+        self.commanded_pos = [0., 0., 0., 0.]
+        self.max_velocity = 300.
+        self.max_accel = 3000.
+        self.min_cruise_ratio = 0.5
+        self.square_corner_velocity = 5.
+        self._calc_junction_deviation()
+        self.need_check_pause = self.reactor.NEVER
+        self.print_time = 0.
+        self.special_queuing_state = ""
+        self.motion_queuing = self
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+        self.trapq_append = ffi_lib.trapq_append
+        self.trapq_finalize_moves = ffi_lib.trapq_finalize_moves
+        self.kin = self
+        self.extra_axes = [BenchExtruder()]
+    # Kinematics and motion_queuing interfaces
+    def check_move(self, move):
+        if move.axes_d[2]:
+            z_ratio = move.move_d / abs(move.axes_d[2])
+            move.limit_speed(10. * z_ratio, 100. * z_ratio)
+    def note_mcu_movequeue_activity(self, mq_time, is_step_gen=True):
+        pass
+    def finalize_step_generation(self):
+        pass
+    # Benchmark helpers
+    def queue_moves(self, move_params):
+        for start_pos, end_pos, speed in move_params:
+            self.move(end_pos, speed)
+    def run_moves(self, move_params):
+        self.queue_moves(move_params)
+        self._process_lookahead()
+        self.trapq_finalize_moves(self.trapq, self.reactor.NEVER,
+                                  self.reactor.NEVER)
+
+def bench_toolhead(options):
+    move_params = load_corpus_moves() + gen_curve_moves()
+    th = BenchMoveToolHead()
+    # Determine the memory held by each move in the look-ahead queue
+    for use_tracemalloc in [False, True]:
+        th.lookahead.set_flush_time(th.reactor.NEVER)
+        gc.collect()
+        if use_tracemalloc:
+            tracemalloc.start()
+        else:
+            start_blocks = sys.getallocatedblocks()
+        th.queue_moves(move_params)
+        count = len(th.lookahead.queue)
+        if use_tracemalloc:
+            mem_size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+        else:
+            blocks = sys.getallocatedblocks() - start_blocks
+        th.lookahead.reset()
+        th.commanded_pos[:] = [0., 0., 0., 0.]
+    print("toolhead queued  %10.1f bytes/move %6.1f allocs/move"
+          % (float(mem_size) / count, float(blocks) / count))
+    # Measure move throughput (including trapq insertion)
+    rate = measure_rate(lambda: th.run_moves(move_params),
+                        len(move_params), options.duration)
+    print("toolhead move    %10.0f moves/sec" % (rate,))
+
+
+######################################################################
+# Step generation
+######################################################################
+
+STEPGEN_WINDOW = 0.250
+STEPGEN_OVERLAP_WORK = 0.002
+
+# Run 'duration' seconds of busy work in the calling thread
+def busy_work(duration):
+    end_time = time.perf_counter() + duration
+    while time.perf_counter() < end_time:
+        pass
+
+def bench_stepgen(options):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    # Setup six steppers on an mcu whose output is discarded
+    devnull = open(os.devnull, 'wb')
+    sq = ffi_main.gc(ffi_lib.serialqueue_alloc(devnull.fileno(), b'f', 0,
+                                               b'bench'),
+                     ffi_lib.serialqueue_free)
+    ssm = ffi_main.gc(ffi_lib.steppersyncmgr_alloc(),
+                      ffi_lib.steppersyncmgr_free)
+    ss = ffi_lib.steppersyncmgr_alloc_steppersync(ssm)
+    ffi_lib.steppersync_setup_movequeue(ss, sq, 1024)
+    trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+    sks = []
+    ses = []
+    for oid, axis in enumerate('xyzxyz'):
+        se = ffi_lib.steppersync_alloc_syncemitter(ss, b'stepper%d' % (oid,),
+                                                   True)
+        sc = ffi_lib.syncemitter_get_stepcompress(se)
+        ffi_lib.stepcompress_fill(sc, oid, 25, 1, 2)
+        sk = ffi_main.gc(ffi_lib.cartesian_stepper_alloc(axis.encode()),
+                         ffi_lib.free)
+        ffi_lib.itersolve_set_trapq(sk, trapq, 0.0125)
+        ffi_lib.itersolve_set_position(sk, 100., 100., 10.)
+        ffi_lib.syncemitter_set_stepper_kinematics(se, sk)
+        sks.append(sk)
+        ses.append(se)
+    ffi_lib.steppersync_set_time(ss, 0., 16000000.)
+    # Generate steps for a zig-zag pattern of moves
+    state = {'move_time': 0.1, 'gen_time': 0.1, 'dir': 1.}
+    def add_moves(end_time):
+        while state['move_time'] < end_time:
+            d = state['dir']
+            # Each 30mm move starts where the previous one ended
+            sx, sy = (100., 100.) if d > 0. else (118., 124.)
+            ffi_lib.trapq_append(trapq, state['move_time'], 0.05, 0.1, 0.05,
+                                 sx, sy, 10., d * .6, d * .8, 0.,
+                                 0., 200., 4000.)
+            state['move_time'] += 0.2
+            state['dir'] = -d
+    def run_window(pipeline):
+        gen_time = state['gen_time'] + STEPGEN_WINDOW
+        add_moves(gen_time + 0.5)
+        start_time = time.perf_counter()
+        if not pipeline:
+            ret = ffi_lib.steppersyncmgr_gen_steps(ssm, gen_time, gen_time,
+                                                   0.)
+            busy_time = time.perf_counter() - start_time
+        else:
+            ffi_lib.steppersyncmgr_start_gen_steps(ssm, gen_time, gen_time,
+                                                   0.)
+            busy_time = time.perf_counter() - start_time
+            # Simulate other reactor work while steps are generated
+            busy_work(STEPGEN_OVERLAP_WORK)
+            start_time = time.perf_counter()
+            ret = ffi_lib.steppersyncmgr_finalize_gen_steps(ssm)
+            busy_time += time.perf_counter() - start_time
+        if ret:
+            raise Exception("Error in step generation")
+        ffi_lib.trapq_finalize_moves(trapq, gen_time, 0.)
+        state['gen_time'] = gen_time
+        return busy_time
+    for desc, pipeline in [("blocking", False), ("pipelined", True)]:
+        total_busy = 0.
+        count = 0
+        start_time = time.perf_counter()
+        while 1:
+            total_busy += run_window(pipeline)
+            count += 1
+            if time.perf_counter() - start_time >= options.duration:
+                break
+        print("stepgen %-9s %8.3f ms main thread per %.3fs window"
+              % (desc, total_busy * 1000. / count, STEPGEN_WINDOW))
+    # Report step generation profile counters
+    sestats = ffi_main.new('struct syncemitter_stats *')
+    gen_time = flush_time = 0.
+    steps = msgs = 0
+    for se in ses:
+        ffi_lib.syncemitter_get_stats(se, sestats)
+        gen_time += sestats.gen_time
+        flush_time += sestats.flush_time
+        steps += sestats.step_count
+        msgs += sestats.msg_count
+    print("stepgen profile   %8.1f ns/step itersolve %.1f ns/step stepcompress"
+          " %.1f steps/queue_step" % (gen_time * 1e9 / max(steps, 1),
+                                      flush_time * 1e9 / max(steps, 1),
+                                      float(steps) / max(msgs, 1)))
+    ffi_lib.serialqueue_exit(sq)
+    devnull.close()
+
+
+######################################################################
+# Reactor timer dispatch
+######################################################################
+
+REACTOR_TIMER_COUNTS = [10, 100, 1000]
+
+def bench_reactor(options):
+    for count in REACTOR_TIMER_COUNTS:
+        r = reactor.SelectReactor()
+        stats = {'callbacks': 0}
+        # Timers reschedule themselves with periods between 10ms and 1s
+        def make_callback(period):
+            def callback(eventtime):
+                stats['callbacks'] += 1
+                return eventtime + period
+            return callback
+        for i in range(count):
+            period = 0.010 * math.pow(100., float(i) / count)
+            r.register_timer(make_callback(period), r.NOW)
+        # Simulate the dispatch loop (without sleeping)
+        eventtime = 0.
+        wakeups = 0
+        start_time = time.perf_counter()
+        while 1:
+            for i in range(100):
+                eventtime = max(eventtime, r._next_timer)
+                r._check_timers(eventtime, False)
+            wakeups += 100
+            elapsed = time.perf_counter() - start_time
+            if elapsed >= options.duration:
+                break
+        print("reactor %4d timers %8.3f us/callback %8.3f us/wakeup"
+              % (count, elapsed * 1000000. / stats['callbacks'],
+                 elapsed * 1000000. / wakeups))
+
+
+######################################################################
+# API Server status subscriptions
+######################################################################
+
+# Printer object that reports either changing or static status
+class BenchStatusObject:
+    def __init__(self, status, is_changing, use_generation):
+        self.status = status
+        self.is_changing = is_changing
+        if use_generation:
+            self.get_status_generation = self._get_status_generation
+    def get_status(self, eventtime):
+        status = dict(self.status)
+        for key, value in status.items():
+            if type(value) == list:
+                status[key] = list(value)
+        if self.is_changing:
+            for key, value in status.items():
+                if type(value) == float:
+                    status[key] = value + eventtime
+                elif key in ('position', 'live_position'):
+                    status[key] = [v + eventtime for v in value]
+        return status
+    def _get_status_generation(self, eventtime):
+        return 0
+
+def build_status_objects():
+    settings = {"section%d" % (i,): {"option%d" % (j,): float(j)
+                                     for j in range(8)}
+                for i in range(40)}
+    raw_config = {s: {o: str(v) for o, v in opts.items()}
+                  for s, opts in settings.items()}
+    matrix = [[float(i * j) for i in range(30)] for j in range(30)]
+    probed = [[float(i + j) for i in range(9)] for j in range(9)]
+    # (name, status, is_changing)
+    return [
+        ("toolhead", {"position": [0., 0., 0., 0.], "print_time": 0.,
+                      "estimated_print_time": 0., "homed_axes": "xyz",
+                      "max_velocity": 300., "max_accel": 3000.}, True),
+        ("gcode_move", {"gcode_position": [0., 0., 0., 0.],
+                        "position": [0., 0., 0., 0.], "speed": 0.,
+                        "speed_factor": 1., "extrude_factor": 1.}, True),
+        ("motion_report", {"live_position": [0., 0., 0., 0.],
+                           "live_velocity": 0.,
+                           "live_extruder_velocity": 0.}, True),
+        ("extruder", {"temperature": 0., "target": 210., "power": 0.,
+                      "pressure_advance": .04}, True),
+        ("heater_bed", {"temperature": 0., "target": 60., "power": 0.},
+         True),
+        ("print_stats", {"filename": "part.gcode", "total_duration": 0.,
+                         "print_duration": 0., "filament_used": 0.,
+                         "state": "printing"}, True),
+        ("virtual_sdcard", {"file_position": 0., "progress": 0.,
+                            "is_active": True}, True),
+        ("fan", {"speed": 0.5, "rpm": None}, False),
+        ("idle_timeout", {"state": "Printing", "printing_time": 0.}, True),
+        ("display_status", {"progress": 0., "message": None}, False),
+        ("pause_resume", {"is_paused": False}, False),
+        ("exclude_object", {"objects": [{"name": "PART_%d" % (i,)}
+                                        for i in range(10)],
+                            "excluded_objects": [],
+                            "current_object": "PART_1"}, False),
+        ("configfile", {"config": raw_config, "settings": settings,
+                        "warnings": [], "save_config_pending": False,
+                        "save_config_pending_items": {}}, False),
+        ("bed_mesh", {"profile_name": "default", "mesh_min": (10., 10.),
+                      "mesh_max": (200., 200.), "probed_matrix": probed,
+                      "mesh_matrix": matrix,
+                      "profiles": {"default": {"points": probed}}}, False),
+    ]
+
+# Subscriptions of a web interface, a display, and a monitoring client
+STATUS_CLIENTS = [
+    (None, .25), (None, .25),
+    (["toolhead", "extruder", "heater_bed", "print_stats", "fan",
+      "display_status", "bed_mesh"], .25),
+    (["print_stats", "virtual_sdcard", "webhooks", "configfile"], 1.),
+    (["extruder", "heater_bed", "print_stats"], 5.),
+]
+
+class BenchClientConnection:
+    def __init__(self, stats):
+        self.stats = stats
+    def is_closed(self):
+        return False
+    def get_encoding(self):
+        return "json"
+    def send_encoded(self, jmsg):
+        self.stats['bytes'] += len(jmsg)
+
+def bench_status(options):
+    for desc, is_printing, use_generation in [
+            ("print poll", True, False), ("print generation", True, True),
+            ("idle poll", False, False), ("idle generation", False, True)]:
+        printer = make_printer()
+        objs = build_status_objects()
+        for name, status, is_changing in objs:
+            printer.add_object(name, BenchStatusObject(
+                status, is_changing and is_printing,
+                use_generation and not is_changing))
+        webhooks = printer.lookup_object('webhooks')
+        helper = webhooks._endpoints["objects/subscribe"].__self__
+        stats = {'bytes': 0}
+        for client_objs, interval in STATUS_CLIENTS:
+            if client_objs is None:
+                client_objs = [name for name, status, is_changing in objs]
+                client_objs.append("webhooks")
+            subscription = {name: None for name in client_objs}
+            helper.add_subscription(BenchClientConnection(stats),
+                                    subscription, {}, interval)
+        eventtime = [0.]
+        def do_queries():
+            for i in range(10):
+                eventtime[0] += .25
+                helper._do_query(eventtime[0])
+        do_queries()
+        stats['bytes'] = 0
+        start_time = time.perf_counter()
+        rate = measure_rate(do_queries, 10, options.duration)
+        elapsed = time.perf_counter() - start_time
+        print("status %-16s %8.1f us/update %8.0f bytes/update"
+              % (desc, 1000000. / rate,
+                 stats['bytes'] / (elapsed * rate)))
+
+
+######################################################################
+# API Server bulk data encoding
+######################################################################
+
+def bench_apiencode(options):
+    import webhooks
+    from extras import bulk_sensor
+    # Half a second of accelerometer samples at 3200Hz
+    data = [(100. + i / 3200., math.sin(i) * 9.8, math.cos(i) * 9.8,
+             9.81 + i * .0001) for i in range(1600)]
+    msg = {"q": 1, "params": {"data": data, "errors": 0,
+                              "overflows": 0}}
+    encodings = [("json", webhooks.json_dumps, webhooks.json_loads, False)]
+    if webhooks.msgpack_dumps is not None:
+        encodings.append(("msgpack", webhooks.msgpack_dumps,
+                          webhooks.msgpack_loads, True))
+    for desc, dumps, loads, is_packed in encodings:
+        def encode():
+            if is_packed:
+                pmsg = dict(msg)
+                pmsg["params"] = bulk_sensor.pack_batch_data(msg["params"])
+                return dumps(pmsg)
+            return dumps(msg)
+        raw = encode()
+        rate = measure_rate(encode, 1, options.duration)
+        drate = measure_rate(lambda: loads(raw), 1, options.duration)
+        print("apiencode %-8s %8d bytes/batch %8.1f us/encode"
+              " %8.1f us/decode"
+              % (desc, len(raw), 1000000. / rate, 1000000. / drate))
+
+
+######################################################################
+# MCU message encoding and parsing
+######################################################################
+
+# Generate example parameters for a message format
+def gen_msg_params(msg, seed):
+    params = []
+    for i, (name, t) in enumerate(msg.param_names):
+        if t.is_dynamic_string:
+            params.append(bytes(bytearray(range(seed % 48))))
+        elif not t.is_int:
+            enums = sorted(t.enums)
+            params.append(enums[seed % len(enums)])
+        elif name.endswith('clock') or name.endswith('ticks'):
+            params.append((seed * 0x9e3779b1) & 0xffffffff)
+        else:
+            params.append((seed * 37 + i) % [0x100, 0x10000][t.max_length > 2])
+    return params
+
+# Reference encoder (one call per parameter type)
+def encode_params_ref(msg, params):
+    out = list(msg.msgid_bytes)
+    for t, v in zip(msg.param_types, params):
+        t.encode(out, v)
+    return out
+
+def bench_msgproto(options):
+    import msgproto
+    dict_file = options.dictionary
+    if not os.path.exists(dict_file):
+        print("msgproto: skipped (no data dictionary at %s - use -d)"
+              % (dict_file,))
+        return
+    msgparser = msgproto.MessageParser()
+    with open(dict_file, 'rb') as f:
+        msgparser.process_identify(f.read(), decompress=False)
+    msgs = [msgparser.messages_by_id[msgid]
+            for msgid, msgtype, msgformat in msgparser.get_messages()
+            if msgtype != 'output']
+    # Verify generated encoders match the reference encoder
+    tests = []
+    for seed in range(8):
+        for msg in msgs:
+            params = gen_msg_params(msg, seed)
+            data = msg.encode(params)
+            if data != encode_params_ref(msg, params):
+                raise Exception("Encoding mismatch on %s" % (msg.msgformat,))
+            res, pos = msg.parse(data, 0)
+            if (pos != len(data) or [res[name] for name, t in msg.param_names]
+                != params):
+                raise Exception("Parse mismatch on %s" % (msg.msgformat,))
+            tests.append((msg, params, data))
+    def encode_all():
+        for msg, params, data in tests:
+            msg.encode(params)
+    def parse_all():
+        for msg, params, data in tests:
+            msg.parse(data, 0)
+    erate = measure_rate(encode_all, len(tests), options.duration)
+    prate = measure_rate(parse_all, len(tests), options.duration)
+    print("msgproto %4d messages %8.3f us/encode %8.3f us/parse"
+          % (len(msgs), 1000000. / erate, 1000000. / prate))
+
+
+######################################################################
+# C helper build variants
+######################################################################
+
+def bench_chelper(options):
+    for variant in sorted(chelper.VARIANT_FLAGS):
+        try:
+            destlib = chelper.build_c_library(variant)
+        except Exception as e:
+            print("chelper %-8s unavailable (%s)" % (variant, e))
+            continue
+        t = chelper.run_benchmark_process(destlib, options.duration)
+        print("chelper %-8s %8.3f us/move (%s)"
+              % (variant, t * 1000000., os.path.basename(destlib)))
+
+
+######################################################################
+# Startup
+######################################################################
+
+BENCHMARKS = {
+    'apiencode': bench_apiencode,
+    'chelper': bench_chelper,
+    'gcode': bench_gcode,
+    'lookahead': bench_lookahead,
+    'msgproto': bench_msgproto,
+    'reactor': bench_reactor,
+    'status': bench_status,
+    'stepgen': bench_stepgen,
+    'toolhead': bench_toolhead,
+}
+
+def main():
+    usage = "%prog [options] <benchmark> [<benchmark>...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-t", "--duration", type="float", dest="duration",
+                    default=2., help="seconds to run each benchmark")
+    opts.add_option("-d", "--dictionary", type="string", dest="dictionary",
+                    default=os.path.join(KLIPPER_DIR, "out", "klipper.dict"),
+                    help="mcu data dictionary for msgproto benchmark")
+    options, args = opts.parse_args()
+    if not args:
+        args = sorted(BENCHMARKS)
+    for name in args:
+        if name not in BENCHMARKS:
+            opts.error("Unknown benchmark '%s' (available: %s)"
+                       % (name, " ".join(sorted(BENCHMARKS))))
+    logging.basicConfig(level=logging.WARNING)
+    for name in args:
+        BENCHMARKS[name](options)
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, os, optparse, socket, select, json, errno, time, zlib, fnmatch
+import struct, base64, array
 
 INDEX_UPDATE_TIME = 5.0
 ClientInfo = {'program': 'motan_data_logger', 'version': 'v0.1'}
@@ -70,13 +71,38 @@ class LogWriter:
         self.file = None
         self.comp = None
 
+MSGPACK_HEADER = struct.Struct(">I")
+
+# Convert a msgpack encoded message to the json format used in the log
+def msgpack_to_json(msg):
+    params = msg.get("params")
+    if isinstance(params, dict) and isinstance(params.get("data"), bytes):
+        raw = params["data"]
+        columns = params.pop("data_columns", None)
+        if columns is None:
+            params["data"] = base64.b64encode(raw).decode()
+        else:
+            vals = array.array('d')
+            vals.frombytes(raw)
+            if sys.byteorder != 'little':
+                vals.byteswap()
+            params["data"] = [vals[i:i+columns].tolist()
+                              for i in range(0, len(vals), columns)]
+    return json.dumps(msg, separators=(',', ':')).encode()
+
 class DataLogger:
-    def __init__(self, uds_filename, log_prefix, want_subscriptions):
+    def __init__(self, uds_filename, log_prefix, want_subscriptions,
+                 binary=False, use_msgpack=False):
         # IO
         self.webhook_socket = webhook_socket_create(uds_filename)
         self.poll = select.poll()
         self.poll.register(self.webhook_socket, select.POLLIN | select.POLLHUP)
         self.socket_data = b""
+        self.msgpack = None
+        if use_msgpack:
+            import msgspec
+            self.msgpack = msgspec.msgpack
+        self.encoding = "json"
         # Data log
         self.logger = LogWriter(log_prefix + ".json.gz")
         self.index = LogWriter(log_prefix + ".index.gz")
@@ -89,9 +115,14 @@ class DataLogger:
         # Subscriptions
         self.want_subscriptions = want_subscriptions
         self.need_subscriptions = []
+        self.motion_params = {}
+        if binary:
+            self.motion_params = {"format": "binary"}
         # Start login process
-        self.send_query("info", "info", {"client_info": ClientInfo},
-                        self.handle_info)
+        info_params = {"client_info": ClientInfo}
+        if self.msgpack is not None:
+            info_params["encoding"] = "msgpack"
+        self.send_query("info", "info", info_params, self.handle_info)
     def error(self, msg):
         sys.stderr.write(msg + "\n")
     def finish(self, msg):
@@ -103,18 +134,42 @@ class DataLogger:
     def send_query(self, msg_id, method, params, cb):
         self.query_handlers[msg_id] = cb
         msg = {"id": msg_id, "method": method, "params": params}
+        if self.encoding == "msgpack":
+            cm = self.msgpack.encode(msg)
+            self.webhook_socket.send(MSGPACK_HEADER.pack(len(cm)) + cm)
+            return
         cm = json.dumps(msg, separators=(',', ':')).encode()
         self.webhook_socket.send(cm + b"\x03")
+    def pop_message(self):
+        data = self.socket_data
+        if self.encoding == "msgpack":
+            if len(data) < MSGPACK_HEADER.size:
+                return None
+            end = MSGPACK_HEADER.size + MSGPACK_HEADER.unpack_from(data)[0]
+            if len(data) < end:
+                return None
+            self.socket_data = data[end:]
+            return data[MSGPACK_HEADER.size:end]
+        pos = data.find(b"\x03")
+        if pos < 0:
+            return None
+        self.socket_data = data[pos+1:]
+        return data[:pos]
     def process_socket(self):
         data = self.webhook_socket.recv(4096)
         if not data:
             self.finish("Socket closed")
-        parts = data.split(b"\x03")
-        parts[0] = self.socket_data + parts[0]
-        self.socket_data = parts.pop()
-        for part in parts:
+        self.socket_data += data
+        while 1:
+            part = self.pop_message()
+            if part is None:
+                break
             try:
-                msg = json.loads(part)
+                if self.encoding == "msgpack":
+                    msg = self.msgpack.decode(part)
+                    part = msgpack_to_json(msg)
+                else:
+                    msg = json.loads(part)
             except:
                 self.error("ERROR: Unable to parse line")
                 continue
@@ -149,11 +204,13 @@ class DataLogger:
         # trapq and stepq subscriptions from motion_report
         motion_report = status.get("motion_report", {})
         for trapq in motion_report.get("trapq", []):
+            params = dict(self.motion_params, name=trapq)
             avail.append(("trapq:" + trapq, "motion_report/dump_trapq",
-                          {"name": trapq}))
+                          params))
         for stepper in motion_report.get("steppers", []):
+            params = dict(self.motion_params, name=stepper)
             avail.append(("stepq:" + stepper, "motion_report/dump_stepper",
-                          {"name": stepper}))
+                          params))
         # config based subsciriptions
         config = status["configfile"]["settings"]
         cfgtypes = {p[0]: p for p in ConfigSubscriptions}
@@ -196,6 +253,7 @@ class DataLogger:
     def handle_info(self, msg, raw_msg):
         if msg["result"]["state"] != "ready":
             self.finish("Klipper not in ready state")
+        self.encoding = msg["result"].get("encoding", "json")
         self.send_query("list", "objects/list", {}, self.handle_list)
     def handle_list(self, msg, raw_msg):
         subreq = {o: None for o in msg["result"]["objects"]}
@@ -246,6 +304,10 @@ def main():
                     help="comma separated list of subscription patterns")
     opts.add_option("--no-default", action="store_true",
                     help="disable default subscriptions")
+    opts.add_option("--binary", action="store_true",
+                    help="request motion data in binary format")
+    opts.add_option("--msgpack", action="store_true",
+                    help="use msgpack encoding on the api socket")
     options, args = opts.parse_args()
     if len(args) != 2:
         opts.error("Incorrect number of arguments")
@@ -258,7 +320,8 @@ def main():
 
     # Connect and start capture
     nice()
-    dl = DataLogger(args[0], args[1], want_subs)
+    dl = DataLogger(args[0], args[1], want_subs, options.binary,
+                    options.msgpack)
     dl.run()
 
 if __name__ == '__main__':
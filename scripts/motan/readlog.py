@@ -3,7 +3,7 @@
 # Copyright (C) 2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import json, zlib
+import json, zlib, struct, base64
 
 class error(Exception):
     pass
@@ -16,6 +16,18 @@ class error(Exception):
 # Log data handlers: {name: class, ...}
 LogHandlers = {}
 
+# Decode the records of a message sent in the binary export format
+def unpack_binary(fmt, jmsg):
+    s = struct.Struct(fmt)
+    raw = base64.b64decode(jmsg['data'])
+    return [s.unpack_from(raw, i) for i in range(0, len(raw), s.size)]
+
+# Return (interval, count, add) tuples from a stepq message
+def get_stepq_data(fmt, jmsg):
+    if fmt is None:
+        return jmsg['data']
+    return [(r[4], r[3], r[5]) for r in unpack_binary(fmt, jmsg)]
+
 # Extract status fields from log
 class HandleStatusField:
     SubscriptionIdParts = 0
@@ -60,6 +72,7 @@ class HandleTrapQ:
         self.cur_data = [(0., 0., 0., 0., (0., 0., 0.), (0., 0., 0.))]
         self.data_pos = 0
         tq, trapq_name, datasel = name_parts
+        self.binary_format = lmanager.get_binary_format("trapq:" + trapq_name)
         ptypes = {}
         ptypes['velocity'] = {
             'label': '%s velocity' % (trapq_name,),
@@ -106,6 +119,10 @@ class HandleTrapQ:
             if jmsg is None:
                 return move, False
             self.cur_data = jmsg['data']
+            if self.binary_format is not None:
+                self.cur_data = [(r[0], r[1], r[2], r[3], r[4:7], r[7:10])
+                                 for r in unpack_binary(self.binary_format,
+                                                        jmsg)]
             self.data_pos = data_pos = 0
     def _pull_axis_position(self, req_time):
         move, in_range = self._find_move(req_time)
@@ -152,6 +169,8 @@ class HandleStepQ:
         self.name = name
         self.stepper_name = name_parts[1]
         self.jdispatch = lmanager.get_jdispatch()
+        self.binary_format = lmanager.get_binary_format(
+            "stepq:" + self.stepper_name)
         self.step_data = [(0., 0., 0.), (0., 0., 0.)] # [(time, half_pos, pos)]
         self.data_pos = 0
         self.smooth_time = 0.010
@@ -209,7 +228,8 @@ class HandleStepQ:
         # Process block into (time, half_position, position) 3-tuples
         first_time = step_time = jmsg['first_step_time']
         first_clock = jmsg['first_clock']
-        step_clock = first_clock - jmsg['data'][0][0]
+        data = get_stepq_data(self.binary_format, jmsg)
+        step_clock = first_clock - data[0][0]
         cdiff = jmsg['last_clock'] - first_clock
         tdiff = last_time - first_time
         inv_freq = 0.
@@ -219,7 +239,7 @@ class HandleStepQ:
         step_pos = jmsg['start_position']
         if not step_data[0][0]:
             step_data[0] = (0., step_pos, step_pos)
-        for interval, raw_count, add in jmsg['data']:
+        for interval, raw_count, add in data:
             qs_dist = step_dist
             count = raw_count
             if count < 0:
@@ -318,6 +338,8 @@ class HandleStepPhase:
             self.phases *= 4
         self.jdispatch = lmanager.get_jdispatch()
         self.jdispatch.add_handler(name, "stepq:" + self.stepper_name)
+        self.binary_format = lmanager.get_binary_format(
+            "stepq:" + self.stepper_name)
         # stepq tracking
         self.step_data = [(0., 0), (0., 0)] # [(time, mcu_pos)]
         self.data_pos = 0
@@ -369,7 +391,8 @@ class HandleStepPhase:
         # Process block into (time, position) 2-tuples
         first_time = step_time = jmsg['first_step_time']
         first_clock = jmsg['first_clock']
-        step_clock = first_clock - jmsg['data'][0][0]
+        data = get_stepq_data(self.binary_format, jmsg)
+        step_clock = first_clock - data[0][0]
         cdiff = jmsg['last_clock'] - first_clock
         tdiff = last_time - first_time
         inv_freq = 0.
@@ -378,7 +401,7 @@ class HandleStepPhase:
         step_pos = jmsg['start_mcu_position']
         if not step_data[0][0]:
             step_data[0] = (0., step_pos)
-        for interval, raw_count, add in jmsg['data']:
+        for interval, raw_count, add in data:
             qs_dist = 1
             count = raw_count
             if count < 0:
@@ -734,6 +757,8 @@ class LogManager:
         return self.initial_start_time
     def get_start_time(self):
         return self.start_time
+    def get_binary_format(self, subscription_id):
+        return self.log_subscriptions.get(subscription_id, {}).get('format')
     def get_status_tracker(self):
         if self.status_tracker is None:
             self.status_tracker = TrackStatus(self, "status", self.start_status)
@@ -4,7 +4,10 @@
 # Copyright (C) 2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, os, optparse, socket, fcntl, select, json, errno, time
+import sys, os, optparse, socket, fcntl, select, json, errno, time, struct
+import base64
+
+MSGPACK_HEADER = struct.Struct(">I")
 
 # Set a file-descriptor as non-blocking
 def set_nonblock(fd):
@@ -30,8 +33,14 @@ def webhook_socket_create(uds_filename):
     sys.stderr.write("Connection.\n")
     return sock
 
+# Show binary data as base64 when displaying msgpack messages
+def json_default(obj):
+    if isinstance(obj, bytes):
+        return base64.b64encode(obj).decode()
+    raise TypeError("Unknown type %s" % (type(obj).__name__,))
+
 class KeyboardReader:
-    def __init__(self, uds_filename):
+    def __init__(self, uds_filename, use_msgpack=False):
         self.kbd_fd = sys.stdin.fileno()
         set_nonblock(self.kbd_fd)
         self.webhook_socket = webhook_socket_create(uds_filename)
@@ -39,15 +48,53 @@ class KeyboardReader:
         self.poll.register(sys.stdin, select.POLLIN | select.POLLHUP)
         self.poll.register(self.webhook_socket, select.POLLIN | select.POLLHUP)
         self.kbd_data = self.socket_data = b""
+        self.encoding = "json"
+        self.msgpack = None
+        if use_msgpack:
+            import msgspec
+            self.msgpack = msgspec.msgpack
+            self.send_message({"id": "whconsole_encoding", "method": "info",
+                               "params": {"encoding": "msgpack"}})
+    def send_message(self, m):
+        cm = json.dumps(m, separators=(',', ':'))
+        sys.stdout.write("SEND: %s\n" % (cm,))
+        if self.encoding == "msgpack":
+            data = self.msgpack.encode(m)
+            self.webhook_socket.send(MSGPACK_HEADER.pack(len(data)) + data)
+        else:
+            self.webhook_socket.send(cm.encode() + b"\x03")
+    def pop_message(self):
+        data = self.socket_data
+        if self.encoding == "msgpack":
+            if len(data) < MSGPACK_HEADER.size:
+                return None
+            end = MSGPACK_HEADER.size + MSGPACK_HEADER.unpack_from(data)[0]
+            if len(data) < end:
+                return None
+            self.socket_data = data[end:]
+            m = self.msgpack.decode(data[MSGPACK_HEADER.size:end])
+            return json.dumps(m, separators=(',', ':'), default=json_default)
+        pos = data.find(b'\x03')
+        if pos < 0:
+            return None
+        self.socket_data = data[pos+1:]
+        line = data[:pos]
+        if self.msgpack is not None and self.encoding == "json":
+            # Check for response to encoding request
+            m = json.loads(line)
+            if m.get("id") == "whconsole_encoding":
+                self.encoding = m.get("result", {}).get("encoding", "json")
+        return line
     def process_socket(self):
         data = self.webhook_socket.recv(4096)
         if not data:
             sys.stderr.write("Socket closed\n")
             sys.exit(0)
-        parts = data.split(b'\x03')
-        parts[0] = self.socket_data + parts[0]
-        self.socket_data = parts.pop()
-        for line in parts:
+        self.socket_data += data
+        while 1:
+            line = self.pop_message()
+            if line is None:
+                break
             sys.stdout.write("GOT: %s\n" % (line,))
     def process_kbd(self):
         data = os.read(self.kbd_fd, 4096)
@@ -63,9 +110,7 @@ class KeyboardReader:
             except:
                 sys.stderr.write("ERROR: Unable to parse line\n")
                 continue
-            cm = json.dumps(m, separators=(',', ':'))
-            sys.stdout.write("SEND: %s\n" % (cm,))
-            self.webhook_socket.send(cm.encode() + b"\x03")
+            self.send_message(m)
     def run(self):
         while 1:
             res = self.poll.poll(1000.)
@@ -78,11 +123,13 @@ class KeyboardReader:
 def main():
     usage = "%prog [options] <socket filename>"
     opts = optparse.OptionParser(usage)
+    opts.add_option("-m", "--msgpack", action="store_true",
+                    help="use msgpack encoding on the api socket")
     options, args = opts.parse_args()
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
 
-    ml = KeyboardReader(args[0])
+    ml = KeyboardReader(args[0], options.msgpack)
     ml.run()
 
 if __name__ == '__main__':